@@ -19,6 +19,7 @@ from foolscap.referenceable import Referenceable, SturdyRef
 from foolscap.copyable import Copyable, RemoteCopy, registerRemoteCopy
 from foolscap.copyable import registerCopier, registerRemoteCopyFactory
 from foolscap.ipb import DeadReferenceError
+from foolscap.ipb import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
 from foolscap.tokens import BananaError
 from foolscap.schema import StringConstraint, IntegerConstraint, \
     ListOf, TupleOf, SetOf, DictOf, ChoiceOf, Any
@@ -36,6 +37,7 @@ _unused = [
     Copyable, RemoteCopy, registerRemoteCopy,
     registerCopier, registerRemoteCopyFactory,
     DeadReferenceError,
+    PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW,
     BananaError,
     StringConstraint, IntegerConstraint,
     ListOf, TupleOf, SetOf, DictOf, ChoiceOf, Any,
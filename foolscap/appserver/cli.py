@@ -10,7 +10,8 @@ from twisted.scripts import twistd
 import foolscap
 from foolscap.api import Tub, Referenceable, fireEventually
 from foolscap.pb import generateSwissnumber
-from foolscap.appserver.services import build_service, BadServiceArguments
+from foolscap.appserver.services import build_service, BadServiceArguments, \
+     parse_service_args
 from foolscap.appserver.server import AppServer
 
 def get_umask():
@@ -263,7 +264,7 @@ def list_services(basedir):
         service_type_f = os.path.join(s.service_basedir, "service_type")
         s.service_type = open(service_type_f).read().strip()
         service_args_f = os.path.join(s.service_basedir, "service_args")
-        s.service_args = eval(open(service_args_f).read().strip())
+        s.service_args = parse_service_args(open(service_args_f).read())
         comment_f = os.path.join(s.service_basedir, "comment")
         s.comment = None
         if os.path.exists(comment_f):
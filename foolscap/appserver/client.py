@@ -15,6 +15,16 @@ class BaseOptions(usage.Options):
 class UploadFileOptions(BaseOptions):
     def getSynopsis(self):
         return "Usage: flappclient [--furl=|--furlfile] upload-file SOURCEFILES.."
+    optParameters = [
+        ("window", None, None,
+         "maximum number of reads the server may keep in flight"),
+        ("blocksize", None, None,
+         "maximum number of bytes the server may read at a time"),
+        ]
+    def opt_window(self, window):
+        self["window"] = int(window)
+    def opt_blocksize(self, blocksize):
+        self["blocksize"] = int(blocksize)
     def parseArgs(self, *sourcefiles):
         self.sourcefiles = sourcefiles
     longdesc = """This client sends one or more files to the upload-file
@@ -23,11 +33,22 @@ class UploadFileOptions(BaseOptions):
     argument."""
 
 class Uploader(Referenceable):
+    def __init__(self, window=None, blocksize=None):
+        self.window = window
+        self.blocksize = blocksize
+
     def run(self, rref, sourcefile, name):
         self.f = open(os.path.expanduser(sourcefile), "rb")
         return rref.callRemote("putfile", name, self)
 
+    def remote_get_read_parameters(self):
+        # the server keeps several reads in flight: these limit how many,
+        # and how large. None means the server's own default.
+        return {"window": self.window, "blocksize": self.blocksize}
+
     def remote_read(self, size):
+        # reads arrive (and are answered) in order, even when several are
+        # outstanding
         return self.f.read(size)
 
 class UploadFile(Referenceable):
@@ -35,12 +56,13 @@ class UploadFile(Referenceable):
         d = defer.succeed(None)
         for sf in options.sourcefiles:
             name = os.path.basename(sf)
-            d.addCallback(self._upload, rref, sf, name)
+            d.addCallback(self._upload, rref, sf, name, options)
             d.addCallback(self._done, options, name)
         d.addCallback(lambda _ign: 0)
         return d
-    def _upload(self, _ignored, rref, sf, name):
-        return Uploader().run(rref, sf, name)
+    def _upload(self, _ignored, rref, sf, name, options):
+        uploader = Uploader(options["window"], options["blocksize"])
+        return uploader.run(rref, sf, name)
     def _done(self, _ignored, options, name):
         print >>options.stdout, "%s: uploaded" % name
 
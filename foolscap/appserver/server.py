@@ -1,11 +1,11 @@
 
-import sys
+import sys, signal
 import os.path
 from twisted.application import service
 from twisted.python import log
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from foolscap.api import Tub
-from foolscap.appserver.services import build_service
+from foolscap.appserver.services import build_service, parse_service_args
 from foolscap.observer import OneShotObserverList
 
 class AppServer(service.MultiService):
@@ -27,6 +27,17 @@ class AppServer(service.MultiService):
         # make sure we log any problems
         self.when_ready().addErrback(log.err)
 
+        # the service table maps swissnum to (stamp, service), where service
+        # is None for entries that could not be built. It is loaded when we
+        # start, and reloaded (rebuilding only the entries that changed)
+        # when the services/ directory is modified or we get a SIGHUP.
+        # Names that aren't in the table are rejected without touching the
+        # disk.
+        self.service_table = {}
+        self.services_dir = os.path.join(self.basedir, "services")
+        self.services_dir_stamp = None
+        self.old_sighup_handler = None
+
     def when_ready(self):
         # return a Deferred that fires (with this AppServer instance) when
         # the service is running and the location is set.
@@ -36,9 +47,22 @@ class AppServer(service.MultiService):
         if self.umask is not None:
             os.umask(self.umask)
         service.MultiService.startService(self)
+        self.load_services()
+        if hasattr(signal, "SIGHUP"):
+            self.old_sighup_handler = signal.signal(signal.SIGHUP,
+                                                    self._sighup)
         d = self.setMyLocation()
         d.addBoth(self.ready_observers.fire)
 
+    def stopService(self):
+        if self.old_sighup_handler is not None:
+            signal.signal(signal.SIGHUP, self.old_sighup_handler)
+            self.old_sighup_handler = None
+        return service.MultiService.stopService(self)
+
+    def _sighup(self, signum, frame):
+        reactor.callFromThread(self.load_services)
+
     def setMyLocation(self):
         location = open(os.path.join(self.basedir, "location")).read().strip()
         if location:
@@ -48,15 +72,59 @@ class AppServer(service.MultiService):
         d.addCallback(lambda ign: self)
         return d
 
-    def lookup(self, name):
-        # walk through our configured services, see if we know about this one
-        service_basedir = os.path.join(self.basedir, "services", name)
-        if not os.path.exists(service_basedir):
+    def _stat(self, fn):
+        try:
+            s = os.stat(fn)
+        except EnvironmentError:
             return None
+        # st_nlink changes when a subdirectory is added or removed, even if
+        # st_mtime has a coarse resolution
+        return (s.st_mtime, s.st_size, s.st_ino, s.st_nlink)
+
+    def load_services(self):
+        # (re)build the service table from services/*
+        self.services_dir_stamp = self._stat(self.services_dir)
+        try:
+            names = os.listdir(self.services_dir)
+        except EnvironmentError:
+            names = []
+        old_services = self.service_table
+        self.service_table = {}
+        for name in names:
+            service_basedir = os.path.join(self.services_dir, name)
+            stamp = (self._stat(os.path.join(service_basedir,
+                                             "service_type")),
+                     self._stat(os.path.join(service_basedir,
+                                             "service_args")))
+            if name in old_services and old_services[name][0] == stamp:
+                self.service_table[name] = old_services.pop(name)
+                continue
+            s = None
+            try:
+                s = self.build_service(service_basedir)
+            except Exception:
+                log.err(None, "unable to build service %s" % service_basedir)
+            self.service_table[name] = (stamp, s)
+        # stop anything that was removed or replaced
+        for (stamp, s) in old_services.values():
+            if s is not None:
+                s.disownServiceParent()
+
+    def build_service(self, service_basedir):
         service_type_f = os.path.join(service_basedir, "service_type")
         service_type = open(service_type_f).read().strip()
         service_args_f = os.path.join(service_basedir, "service_args")
-        service_args = eval(open(service_args_f).read().strip())
+        service_args = parse_service_args(open(service_args_f).read())
         s = build_service(service_basedir, self.tub, service_type, service_args)
         s.setServiceParent(self)
         return s
+
+    def lookup(self, name):
+        # see if we know about this one. A single stat() tells us whether
+        # services have been added or removed since we last looked.
+        if self._stat(self.services_dir) != self.services_dir_stamp:
+            self.load_services()
+        entry = self.service_table.get(name)
+        if entry is None:
+            return None
+        return entry[1]
@@ -1,5 +1,5 @@
 
-import os
+import os, re
 from twisted.python import usage, runtime, filepath, log
 from twisted.application import service
 from twisted.internet import defer, reactor, protocol
@@ -29,7 +29,10 @@ This service allows clients to upload files to a specific directory.
         ]
     optParameters = [
         ("mode", None, 0644,
-         "(octal) mode to set uploaded files to, use 0644 for world-readable")
+         "(octal) mode to set uploaded files to, use 0644 for world-readable"),
+        ("window", None, 4,
+         "maximum number of reads to keep in flight during an upload"),
+        ("blocksize", None, 1024*1024, "maximum size of each read, in bytes"),
         ]
 
     def opt_mode(self, mode):
@@ -38,6 +41,16 @@ This service allows clients to upload files to a specific directory.
         else:
             self["mode"] = int(mode)
 
+    def opt_window(self, window):
+        self["window"] = int(window)
+        if self["window"] < 1:
+            raise BadServiceArguments("--window must be at least 1")
+
+    def opt_blocksize(self, blocksize):
+        self["blocksize"] = int(blocksize)
+        if self["blocksize"] < 1:
+            raise BadServiceArguments("--blocksize must be at least 1")
+
     def parseArgs(self, targetdir):
         self.targetdir = os.path.abspath(targetdir)
         if self["allow-subdirectories"]:
@@ -50,31 +63,67 @@ This service allows clients to upload files to a specific directory.
                                       % self.targetdir)
 
 class FileUploaderReader(Referenceable):
+    # we keep up to WINDOW reads of BLOCKSIZE bytes outstanding, so the
+    # transfer isn't limited to one block per round trip. The source answers
+    # its reads in the order they were sent, but we write them out by block
+    # number anyway.
     BLOCKSIZE = 1024*1024
-    def __init__(self, f, source):
+    WINDOW = 4
+
+    def __init__(self, f, source, blocksize=None, window=None):
         self.f = f
         self.source = source
+        self.blocksize = blocksize or self.BLOCKSIZE
+        self.window = window or self.WINDOW
         self.d = defer.Deferred()
+        self.next_read = 0 # block number of the next read to send
+        self.next_write = 0 # block number of the next block to write
+        self.early_blocks = {} # block number -> data received out of order
+        self.outstanding = 0
+        self.eof = False
+        self.failed = False
 
     def read_file(self):
-        self.read_block()
+        self.fill_window()
         return self.d
 
-    def read_block(self):
-        d = self.source.callRemote("read", self.BLOCKSIZE)
-        d.addCallback(self._got_data)
-        d.addErrback(self._got_error)
+    def fill_window(self):
+        while (not self.eof and not self.failed
+               and self.outstanding < self.window):
+            self.read_block()
 
-    def _got_data(self, data):
+    def read_block(self):
+        blocknum = self.next_read
+        self.next_read += 1
+        self.outstanding += 1
+        d = self.source.callRemote("read", self.blocksize)
+        d.addCallbacks(self._got_data, self._got_error,
+                       callbackArgs=(blocknum,))
+
+    def _got_data(self, data, blocknum):
+        self.outstanding -= 1
+        if self.failed:
+            return
         if data:
-            self.f.write(data)
-            self.read_block()
+            self.early_blocks[blocknum] = data
+            while self.next_write in self.early_blocks:
+                self.f.write(self.early_blocks.pop(self.next_write))
+                self.next_write += 1
         else:
-            # no more data: we're done
-            self.d.callback(None)
+            # no more data. Any reads still in flight will come back empty.
+            self.eof = True
+        if self.eof:
+            if not self.outstanding:
+                # we're done
+                self.d.callback(None)
+            return
+        self.fill_window()
 
     def _got_error(self, f):
-        self.d.errback(f)
+        self.outstanding -= 1
+        if not self.failed:
+            self.failed = True
+            self.d.errback(f)
 
 
 class BadFilenameError(Exception):
@@ -119,8 +168,20 @@ class FileUploader(service.MultiService, Referenceable):
         # TODO: use os.open and set the file mode earlier
         #f = open(tmpfile, "w")
         f = tmpfile.open("w")
-        reader = FileUploaderReader(f, source)
-        d = reader.read_file()
+        # newer clients can ask for a smaller window or blocksize than
+        # ours. Older ones don't have get_read_parameters.
+        d = source.callRemote("get_read_parameters")
+        d.addErrback(lambda f: {})
+        def _read(params):
+            window = self.options["window"]
+            blocksize = self.options["blocksize"]
+            if params.get("window"):
+                window = min(window, params["window"])
+            if params.get("blocksize"):
+                blocksize = min(blocksize, params["blocksize"])
+            reader = FileUploaderReader(f, source, blocksize, window)
+            return reader.read_file()
+        d.addCallback(_read)
         def _done(res):
             f.close()
             if runtime.platform.isWindows() and targetfile.exists():
@@ -282,6 +343,24 @@ all_services = {
     "run-command": (CommandRunnerOptions, CommandRunner),
     }
 
+# service_args files hold repr(service_args): a tuple or list of plain
+# strings, depending upon what was passed to add_service()
+_string_literal = (r"'(?:[^'\\]|\\.)*'" + "|" +
+                   r'"(?:[^"\\]|\\.)*"')
+_string_literal_re = re.compile(_string_literal)
+_service_args_re = re.compile(r"^([\[(])\s*((?:(?:%s)\s*,\s*)*(?:%s)?)\s*"
+                              r"([\])])$"
+                              % (_string_literal, _string_literal))
+
+def parse_service_args(text):
+    """Parse the contents of a service_args file (the repr() of a tuple or
+    list of strings) without eval(). Always returns a tuple."""
+    mo = _service_args_re.search(text.strip())
+    if not mo or (mo.group(1) + mo.group(3)) not in ("()", "[]"):
+        raise BadServiceArguments("unparseable service_args: %r" % (text,))
+    return tuple([lit[1:-1].decode("string_escape")
+                  for lit in _string_literal_re.findall(mo.group(2))])
+
 def build_service(basedir, tub, service_type, service_args):
     # this will be replaced by a plugin system. For now it's pretty static.
     if service_type in all_services:
@@ -1,5 +1,6 @@
 
-import struct, time
+import re, struct, time
+from collections import deque
 
 from twisted.internet import protocol, defer, reactor
 from twisted.python.failure import Failure
@@ -10,11 +11,10 @@ from twisted.python import log
 from foolscap.slicers.allslicers import RootSlicer, RootUnslicer
 from foolscap.slicers.allslicers import ReplaceVocabSlicer, AddVocabSlicer
 
-import stringchain
 import tokens
 from tokens import SIZE_LIMIT, STRING, LIST, INT, NEG, \
      LONGINT, LONGNEG, VOCAB, FLOAT, OPEN, CLOSE, ABORT, ERROR, \
-     PING, PONG, \
+     PING, PONG, LANE, \
      BananaError, BananaFailure, Violation
 
 EPSILON = 0.1
@@ -28,6 +28,17 @@ def int2b128(integer, stream):
         stream(chr(integer & 0x7f))
         integer = integer >> 7
 
+def int2b128string(integer):
+    """Like int2b128, but return the encoded bytes as a single string."""
+    if integer < 0x80:
+        assert integer >= 0, "can only encode positive integers"
+        return chr(integer)
+    digits = []
+    while integer:
+        digits.append(chr(integer & 0x7f))
+        integer = integer >> 7
+    return "".join(digits)
+
 def b1282int(st):
     # NOTE that this is little-endian
     oneHundredAndTwentyEight = 128
@@ -89,6 +100,9 @@ def bytes_to_long(s):
     return acc
 
 HIGH_BIT_SET = chr(0x80)
+# matches the header of a token: up to 64 bytes with the high bit clear. If
+# this matches 65 bytes, the token is malformed.
+HEADER_RE = re.compile("[\x00-\x7f]{0,65}")
 
 
 
@@ -152,6 +166,8 @@ class Banana(protocol.Protocol):
         if self.keepaliveTimer:
             self.keepaliveTimer.cancel()
             self.keepaliveTimer = None
+        # the transport forgets about its producer by itself
+        self.producerRegistered = False
         protocol.Protocol.connectionLost(self, why)
 
     ### SendBanana
@@ -160,14 +176,88 @@ class Banana(protocol.Protocol):
 
     slicerClass = RootSlicer # this is used in connectionMade()
     paused = False
+    # flush the outbound buffer in the middle of produce() once it holds
+    # this many bytes, rather than waiting for produce() to stop
+    outboundHighWaterMark = 64*1024
     streamable = True # this is checked at connectionMade() time
     debugSend = False
 
+    # adaptive VOCAB compression. When enabled (see enableVocabLearning),
+    # we remember the last few strings that were sent in full. Any string
+    # which shows up often enough in that window is added to the outbound
+    # VOCAB table (with an add-vocab sequence), and later copies are sent as
+    # short VOCAB tokens. The far end must accept top-level add-vocab
+    # sequences, so this is off by default.
+    vocabLearning = False
+    vocabPromotionThreshold = 3 # copies within the window before promotion
+    vocabCandidateWindow = 30 # how many recent full strings we remember
+    vocabTableSizeLimit = 1000 # stop adding once the table is this large
+    vocabMinLength = 3 # shorter strings are not worth a table entry
+    vocabMaxLength = 100 # AddVocabUnslicer rejects anything longer
+    # the far end may not grow our incoming VOCAB table without bound: an
+    # add-vocab sequence for an index at or above this limit is a protocol
+    # error. A sender's vocabTableSizeLimit must not exceed it.
+    incomingVocabTableSizeLimit = 4096
+
+    # outbound lanes. Every top-level object is sent in one of the
+    # RootSlicer's lanes, and each lane is serialized in order. There is
+    # only one lane until enableSendLanes() is called (the far end must
+    # accept LANE tokens). After that, a weighted scheduler picks the next
+    # lane whenever the current one has to wait for a Deferred, or has been
+    # producing for laneQuantum steps (unless the Slicer on top of its stack
+    # has .holdsLane set), and a LANE token tells the far end which lane the
+    # following tokens belong to. Lane 0 is the most urgent.
+    sendLaneWeights = (4, 2, 1)
+    laneQuantum = 64 # produce() steps (roughly tokens) between choices
+    flowControl = False # see flushBulk
+    maxReceiveLanes = 8 # we reject LANE tokens for higher-numbered lanes
+
     def initSend(self):
+        self.producerRegistered = False
         self.openCount = 0
+        self.outboundBuffer = [] # bytes waiting for flushOutbound()
+        self.outboundBufferSize = 0 # approximate
         self.outgoingVocabulary = {}
         self.nextAvailableOutgoingVocabularyIndex = 0
         self.pendingVocabAdditions = set()
+        # these are only used when vocabLearning is enabled
+        self.vocabCandidates = {} # maps string to count within the window
+        self.vocabWindow = deque() # the last few strings sent in full
+        self.vocabStats = {"strings-sent": 0, # STRING tokens
+                           "string-bytes-sent": 0,
+                           "vocab-tokens-sent": 0, # VOCAB tokens
+                           "vocab-bytes-saved": 0, # approximate
+                           "vocab-additions": 0, # add-vocab sequences
+                           }
+
+    def enableVocabLearning(self, threshold=None, tableSize=None,
+                            window=None):
+        """Start adding frequently-sent strings to the outbound VOCAB table.
+
+        Only call this if the far end is known to accept top-level
+        (add-vocab) sequences. 'threshold' is the number of times a string
+        must be sent in full (within the last 'window' full strings) before
+        it is added to the table. No entries will be added once the table
+        holds 'tableSize' strings.
+        """
+        if threshold is not None:
+            assert threshold > 0
+            self.vocabPromotionThreshold = threshold
+        if tableSize is not None:
+            self.vocabTableSizeLimit = tableSize
+        if window is not None:
+            assert window > 0
+            self.vocabCandidateWindow = window
+        self.vocabLearning = True
+
+    def getVocabStats(self):
+        """Return a dictionary of statistics about outbound string
+        compression on this connection."""
+        stats = self.vocabStats.copy()
+        stats["table-size"] = len(self.outgoingVocabulary)
+        stats["pending-additions"] = len(self.pendingVocabAdditions)
+        stats["candidates"] = len(self.vocabCandidates)
+        return stats
 
     def initSlicer(self):
         self.rootSlicer = self.slicerClass(self)
@@ -175,23 +265,151 @@ class Banana(protocol.Protocol):
         assert tokens.ISlicer.providedBy(self.rootSlicer)
         assert tokens.IRootSlicer.providedBy(self.rootSlicer)
 
+        self.producing = False
+        self.sendVirtualTime = 0.0 # of the lane that was picked last
+        lane = self.rootSlicer.lane
+        self.initSendLane(lane)
+        self.sendLane = lane
+        self.slicerStack = lane.stack
+        self.wireLane = 0 # where the far end thinks our tokens belong
+
+    def initSendLane(self, lane):
         itr = self.rootSlicer.slice()
         next = iter(itr).next
         top = (self.rootSlicer, next, None)
-        self.slicerStack = [top]
+        lane.stack = [top]
+
+    def enableSendLanes(self):
+        """Start multiplexing the outbound lanes (see sendLaneWeights).
 
-    def send(self, obj):
+        Only call this if the far end is known to accept LANE tokens.
+        Objects sent in different lanes may be delivered in a different
+        order than they were sent.
+        """
+        root = self.rootSlicer
+        if len(root.lanes) > 1:
+            return
+        weights = self.sendLaneWeights
+        root.lanes[0].weight = weights[0]
+        for weight in weights[1:]:
+            self.initSendLane(root.addLane(weight))
+        # let the new lanes go idle
+        self.produce()
+
+    def send(self, obj, lane=0):
         if self.debugSend: print "Banana.send(%s)" % obj
-        return self.rootSlicer.send(obj)
+        return self.rootSlicer.send(obj, lane)
+
+    def chooseSendLane(self):
+        # weighted fair queueing: of the lanes that have something to do,
+        # pick the one that has used the least of its share so far
+        best = None
+        for lane in self.rootSlicer.lanes:
+            if lane.blocked:
+                continue
+            if best is None or lane.virtualTime < best.virtualTime:
+                best = lane
+        if best is None:
+            return None
+        self.sendVirtualTime = best.virtualTime
+        best.virtualTime += 1.0 / best.weight
+        if best is not self.sendLane:
+            self.switchSendLane(best)
+        if best.number != self.wireLane and (len(best.stack) > 1
+                                             or best.sendQueue
+                                             or best.objectSentDeferred):
+            # this lane may be about to send tokens (an idle one is not), so
+            # tell the far end where they belong
+            self.wireLane = best.number
+            self.sendLaneToken(best.number)
+        return best
+
+    def switchSendLane(self, lane):
+        if self.debugSend: print "switching to %s" % lane
+        self.sendLane = lane
+        self.slicerStack = lane.stack
+        self.rootSlicer.lane = lane
+        self.rootSlicer.streamable = lane.streamable
+
+    def _laneReady(self, res, lane):
+        # a lane that was waiting for a Deferred can go on. It does not get
+        # credit for the time it spent waiting.
+        lane.blocked = False
+        if lane.virtualTime < self.sendVirtualTime:
+            lane.virtualTime = self.sendVirtualTime
+        self.produce()
+
+    # IPushProducer. If flowControl is set (the Broker sets it when it
+    # enables the lanes), we register with the transport whenever we find
+    # ourselves producing a large object, so that it is only produced as fast
+    # as the transport can take it, and objects in other lanes can go
+    # between its pieces instead of waiting behind all of it. We unregister
+    # once every lane is idle again, because some transports (TLS, for one)
+    # will not finish a loseConnection() while they still have a producer.
+
+    def flushBulk(self):
+        if self.flowControl and not self.producerRegistered:
+            self.transport.registerProducer(self, True)
+            self.producerRegistered = True
+        self.flushOutbound()
+
+    def unregisterProducer(self):
+        if self.producerRegistered:
+            self.producerRegistered = False
+            self.transport.unregisterProducer()
+
+    def dropConnection(self):
+        self.unregisterProducer()
+        self.transport.loseConnection()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.produce()
+
+    def stopProducing(self):
+        pass
 
     def _slice_error(self, f, s):
         log.msg("Error in Deferred returned by slicer %s: %s" % (s, f))
         self.sendFailed(f)
 
     def produce(self, dummy=None):
+        if self.producing:
+            # we were called from inside the loop below, by a Deferred which
+            # fired right away or by a lane which just became ready. The
+            # loop will notice.
+            return
+        self.producing = True
+        try:
+            self._produce()
+        finally:
+            self.producing = False
+
+    def _produce(self):
         # optimize: cache 'next' because we get many more tokens than stack
         # pushes/pops
-        while self.slicerStack and not self.paused:
+        lane = self.sendLane
+        steps = 0 # a lane with something urgent may have woken up
+        while not self.paused:
+            if lane.blocked or (steps <= 0 and
+                                not getattr(self.slicerStack[-1][0],
+                                            "holdsLane", False)):
+                lane = self.chooseSendLane()
+                if lane is None:
+                    # every lane is waiting for a Deferred. This is the
+                    # primary exit point.
+                    if self.producerRegistered:
+                        for other in self.rootSlicer.lanes:
+                            if not other.producingDeferred:
+                                break # still in the middle of something
+                        else:
+                            self.unregisterProducer()
+                    break
+                steps = self.laneQuantum
+            steps -= 1
             if self.debugSend: print "produce.loop"
             try:
                 slicer, next, openID = self.slicerStack[-1]
@@ -201,19 +419,34 @@ class Banana(protocol.Protocol):
                     for s,n,o in self.slicerStack:
                         if not s.streamable:
                             raise Violation("parent not streamable")
-                    obj.addCallback(self.produce)
+                    # this lane has to wait, but the others can go on
+                    lane.blocked = True
+                    obj.addCallback(self._laneReady, lane)
                     obj.addErrback(self._slice_error, s)
-                    # this is the primary exit point
-                    break
+                    continue
                 elif type(obj) in (int, long, float, str):
                     # sendToken raises a BananaError for weird tokens
                     self.sendToken(obj)
+                    if self.outboundBufferSize > self.outboundHighWaterMark:
+                        self.flushBulk()
                 else:
                     # newSlicerFor raises a Violation for unsendable types
                     # pushSlicer calls .slice, which can raise Violation
                     try:
                         slicer = self.newSlicerFor(obj)
-                        self.pushSlicer(slicer, obj)
+                        body = None
+                        if slicer.sendOpen:
+                            slicePrimitives = getattr(slicer,
+                                                      "slicePrimitives", None)
+                            if slicePrimitives:
+                                body = slicePrimitives()
+                        if body is None:
+                            self.pushSlicer(slicer, obj)
+                        else:
+                            self.sendPrimitives(slicer, obj, body)
+                            if (self.outboundBufferSize >
+                                self.outboundHighWaterMark):
+                                self.flushBulk()
                     except Violation, v:
                         # pushSlicer is arranged such that the pushing of
                         # the Slicer and the sending of the OPEN happen
@@ -259,6 +492,9 @@ class Banana(protocol.Protocol):
                 # is nothing left to do.
                 return
 
+        # we're about to wait (for a Deferred, for more objects to send, or
+        # to be unpaused), so now is the time to write what we've produced
+        self.flushOutbound()
         assert self.slicerStack # should never be empty
 
     def handleSendViolation(self, f, doPop, sendAbort):
@@ -359,6 +595,32 @@ class Banana(protocol.Protocol):
         slicertuple = (slicer, next, openID)
         self.slicerStack.append(slicertuple)
 
+    def sendPrimitives(self, slicer, obj, body):
+        # this emits the same tokens as pushSlicer() followed by iterating
+        # over the slicer and popSlicer(), for slicers which told us (via
+        # slicePrimitives) that their body is made entirely of primitive
+        # values. It saves a stack frame and a trip around produce() for
+        # each element.
+        if self.debugSend: print "sendPrimitives", slicer
+        topSlicer = self.slicerStack[-1][0]
+        slicer.parent = topSlicer
+        openID = self.sendOpen()
+        if slicer.trackReferences:
+            topSlicer.registerReference(openID, obj)
+        sendToken = self.sendToken
+        for t in slicer.opentype:
+            sendToken(t)
+        for t in body:
+            if type(t) is bool:
+                # this is what BooleanSlicer would produce
+                boolID = self.sendOpen()
+                sendToken("boolean")
+                sendToken(int(t))
+                self.sendClose(boolID)
+            else:
+                sendToken(t)
+        self.sendClose(openID)
+
     def popSlicer(self):
         slicer, next, openID = self.slicerStack.pop()
         if openID is not None:
@@ -431,7 +693,7 @@ class Banana(protocol.Protocol):
             return
         if value in self.pendingVocabAdditions:
             return
-        self.pendingVocabAdditions.add(str)
+        self.pendingVocabAdditions.add(value)
         s = AddVocabSlicer(value)
         self.send(s)
 
@@ -455,94 +717,142 @@ class Banana(protocol.Protocol):
         #
         # return self.outgoingVocabulary[string]
 
-        self.pendingVocabAdditions.remove(self.value)
         index = self.nextAvailableOutgoingVocabularyIndex
         self.nextAvailableOutgoingVocabularyIndex = index + 1
         return index
 
     def outgoingVocabTableWasAmended(self, index, string):
+        # the string stays pending until now, so that the copy inside the
+        # (add-vocab) sequence itself does not provoke a second addition
+        self.pendingVocabAdditions.discard(string)
         self.outgoingVocabulary[string] = index
 
-    # these methods define how we emit low-level tokens
+    # these methods define how we emit low-level tokens. The bytes are
+    # collected in self.outboundBuffer and handed to the transport by
+    # flushOutbound(), which produce() calls whenever it stops to wait, or
+    # when the buffer grows past outboundHighWaterMark. Tokens which are
+    # sent from outside produce() (PING, PONG, ERROR) flush right away.
+
+    def flushOutbound(self):
+        if not self.outboundBuffer:
+            return
+        data = "".join(self.outboundBuffer)
+        self.outboundBuffer = []
+        self.outboundBufferSize = 0
+        self.transport.write(data)
 
     def sendPING(self, number=0):
         if number:
-            int2b128(number, self.transport.write)
-        self.transport.write(PING)
+            self.outboundBuffer.append(int2b128string(number) + PING)
+        else:
+            self.outboundBuffer.append(PING)
+        self.flushOutbound()
 
     def sendPONG(self, number):
         if number:
-            int2b128(number, self.transport.write)
-        self.transport.write(PONG)
+            self.outboundBuffer.append(int2b128string(number) + PONG)
+        else:
+            self.outboundBuffer.append(PONG)
+        self.flushOutbound()
+
+    def sendLaneToken(self, number):
+        self.outboundBuffer.append(int2b128string(number) + LANE)
+        self.outboundBufferSize += 2
 
     def sendOpen(self):
         openID = self.openCount
         self.openCount += 1
-        int2b128(openID, self.transport.write)
-        self.transport.write(OPEN)
+        self.outboundBuffer.append(int2b128string(openID) + OPEN)
+        self.outboundBufferSize += 2
         return openID
 
     def sendToken(self, obj):
-        write = self.transport.write
         if isinstance(obj, (int, long)):
             if obj >= 2**31:
                 s = long_to_bytes(obj)
-                int2b128(len(s), write)
-                write(LONGINT)
-                write(s)
+                data = int2b128string(len(s)) + LONGINT + s
             elif obj >= 0:
-                int2b128(obj, write)
-                write(INT)
+                data = int2b128string(obj) + INT
             elif -obj > 2**31: # NEG is [-2**31, 0)
                 s = long_to_bytes(-obj)
-                int2b128(len(s), write)
-                write(LONGNEG)
-                write(s)
+                data = int2b128string(len(s)) + LONGNEG + s
             else:
-                int2b128(-obj, write)
-                write(NEG)
+                data = int2b128string(-obj) + NEG
         elif isinstance(obj, float):
-            write(FLOAT)
-            write(struct.pack("!d", obj))
+            data = FLOAT + struct.pack("!d", obj)
         elif isinstance(obj, str):
             if self.outgoingVocabulary.has_key(obj):
                 symbolID = self.outgoingVocabulary[obj]
-                int2b128(symbolID, write)
-                write(VOCAB)
+                data = int2b128string(symbolID) + VOCAB
+                if self.vocabLearning:
+                    stats = self.vocabStats
+                    stats["vocab-tokens-sent"] += 1
+                    stats["vocab-bytes-saved"] += len(obj)
             else:
-                self.maybeVocabizeString(obj)
-                int2b128(len(obj), write)
-                write(STRING)
-                write(obj)
+                if self.vocabLearning:
+                    self.maybeVocabizeString(obj)
+                # the body is appended separately, to avoid copying large
+                # strings
+                self.outboundBuffer.append(int2b128string(len(obj)) + STRING)
+                data = obj
         else:
             raise BananaError, "could not send object: %s" % repr(obj)
+        self.outboundBuffer.append(data)
+        self.outboundBufferSize += len(data)
 
     def maybeVocabizeString(self, string):
-        # TODO: keep track of the last 30 strings we've send in full. If this
-        # string appears more than 3 times on that list, create a vocab item
-        # for it. Make sure we don't start using the vocab number until the
-        # ADDVOCAB token has been queued.
-        if False:
-            self.addToOutgoingVocabulary(string)
+        # keep track of the last 30 (vocabCandidateWindow) strings we've sent
+        # in full. If this string appears 3 (vocabPromotionThreshold) times
+        # in that window, create a vocab item for it. We don't start using
+        # the vocab number until the add-vocab sequence has been serialized:
+        # AddVocabSlicer amends our table when it finishes.
+        stats = self.vocabStats
+        stats["strings-sent"] += 1
+        stats["string-bytes-sent"] += len(string)
+        if (len(string) < self.vocabMinLength
+            or len(string) > self.vocabMaxLength):
+            return
+        if string in self.pendingVocabAdditions:
+            return
+        candidates = self.vocabCandidates
+        window = self.vocabWindow
+        count = candidates.get(string, 0) + 1
+        candidates[string] = count
+        window.append(string)
+        if len(window) > self.vocabCandidateWindow:
+            old = window.popleft()
+            oldcount = candidates[old] - 1
+            if oldcount:
+                candidates[old] = oldcount
+            else:
+                del candidates[old]
+        if count < self.vocabPromotionThreshold:
+            return
+        tablesize = (self.nextAvailableOutgoingVocabularyIndex
+                     + len(self.pendingVocabAdditions))
+        if tablesize >= self.vocabTableSizeLimit:
+            return
+        stats["vocab-additions"] += 1
+        self.addToOutgoingVocabulary(string)
 
     def sendClose(self, openID):
-        int2b128(openID, self.transport.write)
-        self.transport.write(CLOSE)
+        self.outboundBuffer.append(int2b128string(openID) + CLOSE)
+        self.outboundBufferSize += 2
 
     def sendAbort(self, count=0):
-        int2b128(count, self.transport.write)
-        self.transport.write(ABORT)
+        self.outboundBuffer.append(int2b128string(count) + ABORT)
+        self.outboundBufferSize += 2
 
     def sendError(self, msg):
         if not self.transport:
             return
         if len(msg) > SIZE_LIMIT:
             msg = msg[:SIZE_LIMIT-10] + "..."
-        int2b128(len(msg), self.transport.write)
-        self.transport.write(ERROR)
-        self.transport.write(msg)
+        self.outboundBuffer.append(int2b128string(len(msg)) + ERROR)
+        self.outboundBuffer.append(msg)
+        self.flushOutbound()
         # now you should drop the connection
-        self.transport.loseConnection()
+        self.dropConnection()
 
     def sendFailed(self, f):
         # call this if an exception is raised in transmission. The Failure
@@ -553,7 +863,7 @@ class Banana(protocol.Protocol):
         log.err(f)
         try:
             if self.transport:
-                self.transport.loseConnection()
+                self.dropConnection()
         except:
             print "exception during transport.loseConnection"
             log.err()
@@ -580,18 +890,28 @@ class Banana(protocol.Protocol):
     def initReceive(self):
         self.inOpen = False # set during the Index Phase of an OPEN sequence
         self.opentype = [] # accumulates Index Tokens
+        self.inboundOpenCount = None # of the sequence being opened
+        self.inboundObjectCount = None
 
         # to pre-negotiate, set the negotiation parameters and set
         # self.negotiated to True. It might instead make sense to fill
         # self.buffer with the inbound negotiation block.
         self.negotiated = False
         self.connectionAbandoned = False
-        self.buffer = stringchain.StringChain()
+        # unparsed inbound data: a list of strings, their total length, and
+        # the number of bytes we need before it is worth parsing again
+        self.buffer = []
+        self.bufferLength = 0
+        self.bufferWanted = 0
 
         self.incomingVocabulary = {}
         self.skipBytes = 0 # used to discard a single long token
         self.discardCount = 0 # used to discard non-primitive objects
         self.exploded = None # last-ditch error catcher
+        # the parsing state of the inbound lanes we are not reading right
+        # now, indexed by lane number. See switchReceiveLane.
+        self.receiveLane = 0
+        self.receiveLanes = {}
 
     def initUnslicer(self):
         self.rootUnslicer = self.unslicerClass(self)
@@ -628,8 +948,17 @@ class Banana(protocol.Protocol):
 
     def addIncomingVocabulary(self, key, value):
         # called in response to an OPEN(add-vocab) sequence
+        self.checkIncomingVocabularyIndex(key)
         self.incomingVocabulary[key] = value
 
+    def checkIncomingVocabularyIndex(self, key):
+        # the sender allocates indices sequentially, so limiting the index
+        # also limits the size of the table
+        if key < 0 or key >= self.incomingVocabTableSizeLimit:
+            raise BananaError("add-vocab index %d is outside the VOCAB table "
+                              "(limit %d)"
+                              % (key, self.incomingVocabTableSizeLimit))
+
     def dataReceived(self, chunk):
         if self.connectionAbandoned:
             return
@@ -718,40 +1047,59 @@ class Banana(protocol.Protocol):
             # skip part of the chunk, and stop skipping
             chunk = chunk[self.skipBytes:]
             self.skipBytes = 0
+        if not chunk:
+            return
         self.buffer.append(chunk)
+        self.bufferLength += len(chunk)
+        if self.bufferLength < self.bufferWanted:
+            # we're still waiting for the rest of a large token. Just hang
+            # on to the pieces: joining them now would make a long STRING
+            # cost O(n^2) to receive.
+            return
+        if len(self.buffer) == 1:
+            buf = chunk
+        else:
+            buf = "".join(self.buffer)
+        end = len(buf)
 
         # Loop through the available input data, extracting one token per
-        # pass.
-
-        while len(self.buffer):
-            first65 = self.buffer.popleft(65)
-            pos = 0
-            for ch in first65:
-                if ch >= HIGH_BIT_SET:
-                    break
-                pos = pos + 1
-                if pos > 64:
-                    # drop the connection. We log more of the buffer, but not
-                    # all of it, to make it harder for someone to spam our
-                    # logs.
-                    s = first65 + self.buffer.popleft(200)
-                    raise BananaError("token prefix is limited to 64 bytes: "
-                                      "but got %r" % s)
-            else:
+        # pass. 'pos' is the offset of the start of the current token. We
+        # parse the header in place and only copy bytes out of 'buf' when
+        # they form a token body (STRING, LONGINT, etc) that we deliver.
+
+        pos = 0
+        while pos < end:
+            if not (self.inOpen or self.discardCount or self.debugReceive):
+                top = self.receiveStack[-1]
+                if top.primitiveTaster is not None:
+                    pos = self.decodePrimitives(buf, pos, end, top)
+                    if pos == end:
+                        break
+            headerEnd = HEADER_RE.match(buf, pos).end()
+            if headerEnd - pos > 64:
+                # drop the connection. We log more of the buffer, but not
+                # all of it, to make it harder for someone to spam our
+                # logs.
+                s = buf[pos:pos+265]
+                raise BananaError("token prefix is limited to 64 bytes: "
+                                  "but got %r" % s)
+            if headerEnd == end:
                 # we've run out of buffer without seeing the high bit, which
                 # means we're still waiting for header to finish
-                self.buffer.appendleft(first65)
+                self._saveBuffer(buf, pos, end - pos + 1)
                 return
-            assert pos <= 64
 
             # At this point, the header and type byte have been received.
             # The body may or may not be complete.
 
-            typebyte = first65[pos]
-            if pos:
-                header = b1282int(first65[:pos])
+            typebyte = buf[headerEnd]
+            if headerEnd == pos + 1:
+                header = ord(buf[pos])
+            elif headerEnd > pos:
+                header = b1282int(buf[pos:headerEnd])
             else:
                 header = 0
+            bodyStart = headerEnd + 1
 
             # rejected is set as soon as a violation is detected. It
             # indicates that this single token will be rejected.
@@ -785,12 +1133,12 @@ class Banana(protocol.Protocol):
             # it is allowed to be (for STRING and LONGINT/LONGNEG)
 
             if ((not rejected) and
-                (typebyte not in (PING, PONG, ABORT, CLOSE, ERROR))):
-                # PING, PONG, ABORT, CLOSE, and ERROR are always legal. All
-                # others (including OPEN) can be rejected by the schema: for
-                # example, a list of integers would reject STRING, VOCAB, and
-                # OPEN because none of those will produce integers. If the
-                # unslicer's .checkToken rejects the tokentype, its
+                (typebyte not in (PING, PONG, ABORT, CLOSE, ERROR, LANE))):
+                # PING, PONG, ABORT, CLOSE, ERROR, and LANE are always legal.
+                # All others (including OPEN) can be rejected by the schema:
+                # for example, a list of integers would reject STRING, VOCAB,
+                # and OPEN because none of those will produce integers. If
+                # the unslicer's .checkToken rejects the tokentype, its
                 # .receiveChild will immediately get an Failure
                 try:
                     # the purpose here is to limit the memory consumed by
@@ -819,15 +1167,15 @@ class Banana(protocol.Protocol):
                 # them with extreme prejudice.
                 raise BananaError("oversized ERROR token")
 
-            self.buffer.appendleft(first65[pos+1:])
-
             # determine what kind of token it is. Each clause finishes in
             # one of four ways:
             #
             #  raise BananaError: the protocol was violated so badly there is
             #                     nothing to do for it but hang up abruptly
             #
-            #  return: if the token is not yet complete (need more data)
+            #  return: if the token is not yet complete (need more data).
+            #          The unparsed bytes (including this token's header)
+            #          are saved for next time.
             #
             #  continue: if the token is complete but no object (for
             #            handleToken) was produced, e.g. OPEN, CLOSE, ABORT
@@ -838,6 +1186,7 @@ class Banana(protocol.Protocol):
             # being passed up to the current Unslicer
 
             if typebyte == OPEN:
+                pos = bodyStart
                 self.inboundOpenCount = header
                 if rejected:
                     if self.debugReceive:
@@ -860,6 +1209,7 @@ class Banana(protocol.Protocol):
                 continue
 
             elif typebyte == CLOSE:
+                pos = bodyStart
                 count = header
                 if self.discardCount:
                     self.discardCount -= 1
@@ -871,6 +1221,7 @@ class Banana(protocol.Protocol):
                 continue
 
             elif typebyte == ABORT:
+                pos = bodyStart
                 count = header
                 # TODO: this isn't really a Violation, but we need something
                 # to describe it. It does behave identically to what happens
@@ -897,15 +1248,17 @@ class Banana(protocol.Protocol):
 
             elif typebyte == ERROR:
                 strlen = header
-                if len(self.buffer) >= strlen:
+                if end - bodyStart >= strlen:
                     # the whole string is available
-                    obj = self.buffer.popleft(strlen)
+                    obj = buf[bodyStart:bodyStart+strlen]
+                    self._saveBuffer(buf, end, 0)
                     # handleError must drop the connection
                     self.handleError(obj)
                     return
                 else:
-                    self.buffer.appendleft(first65[:pos+1])
-                    return # there is more to come
+                    # there is more to come
+                    self._saveBuffer(buf, pos, bodyStart - pos + strlen)
+                    return
 
             elif typebyte == LIST:
                 raise BananaError("oldbanana peer detected, " +
@@ -914,9 +1267,10 @@ class Banana(protocol.Protocol):
 
             elif typebyte == STRING:
                 strlen = header
-                if len(self.buffer) >= strlen:
+                if end - bodyStart >= strlen:
                     # the whole string is available
-                    obj = self.buffer.popleft(strlen)
+                    pos = bodyStart + strlen
+                    obj = buf[bodyStart:pos]
                     # although it might be rejected
                 else:
                     # there is more to come
@@ -925,23 +1279,26 @@ class Banana(protocol.Protocol):
                         # dropped
                         if self.debugReceive:
                             print "DROPPED some string bits"
-                        self.skipBytes = strlen - len(self.buffer)
-                        self.buffer.clear()
+                        self.skipBytes = strlen - (end - bodyStart)
+                        self._saveBuffer(buf, end, 0)
                     else:
-                        self.buffer.appendleft(first65[:pos+1])
+                        self._saveBuffer(buf, pos, bodyStart - pos + strlen)
                     return
 
             elif typebyte == INT:
+                pos = bodyStart
                 obj = int(header)
             elif typebyte == NEG:
+                pos = bodyStart
                 # -2**31 is too large for a positive int, so go through
                 # LongType first
                 obj = int(-long(header))
             elif typebyte == LONGINT or typebyte == LONGNEG:
                 strlen = header
-                if len(self.buffer) >= strlen:
+                if end - bodyStart >= strlen:
                     # the whole number is available
-                    obj = bytes_to_long(self.buffer.popleft(strlen))
+                    pos = bodyStart + strlen
+                    obj = bytes_to_long(buf[bodyStart:pos])
                     if typebyte == LONGNEG:
                         obj = -obj
                     # although it might be rejected
@@ -950,34 +1307,43 @@ class Banana(protocol.Protocol):
                     if rejected:
                         # drop all we have and note how much more should be
                         # dropped
-                        self.skipBytes = strlen - len(self.buffer)
-                        self.buffer.clear()
+                        self.skipBytes = strlen - (end - bodyStart)
+                        self._saveBuffer(buf, end, 0)
                     else:
-                        self.buffer.appendleft(first65[:pos+1])
+                        self._saveBuffer(buf, pos, bodyStart - pos + strlen)
                     return
 
             elif typebyte == VOCAB:
+                pos = bodyStart
                 obj = self.incomingVocabulary[header]
                 # TODO: bail if expanded string is too big
                 # this actually means doing self.checkToken(VOCAB, len(obj))
                 # but we have to make sure we handle the rejection properly
 
             elif typebyte == FLOAT:
-                if len(self.buffer) >= 8:
-                    obj = struct.unpack("!d", self.buffer.popleft(8))[0]
+                if end - bodyStart >= 8:
+                    pos = bodyStart + 8
+                    obj = struct.unpack("!d", buf[bodyStart:pos])[0]
                 else:
                     # this case is easier than STRING, because it is only 8
                     # bytes. We don't bother skipping anything.
-                    self.buffer.appendleft(first65[:pos+1])
+                    self._saveBuffer(buf, pos, bodyStart - pos + 8)
                     return
 
             elif typebyte == PING:
+                pos = bodyStart
                 self.sendPONG(header)
                 continue # otherwise ignored
 
             elif typebyte == PONG:
+                pos = bodyStart
                 continue # otherwise ignored
 
+            elif typebyte == LANE:
+                pos = bodyStart
+                self.switchReceiveLane(header)
+                continue
+
             else:
                 raise BananaError("Invalid Type Byte 0x%x" % ord(typebyte))
 
@@ -998,9 +1364,96 @@ class Banana(protocol.Protocol):
 
             # while loop ends here
 
-        # note: this is redundant, as there are no 'break' statements in that
-        # loop, and the loop exit condition is 'while len(self.buffer)'
-        self.buffer.clear()
+        # everything in the buffer was consumed
+        self._saveBuffer(buf, end, 0)
+
+    def switchReceiveLane(self, lane):
+        # the following tokens belong to a different lane. Each lane is a
+        # separate stream of top-level objects, with its own stack of
+        # Unslicers, so we put away everything we know about the one we
+        # were reading, and pick up where we left off in the new one.
+        if lane >= self.maxReceiveLanes:
+            raise BananaError("LANE %d is too large" % lane)
+        if lane == self.receiveLane:
+            return
+        if self.debugReceive:
+            print "switching to lane %d" % lane
+        self.receiveLanes[self.receiveLane] = (self.receiveStack,
+                                               self.inOpen, self.opentype,
+                                               self.discardCount,
+                                               self.inboundOpenCount,
+                                               self.inboundObjectCount)
+        state = self.receiveLanes.pop(lane, None)
+        if state is None:
+            state = ([self.rootUnslicer], False, [], 0, None, None)
+        (self.receiveStack, self.inOpen, self.opentype, self.discardCount,
+         self.inboundOpenCount, self.inboundObjectCount) = state
+        self.receiveLane = lane
+
+    def decodePrimitives(self, buf, pos, end, top):
+        # This is a shortcut through the token loop for Unslicers (like a
+        # ListUnslicer constrained by ListOf(int)) which set
+        # .primitiveTaster. It decodes a run of complete INT, NEG, STRING,
+        # and VOCAB tokens that the taster accepts and appends them
+        # straight to top.list, which is what checkToken and receiveChild
+        # would have done. It stops at the first token that needs anything
+        # else (including a Violation), and returns its offset, so the
+        # regular loop can handle it.
+        taster = top.primitiveTaster
+        items = top.list
+        maxLength = top.maxLength
+        stringLimit = taster.get(STRING)
+        acceptInts = INT in taster
+        acceptStrings = STRING in taster
+        acceptVocab = VOCAB in taster
+        vocab = self.incomingVocabulary
+        match = HEADER_RE.match
+        while pos < end:
+            if maxLength is not None and len(items) >= maxLength:
+                break
+            headerEnd = match(buf, pos).end()
+            if headerEnd == end or headerEnd - pos > 64:
+                break
+            typebyte = buf[headerEnd]
+            if headerEnd == pos + 1:
+                header = ord(buf[pos])
+            elif headerEnd > pos:
+                header = b1282int(buf[pos:headerEnd])
+            else:
+                header = 0
+            if typebyte == INT and acceptInts:
+                items.append(int(header))
+                pos = headerEnd + 1
+            elif typebyte == NEG and acceptInts:
+                items.append(int(-long(header)))
+                pos = headerEnd + 1
+            elif typebyte == STRING and acceptStrings:
+                if stringLimit and header > stringLimit:
+                    break
+                bodyStart = headerEnd + 1
+                if end - bodyStart < header:
+                    break
+                pos = bodyStart + header
+                items.append(buf[bodyStart:pos])
+            elif typebyte == VOCAB and acceptVocab and header in vocab:
+                items.append(vocab[header])
+                pos = headerEnd + 1
+            else:
+                break
+        return pos
+
+    def _saveBuffer(self, buf, pos, wanted):
+        # keep the unparsed bytes buf[pos:] for the next call to handleData.
+        # We won't look at them again until we have at least 'wanted' bytes.
+        if pos < len(buf):
+            if pos:
+                buf = buf[pos:]
+            self.buffer = [buf]
+            self.bufferLength = len(buf)
+        else:
+            self.buffer = []
+            self.bufferLength = 0
+        self.bufferWanted = wanted
 
 
     def handleOpen(self, openCount, objectCount, indexToken):
@@ -1167,7 +1620,7 @@ class Banana(protocol.Protocol):
 
     def handleError(self, msg):
         log.msg("got banana ERROR from remote side: %s" % msg)
-        self.transport.loseConnection()
+        self.dropConnection()
 
 
     def describeReceive(self):
@@ -4,6 +4,7 @@
 
 import types, time
 from itertools import count
+from collections import deque
 
 from zope.interface import implements
 from twisted.python import failure
@@ -14,9 +15,11 @@ from twisted.internet.protocol import connectionDone
 from foolscap import banana, tokens, ipb, vocab
 from foolscap import call, slicer, referenceable, copyable, remoteinterface
 from foolscap.constraint import Any
+from foolscap.schema import ListOf, TupleOf
 from foolscap.tokens import Violation, BananaError
 from foolscap.ipb import DeadReferenceError, IBroker
 from foolscap.slicers.root import RootSlicer, RootUnslicer, ScopedRootSlicer
+from foolscap.slicers.vocab import AddVocabUnslicer
 from foolscap.eventual import eventually
 from foolscap.logging import log
 
@@ -31,6 +34,19 @@ PBTopRegistry = {
     ("call",): call.CallUnslicer,
     ("answer",): call.AnswerUnslicer,
     ("error",): call.ErrorUnslicer,
+    # peers which negotiate banana-decision-version 4 or later may amend our
+    # incoming VOCAB table at any time
+    ("add-vocab",): AddVocabUnslicer,
+    # peers which negotiate banana-decision-version 6 or later may send
+    # several calls, answers, and errors inside a single (batch) sequence
+    ("batch",): call.BatchUnslicer,
+    }
+
+# top-level sequences which are only accepted from peers that negotiated at
+# least this banana-decision-version
+PBTopVersions = {
+    ("add-vocab",): 4,
+    ("batch",): 6,
     }
 
 PBOpenRegistry = {
@@ -87,6 +103,13 @@ class PBRootUnslicer(RootUnslicer):
         return child
 
     def doOpen(self, opentype):
+        minVersion = PBTopVersions.get(opentype)
+        if minVersion is not None:
+            version = self.broker._banana_decision_version
+            if not version >= minVersion:
+                raise Violation("top-level OPEN type %s requires "
+                                "banana-decision-version %d, not %s"
+                                % (opentype, minVersion, version))
         child = RootUnslicer.doOpen(self, opentype)
         if child:
             child.broker = self.broker
@@ -113,6 +136,9 @@ class PBRootSlicer(RootSlicer):
         assert 0
 
 
+# decref_batch messages never carry more than this many (clid, count) pairs
+MAX_DECREF_BATCH = 1000
+
 class RIBroker(remoteinterface.RemoteInterface):
     def getReferenceByName(name=str):
         """If I have published an object by that name, return a reference to
@@ -127,6 +153,13 @@ class RIBroker(remoteinterface.RemoteInterface):
         """Release some reference to a their-reference 'giftID' that was
         sent earlier."""
         return None
+    def decref_batch(decrefs=ListOf(TupleOf(int, int),
+                                    maxLength=MAX_DECREF_BATCH)):
+        """Like decref, but releases references to several my-references
+        at once. Each item of 'decrefs' is a (clid, count) pair. This is
+        only sent to peers which negotiated banana-decision-version 5 or
+        later."""
+        return None
 
 
 class Broker(banana.Banana, referenceable.Referenceable):
@@ -151,6 +184,10 @@ class Broker(banana.Banana, referenceable.Referenceable):
     startingTLS = False
     startedTLS = False
     use_remote_broker = True
+    # when the peer understands decref_batch, released references are
+    # queued and sent together once per turn, or as soon as this many are
+    # waiting
+    decrefBatchSize = 100
 
     def __init__(self, remote_tubref, params={},
                  keepaliveTimeout=None, disconnectTimeout=None):
@@ -185,15 +222,21 @@ class Broker(banana.Banana, referenceable.Referenceable):
         self.myGifts = {} # maps (broker,clid) to (rref, giftID, count)
         self.myGiftsByGiftID = {} # maps giftID to (broker,clid)
 
+        # released RemoteReferences waiting to be sent in a decref_batch
+        self.pendingDecrefs = [] # list of (tracker, count)
+
         # remote calls
         # sending side uses these
         self.nextReqID = count(1).next # 0 means "we don't want a response"
         self.waitingForAnswers = {} # we wait for the other side to answer
         self.disconnectWatchers = []
         # receiving side uses these
-        self.inboundDeliveryQueue = []
+        self.inboundDeliveryQueue = deque()
+        self._next_call_scheduled = False
         self._waiting_for_call_to_be_ready = False
         self.activeLocalCalls = {} # the other side wants an answer from us
+        # answers held back while doNextCall runs, to go out in one batch
+        self._answerBatch = None
 
     def setTub(self, tub):
         assert ipb.ITub.providedBy(tub)
@@ -203,11 +246,22 @@ class Broker(banana.Banana, referenceable.Referenceable):
         if tub.debugBanana:
             self.debugSend = True
             self.debugReceive = True
+        if (tub._adaptive_vocab is not None
+            and self._banana_decision_version >= 4):
+            # the far end will accept add-vocab sequences
+            self.enableVocabLearning(**tub._adaptive_vocab)
 
     def connectionMade(self):
         banana.Banana.connectionMade(self)
         self.rootSlicer.broker = self
         self.rootUnslicer.broker = self
+        if self._banana_decision_version >= 7:
+            # the far end accepts LANE tokens, so answers, small calls and
+            # decrefs can overtake a large object that is being sent. This
+            # only works if we produce a large object as the transport wants
+            # it, rather than all at once.
+            self.enableSendLanes()
+            self.flowControl = True
         if self.use_remote_broker:
             self._create_remote_broker()
 
@@ -240,7 +294,7 @@ class Broker(banana.Banana, referenceable.Referenceable):
             self.disconnectWatchers = []
         self.finish(why)
         # loseConnection eventually provokes connectionLost()
-        self.transport.loseConnection()
+        self.dropConnection()
 
     def connectionLost(self, why):
         tubid = "?"
@@ -359,6 +413,14 @@ class Broker(banana.Banana, referenceable.Referenceable):
         if not self.remote_broker: # tests do not set this up
             self.freeYourReferenceTracker(None, tracker)
             return
+        if self._banana_decision_version >= 5:
+            # the far end accepts decref_batch, so coalesce these
+            self.pendingDecrefs.append((tracker, count))
+            if len(self.pendingDecrefs) == 1:
+                eventually(self.flushDecrefs)
+            elif len(self.pendingDecrefs) >= self.decrefBatchSize:
+                self.flushDecrefs()
+            return
         try:
             rb = self.remote_broker
             # TODO: do we want callRemoteOnly here? is there a way we can
@@ -380,13 +442,11 @@ class Broker(banana.Banana, referenceable.Referenceable):
             # self.freeYourReferenceTracker('bogus', tracker)
             # return
 
-            d = rb.callRemote("decref", clid=tracker.clid, count=count)
+            d = rb.callRemote("decref", clid=tracker.clid, count=count,
+                              _priority=ipb.PRIORITY_HIGH)
             # if the connection was lost before we can get an ack, we're
             # tearing this down anyway
-            def _ignore_loss(f):
-                f.trap(DeadReferenceError, *LOST_CONNECTION_ERRORS)
-                return None
-            d.addErrback(_ignore_loss)
+            d.addErrback(self._ignoreDecrefLoss)
             # once the ack comes back, or if we know we'll never get one,
             # release the tracker
             d.addCallback(self.freeYourReferenceTracker, tracker)
@@ -395,6 +455,36 @@ class Broker(banana.Banana, referenceable.Referenceable):
             log.msg("failure during freeRemoteReference", facility="foolscap",
                     level=log.UNUSUAL, failure=f)
 
+    def _ignoreDecrefLoss(self, f):
+        f.trap(DeadReferenceError, *LOST_CONNECTION_ERRORS)
+        return None
+
+    def flushDecrefs(self):
+        # send everything in pendingDecrefs as a single decref_batch. Each
+        # tracker is released when the ack arrives, exactly as if it had
+        # been sent in its own decref message.
+        pending, self.pendingDecrefs = self.pendingDecrefs, []
+        if not pending:
+            return
+        if not self.remote_broker:
+            # the connection has been lost, so nobody is listening
+            for (tracker, n) in pending:
+                self.freeYourReferenceTracker(None, tracker)
+            return
+        try:
+            decrefs = [(tracker.clid, n) for (tracker, n) in pending]
+            d = self.remote_broker.callRemote("decref_batch", decrefs=decrefs,
+                                              _priority=ipb.PRIORITY_HIGH)
+            d.addErrback(self._ignoreDecrefLoss)
+            def _release(res):
+                for (tracker, n) in pending:
+                    self.freeYourReferenceTracker(res, tracker)
+            d.addCallback(_release)
+        except:
+            f = failure.Failure()
+            log.msg("failure during flushDecrefs", facility="foolscap",
+                    level=log.UNUSUAL, failure=f)
+
     def freeYourReferenceTracker(self, res, tracker):
         if tracker.received_count != 0:
             return
@@ -434,6 +524,11 @@ class Broker(banana.Banana, referenceable.Referenceable):
             del self.myReferenceByPUID[tracker.puid]
             del self.myReferenceByCLID[clid]
 
+    def remote_decref_batch(self, decrefs):
+        # invoked when the other side releases several references at once
+        for (clid, n) in decrefs:
+            self.remote_decref(clid, n)
+
     # methods to send RemoteReference 'gifts' to third-parties
 
     def makeGift(self, rref):
@@ -523,24 +618,96 @@ class Broker(banana.Banana, referenceable.Referenceable):
 
     def scheduleCall(self, delivery, ready_deferred):
         self.inboundDeliveryQueue.append( (delivery,ready_deferred) )
-        eventually(self.doNextCall)
+        self._scheduleNextCall()
+
+    def _scheduleNextCall(self):
+        # one eventual-send drains everything that arrived in this turn
+        if not self._next_call_scheduled:
+            self._next_call_scheduled = True
+            eventually(self.doNextCall)
 
     def doNextCall(self):
-        if self.disconnected:
-            return
-        if self._waiting_for_call_to_be_ready:
-            return
-        if not self.inboundDeliveryQueue:
-            return
-        delivery, ready_deferred = self.inboundDeliveryQueue.pop(0)
+        self._next_call_scheduled = False
+        # deliver every call that is ready to run, in the order they
+        # arrived. A call which is still waiting for its arguments (a
+        # ready_deferred, for gifts that are being fetched) holds up all
+        # the calls behind it until it fires.
+        queue = self.inboundDeliveryQueue
+        if self._banana_decision_version >= 6:
+            # the far end accepts (batch) sequences, so the answers to all
+            # the calls we deliver in this turn can share one
+            self._answerBatch = []
+        try:
+            while queue:
+                if self.disconnected or self._waiting_for_call_to_be_ready:
+                    return
+                delivery, ready_deferred = queue.popleft()
+                if ready_deferred:
+                    self._waitForCall(delivery, ready_deferred)
+                else:
+                    self._deliverCall(delivery)
+        finally:
+            if self._answerBatch is not None:
+                self._flushAnswers()
+                self._answerBatch = None
+
+    def send(self, obj, lane=0):
+        # nothing we send may overtake an answer that we are holding back
+        if self._answerBatch:
+            self._flushAnswers()
+        return banana.Banana.send(self, obj, lane)
+
+    def _sendAnswer(self, answer, lane=0):
+        if self._answerBatch is not None:
+            self._answerBatch.append((answer, lane))
+        else:
+            self.send(answer, lane)
+
+    def _flushAnswers(self):
+        answers = self._answerBatch
+        self._answerBatch = []
+        # answers go back on the lane their call arrived on, so calls that
+        # arrived on different lanes get separate batches
+        lanes = {}
+        for (answer, lane) in answers:
+            lanes.setdefault(lane, []).append(answer)
+        laneNumbers = lanes.keys()
+        laneNumbers.sort()
+        for lane in laneNumbers:
+            answers = lanes[lane]
+            if len(answers) == 1:
+                obj = answers[0]
+            else:
+                children = []
+                for answer in answers:
+                    def _notSent(f, answer=answer):
+                        self._answerNotSent(f, answer)
+                    children.append((answer, _notSent))
+                obj = call.BatchSlicer(children)
+            # like _callFinished, we can only log a failure to send
+            try:
+                d = banana.Banana.send(self, obj, lane)
+                if len(answers) == 1:
+                    d.addErrback(self._answerNotSent, obj)
+            except:
+                f = failure.Failure()
+                log.msg("Broker._flushAnswers unable to send",
+                        facility="foolscap", level=log.UNUSUAL, failure=f)
+
+    def _answerNotSent(self, f, answer):
+        # an answer which could not be serialized was ABORTed after its
+        # reqID was sent, so the far end has already failed that request.
+        # All that is left to do is log it.
+        log.msg("Broker._flushAnswers unable to serialize %s"
+                % answer.describe(),
+                facility="foolscap", level=log.UNUSUAL, failure=f)
+
+    def _waitForCall(self, delivery, d):
         self._waiting_for_call_to_be_ready = True
-        if not ready_deferred:
-            ready_deferred = defer.succeed(None)
-        d = ready_deferred
 
         def _ready(res):
             self._waiting_for_call_to_be_ready = False
-            eventually(self.doNextCall)
+            self._scheduleNextCall()
             return res
         d.addBoth(_ready)
 
@@ -555,7 +722,33 @@ class Broker(banana.Banana, referenceable.Referenceable):
         d.addCallback(self._callFinished, delivery)
         d.addErrback(self.callFailed, delivery.reqID, delivery)
         d.addErrback(log.err)
-        return None
+
+    def _deliverCall(self, delivery):
+        # this is the same as _waitForCall's chain, but without building a
+        # Deferred unless the method returns one
+        try:
+            res = self._doCall(delivery)
+        except:
+            self._deliveryFailed(failure.Failure(), delivery)
+            return
+        if isinstance(res, defer.Deferred):
+            res.addCallback(self._callFinished, delivery)
+            res.addErrback(self.callFailed, delivery.reqID, delivery)
+            res.addErrback(log.err)
+            return
+        if isinstance(res, failure.Failure):
+            self._deliveryFailed(res, delivery)
+            return
+        try:
+            self._callFinished(res, delivery)
+        except:
+            self._deliveryFailed(failure.Failure(), delivery)
+
+    def _deliveryFailed(self, f, delivery):
+        try:
+            self.callFailed(f, delivery.reqID, delivery)
+        except:
+            log.err(failure.Failure())
 
     def _doCall(self, delivery):
         # our ordering rules require that the order in which each
@@ -570,10 +763,10 @@ class Broker(banana.Banana, referenceable.Referenceable):
             assert not isinstance(i, defer.Deferred)
 
         if delivery.methodSchema:
-            # we asked about each argument on the way in, but ask again so
-            # they can look for missing arguments. TODO: see if we can remove
-            # the redundant per-argument checks.
-            delivery.methodSchema.checkAllArgs(args, kwargs, True)
+            # most arguments were checked as they arrived, so this is mostly
+            # a check for missing ones
+            delivery.methodSchema.checkAllArgs(args, kwargs, True,
+                                               delivery.allargs.validated)
 
         # interesting case: if the method completes successfully, but
         # our schema prohibits us from sending the result (perhaps the
@@ -594,7 +787,7 @@ class Broker(banana.Banana, referenceable.Referenceable):
         if reqID == 0:
             return
         methodSchema = delivery.methodSchema
-        assert self.activeLocalCalls[reqID]
+        lane = self.activeLocalCalls[reqID].lane
         if methodSchema:
             try:
                 methodSchema.checkResults(res, False) # may raise Violation
@@ -607,7 +800,7 @@ class Broker(banana.Banana, referenceable.Referenceable):
         # once the answer has started transmitting, any exceptions must be
         # logged and dropped, and not turned into an Error to be sent.
         try:
-            self.send(answer)
+            self._sendAnswer(answer, lane)
             # TODO: .send should return a Deferred that fires when the last
             # byte has been queued, and we should delete the local note then
         except:
@@ -627,8 +820,8 @@ class Broker(banana.Banana, referenceable.Referenceable):
                 # the 'not self.tub' case is for unit tests
                 delivery.logFailure(f)
         if reqID != 0:
-            assert self.activeLocalCalls[reqID]
-            self.send(call.ErrorSlicer(reqID, f))
+            lane = self.activeLocalCalls[reqID].lane
+            self._sendAnswer(call.ErrorSlicer(reqID, f), lane)
             del self.activeLocalCalls[reqID]
 
 class StorageBrokerRootSlicer(ScopedRootSlicer):
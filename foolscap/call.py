@@ -237,6 +237,20 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
         self._all_children_are_referenceable_d = None
         self._ready_deferreds = []
         self.closed = False
+        # positions and names of the arguments that have been checked
+        # against their constraints, so the Broker doesn't check them again
+        self.validated = set()
+
+    def checkArgument(self, argvalue, ready_deferred, which):
+        # the tokens of each argument were checked as they arrived, but some
+        # constraints (regexps, integer ranges, shared references) can only
+        # be checked against the finished object. Arguments which are not
+        # ready yet are left for the Broker to check.
+        if (self.argConstraint is None or ready_deferred
+            or isinstance(argvalue, defer.Deferred)):
+            return
+        self.argConstraint.checkObject(argvalue, True)
+        self.validated.add(which)
 
     def checkToken(self, typebyte, size):
         if self.numargs is None:
@@ -291,6 +305,7 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
             # this token is a positional argument
             argvalue = token
             argpos = len(self.args)
+            self.checkArgument(argvalue, ready_deferred, argpos)
             self.args.append(argvalue)
             if isinstance(argvalue, defer.Deferred):
                 # this may occur if the child is a gift which has not
@@ -327,6 +342,7 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
 
         # this token is the value of a keyword argument
         argvalue = token
+        self.checkArgument(argvalue, ready_deferred, self.argname)
         self.kwargs[self.argname] = argvalue
         if isinstance(argvalue, defer.Deferred):
             self.num_unreferenceable_children += 1
@@ -411,6 +427,8 @@ class CallUnslicer(slicer.ScopedUnslicer):
         self.methodname = None
         self.methodSchema = None # will be a MethodArgumentsConstraint
         self._ready_deferreds = []
+        # the answer goes back on the lane that the call arrived on
+        self.lane = self.protocol.receiveLane
 
     def checkToken(self, typebyte, size):
         # TODO: limit strings by returning a number instead of None
@@ -759,6 +777,74 @@ class ErrorUnslicer(slicer.ScopedUnslicer):
         return "<error-%s>" % self.request.reqID
 
 
+class BatchSlicer(slicer.BaseSlicer):
+    """I send several top-level call/answer/error sequences inside a single
+    (batch) sequence. Each child is a (slicer, onFailure) pair: if that
+    child cannot be serialized, onFailure (if not None) is called with the
+    Failure, and the rest of the batch is sent anyway."""
+    opentype = ('batch',)
+
+    def __init__(self, children):
+        slicer.BaseSlicer.__init__(self, None)
+        self.children = children
+        self.onFailure = None
+
+    def sliceBody(self, streamable, banana):
+        for (child, onFailure) in self.children:
+            self.onFailure = onFailure
+            yield child
+        self.onFailure = None
+
+    def childAborted(self, f):
+        # the child has already sent its ABORT, so the far end will discard
+        # it. Tell whoever was waiting for it, then go on to the next one.
+        if self.onFailure:
+            self.onFailure(f)
+        return None
+
+    def describe(self):
+        return "<batch>"
+
+class BatchUnslicer(slicer.BaseUnslicer):
+    """I receive a (batch) sequence, which holds the same call/answer/error
+    sequences that could otherwise appear at the top level. Each is handled
+    as soon as it is closed, just as if it had arrived on its own, and a
+    failure in one of them does not affect the others."""
+
+    openers = {
+        ("call",): CallUnslicer,
+        ("answer",): AnswerUnslicer,
+        ("error",): ErrorUnslicer,
+        }
+
+    def checkToken(self, typebyte, size):
+        if typebyte != tokens.OPEN:
+            raise BananaError("batch members must be OPEN")
+
+    def doOpen(self, opentype):
+        opener = self.openers.get(opentype)
+        if opener is None:
+            raise Violation("unknown batch member type %s" % (opentype,))
+        child = opener()
+        child.broker = self.broker
+        return child
+
+    def receiveChild(self, token, ready_deferred=None):
+        if isinstance(token, InboundDelivery):
+            self.broker.scheduleCall(token, ready_deferred)
+
+    def reportViolation(self, f):
+        # the member has already failed its own request (or sent back an
+        # error for its call), so keep reading the rest of the batch
+        return None
+
+    def receiveClose(self):
+        return None, None
+
+    def describe(self):
+        return "<batch>"
+
+
 def truncate(s, limit):
     assert limit > 3
     if s and len(s) > limit:
@@ -42,13 +42,18 @@ class IRemoteMethodConstraint(IConstraint):
         used to handle mixed positional and keyword arguments. Returns a
         tuple of (accept, constraint)."""
 
-    def checkAllArgs(args, kwargs, inbound):
+    def checkAllArgs(args, kwargs, inbound, validated=()):
         """Submit all argument values for checking. When inbound=True, this
         is called after the arguments have been deserialized, but before the
         method is invoked. When inbound=False, this is called just inside
         callRemote(), as soon as the target object (and hence the remote
         method constraint) is located.
 
+        'validated' holds the positions (for positional arguments) and names
+        (for keyword arguments) of the values which were already checked
+        against their constraint as they arrived, which need not be checked
+        again.
+
         This should either raise Violation or return None."""
         pass
     def getResponseConstraint():
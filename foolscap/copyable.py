@@ -97,6 +97,7 @@ def registerCopier(klass, copier):
         def getStateToCopy(self):
             return self.state
     registerAdapter(_CopierAdapter, klass, ICopyable)
+    slicer.invalidateSlicerCache()
 
 ############################################################
 # beyond here is the receiving/deserialization side
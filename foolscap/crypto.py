@@ -41,9 +41,40 @@ from foolscap import base32
 
 peerFromTransport = Certificate.peerFromTransport
 
+# older versions of CertificateOptions always disable session tickets
+import inspect
+_sessionTicketsAvailable = ("enableSessionTickets" in
+                            inspect.getargspec(CertificateOptions.__init__)[0])
+
 class MyOptions(CertificateOptions):
+    # a Tub keeps one of these for each side of the connection (see
+    # Tub.getTLSOptions), so the SSL.Context is built once, and its session
+    # cache and session-ticket keys are shared by every connection.
+
+    # the session-id context must be set for the server to resume sessions
+    # with clients that gave us a certificate
+    sessionContext = "foolscap"
+    # client side: handed over by ResumingOptions.getContext, for the
+    # SSL.Connection that Twisted creates right after calling it
+    _nextSession = None
+
+    def __init__(self, *args, **kwargs):
+        if _sessionTicketsAvailable:
+            kwargs.setdefault("enableSessionTickets", True)
+        CertificateOptions.__init__(self, *args, **kwargs)
+
+    def _handshakeStarting(self, conn, where, ret):
+        if where & SSL.SSL_CB_HANDSHAKE_START and self._nextSession:
+            session = self._nextSession
+            self._nextSession = None
+            conn.set_session(session)
+
     def _makeContext(self):
         ctx = CertificateOptions._makeContext(self)
+        ctx.set_session_id(self.sessionContext)
+        if hasattr(ctx, "set_session_cache_mode"):
+            ctx.set_session_cache_mode(SSL.SESS_CACHE_BOTH)
+        ctx.set_info_callback(self._handshakeStarting)
         def alwaysValidate(conn, cert, errno, depth, preverify_ok):
             # This function is called to validate the certificate received by
             # the other end. OpenSSL calls it multiple times, each time it
@@ -88,6 +119,66 @@ class MyOptions(CertificateOptions):
                        alwaysValidate)
         return ctx
 
+class ResumingOptions:
+    """I am the context factory for a single client connection. I use the
+    shared SSL.Context of a MyOptions, and attach 'session' (from
+    SSL.Connection.get_session) to the SSL.Connection that is made for this
+    connection, so its handshake offers to resume that session."""
+
+    def __init__(self, options, session):
+        self.options = options
+        self.session = session
+
+    def getContext(self):
+        # older versions of Twisted create the SSL.Connection themselves,
+        # right after calling getContext(), and start the handshake before
+        # startTLS() returns. The context's info callback attaches the
+        # session to that connection when its handshake starts.
+        self.options._nextSession = self.session
+        return self.options.getContext()
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        # newer versions let us create the SSL.Connection ourselves
+        conn = SSL.Connection(self.options.getContext(), None)
+        conn.set_app_data(tlsProtocol)
+        if self.session:
+            conn.set_session(self.session)
+        return conn
+
+try:
+    from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+except ImportError:
+    pass
+else:
+    from zope.interface import classImplements
+    classImplements(ResumingOptions, IOpenSSLClientConnectionCreator)
+
+def _findSessionReused():
+    # pyOpenSSL has no public way to ask whether a handshake resumed a
+    # session, although later versions might grow one. Otherwise we ask
+    # OpenSSL through pyOpenSSL's private cffi binding, if it looks the way
+    # we expect: anything else just means we cannot tell.
+    if hasattr(SSL.Connection, "session_reused"):
+        return lambda conn: bool(conn.session_reused())
+    try:
+        from OpenSSL._util import lib
+        SSL_session_reused = lib.SSL_session_reused
+    except Exception:
+        return None
+    return lambda conn: bool(SSL_session_reused(conn._ssl))
+_sessionReused = _findSessionReused()
+
+def sessionWasReused(conn):
+    """Return True if the handshake on the given SSL.Connection resumed an
+    earlier session, False if it was a full handshake, or None if this
+    version of pyOpenSSL cannot tell us."""
+    if _sessionReused is None:
+        return None
+    try:
+        return _sessionReused(conn)
+    except Exception:
+        return None
+
 def digest32(colondigest):
     digest = "".join([chr(int(c,16)) for c in colondigest.split(":")])
     digest = base32.encode(digest)
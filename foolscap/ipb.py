@@ -26,6 +26,11 @@ class DeadReferenceError(Exception):
         return " ".join([str(a) for a in args])
 
 
+# values for callRemote's _priority= argument
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
 class IReferenceable(Interface):
     """This object is remotely referenceable. This means it is represented to
     remote systems as an opaque identifier, and that round-trips preserve
@@ -109,6 +114,41 @@ class IRemoteReference(Interface):
 
          the return value is not accepted by the schema I believe is in use
          by the far end (Violation)
+
+        If the far end understands it (foolscap 0.6.5 or later), the
+        _priority= argument lets a call and its answer travel in a separate
+        lane from other traffic on the same connection: PRIORITY_HIGH for
+        small, urgent calls, PRIORITY_LOW for bulk transfers, and
+        PRIORITY_NORMAL (the default) for everything else. Lanes share the
+        connection by weight, so a large or streaming argument or answer in
+        one lane does not hold up the others. Calls are only delivered in
+        order with other calls of the same priority.
+        """
+
+    def getMethod(name):
+        """Return a callable which invokes the named remote method: calling
+        rref.getMethod('foo')(*args, **kwargs) is the same as calling
+        rref.callRemote('foo', *args, **kwargs). The method's schema is
+        looked up just once, so this is faster for a method that will be
+        called many times. If the RemoteInterface has no such method, this
+        raises Violation immediately. Once the connection is lost, calling
+        the method fails with DeadReferenceError.
+
+        The callable accepts callRemote's _priority= argument, and
+        _callOnly=True makes it behave like callRemoteOnly (returning None).
+        Since the schema is fixed, _useSchema=, _resultConstraint=, and
+        _methodConstraint= are rejected with TypeError.
+        """
+
+    def callRemoteMany(calls):
+        """Invoke several methods on the remote object. 'calls' is a
+        sequence of (name, args, kwargs) tuples. I return a list of
+        Deferreds, one per call, and each one fires just like the one that
+        callRemote(name, *args, **kwargs) would have returned. The calls are
+        delivered in the order given. If the far end understands it, they
+        are sent together in a single message, and their answers come back
+        the same way. A call that fails (locally or remotely) only affects
+        its own Deferred.
         """
 
     def callRemoteOnly(name, *args, **kwargs):
@@ -11,10 +11,11 @@ from foolscap.logging.gatherer import \
 from foolscap.logging.dumper import DumpOptions, LogDumper
 from foolscap.logging.web import WebViewerOptions, WebViewer
 from foolscap.logging.filter import FilterOptions, Filter
+from foolscap.logging.merge import MergeOptions, Merge
 from foolscap.logging.incident import ClassifyOptions, IncidentClassifier
 
 class Options(usage.Options):
-    synopsis = "Usage: flogtool (tail|create-gatherer|dump|filter|web-viewer)"
+    synopsis = "Usage: flogtool (tail|create-gatherer|dump|filter|merge|web-viewer)"
 
     subCommands = [
         ("tail", None, TailOptions, "follow logs of the target node"),
@@ -26,6 +27,8 @@ class Options(usage.Options):
          "dump the logs recorded by 'logtool gather'"),
         ("filter", None, FilterOptions,
          "produce a new file with a subset of the events from another file"),
+        ("merge", None, MergeOptions,
+         "merge (and filter) several files into one, sorted by time"),
         ("web-viewer", None, WebViewerOptions,
          "view the logs through a web page"),
         ("classify-incident", None, ClassifyOptions,
@@ -66,6 +69,10 @@ def dispatch(command, options):
         f = Filter()
         return f.run(options)
 
+    elif command == "merge":
+        m = Merge()
+        return m.run(options)
+
     elif command == "web-viewer":
         wv = WebViewer()
         return wv.run(options)
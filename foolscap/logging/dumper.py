@@ -1,7 +1,8 @@
 
-import sys, pickle, errno
+import sys, errno
 from twisted.python import usage
 from foolscap.logging.log import format_message
+from foolscap.logging import flogfile
 from foolscap.util import format_time, FORMAT_TIME_MODES
 
 class DumpOptions(usage.Options):
@@ -115,19 +116,8 @@ class LogDumper:
                 print >>self.options.stdout, " %s" % (line,)
 
     def open_dumpfile(self):
-        fn = self.options.dumpfile
-        if fn.endswith(".bz2"):
-            import bz2
-            f = bz2.BZ2File(fn, "r")
-        else:
-            f = open(fn, "rb")
-        return f
+        return flogfile.open_flogfile(self.options.dumpfile)
 
     def get_events(self, f):
-        while True:
-            try:
-                e = pickle.load(f)
-                yield e
-            except EOFError:
-                break
+        return flogfile.get_events(f)
 
@@ -1,7 +1,7 @@
 
 from twisted.python import usage
-import sys, os, pickle, bz2, time
-from foolscap.logging import log
+import sys, os, bz2, time
+from foolscap.logging import log, flogfile
 
 class FilterOptions(usage.Options):
     stdout = sys.stdout
@@ -48,6 +48,58 @@ class FilterOptions(usage.Options):
             self['above'] = levelmap[arg]
 
 
+class EventFilter:
+    """The event predicates that 'flogtool filter' and 'flogtool merge'
+    apply: --after/--before (exclusive), --above, --from (a tubid prefix),
+    and --strip-facility (a facility prefix). Headers always pass."""
+
+    def __init__(self, after=None, before=None, above=None,
+                 from_tubid=None, strip_facility=None):
+        self.after = after
+        self.before = before
+        self.above = above
+        self.from_tubid = from_tubid
+        self.strip_facility = strip_facility
+
+    def from_options(cls, options):
+        return cls(options['after'], options['before'], options['above'],
+                   options['from'], options['strip-facility'])
+    from_options = classmethod(from_options)
+
+    def wants(self, e):
+        if "d" not in e:
+            return True
+        if self.before is not None and e['d']['time'] >= self.before:
+            return False
+        if self.after is not None and e['d']['time'] <= self.after:
+            return False
+        if self.above is not None and e['d']['level'] < self.above:
+            return False
+        if (self.from_tubid is not None
+            and not e['from'].startswith(self.from_tubid)):
+            return False
+        if (self.strip_facility is not None
+            and e['d'].get('facility', "").startswith(self.strip_facility)):
+            return False
+        return True
+
+def describe_filter(options, stdout):
+    after = options['after']
+    if after is not None:
+        print >>stdout, " --after: removing events before %s" % time.ctime(after)
+    before = options['before']
+    if before is not None:
+        print >>stdout, " --before: removing events after %s" % time.ctime(before)
+    above = options['above']
+    if above:
+        print >>stdout, " --above: removing events below level %d" % above
+    from_tubid = options['from']
+    if from_tubid:
+        print >>stdout, " --from: retaining events only from tubid prefix %s" % from_tubid
+    strip_facility = options['strip-facility']
+    if strip_facility is not None:
+        print >>stdout, "--strip-facility: removing events for %s and children" % strip_facility
+
 class Filter:
 
     def run(self, options):
@@ -60,64 +112,43 @@ class Filter:
             newfile = bz2.BZ2File(newfilename, "w")
         else:
             newfile = open(newfilename, "wb")
+        newindex = open(flogfile.index_filename(newfilename), "wb")
+        writer = flogfile.FlogWriter(newfile, newindex)
+        describe_filter(options, stdout)
+        event_filter = EventFilter.from_options(options)
         after = options['after']
-        if after is not None:
-            print >>stdout, " --after: removing events before %s" % time.ctime(after)
         before = options['before']
-        if before is not None:
-            print >>stdout, " --before: removing events after %s" % time.ctime(before)
-        above = options['above']
-        if above:
-            print >>stdout, " --above: removing events below level %d" % above
-        from_tubid = options['from']
-        if from_tubid:
-            print >>stdout, " --from: retaining events only from tubid prefix %s" % from_tubid
-        strip_facility = options['strip-facility']
-        if strip_facility is not None:
-            print >>stdout, "--strip-facility: removing events for %s and children" % strip_facility
         total = 0
         copied = 0
-        for e in self.get_events(options.oldfile):
+        # --after and --before let indexed files skip whole blocks
+        reader = flogfile.FlogReader(options.oldfile)
+        for e in reader.get_events(after=after, before=before):
             if options['verbose']:
                 if "d" in e:
                     print >>stdout, e['d']['num']
                 else:
                     print >>stdout, "HEADER"
             total += 1
-            if "d" in e:
-                if before is not None and e['d']['time'] >= before:
-                    continue
-                if after is not None and e['d']['time'] <= after:
-                    continue
-                if above is not None and e['d']['level'] < above:
-                    continue
-                if from_tubid is not None and not e['from'].startswith(from_tubid):
-                    continue
-                if (strip_facility is not None
-                    and e['d'].get('facility', "").startswith(strip_facility)):
-                    continue
+            if not event_filter.wants(e):
+                continue
             copied += 1
-            pickle.dump(e, newfile, 2)
-        newfile.close()
+            writer.add(e)
+        writer.close()
+        if reader.is_container:
+            # count the events we never had to read
+            total = reader.count_events()
+        reader.close()
         if options.newfile == options.oldfile:
-            if sys.platform == "win32":
-                # Win32 can't do an atomic rename to an existing file.
-                try:
-                    os.unlink(options.newfile)
-                except OSError:
-                    pass
-            os.rename(newfilename, options.newfile)
+            self.replace(newfilename, options.newfile)
+            self.replace(flogfile.index_filename(newfilename),
+                         flogfile.index_filename(options.newfile))
         print >>stdout, "copied %d of %d events into new file" % (copied, total)
 
-    def get_events(self, fn):
-        if fn.endswith(".bz2"):
-            import bz2
-            f = bz2.BZ2File(fn, "r")
-        else:
-            f = open(fn, "rb")
-        while True:
+    def replace(self, fromfile, tofile):
+        if sys.platform == "win32":
+            # Win32 can't do an atomic rename to an existing file.
             try:
-                e = pickle.load(f)
-                yield e
-            except EOFError:
-                break
+                os.unlink(tofile)
+            except OSError:
+                pass
+        os.rename(fromfile, tofile)
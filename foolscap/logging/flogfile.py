@@ -0,0 +1,616 @@
+
+"""Reading and writing .flog event files.
+
+A legacy .flog file is nothing but a sequence of pickled event wrappers
+(the first of which is usually a header), so the only way to find anything
+is to unpickle everything in front of it. The indexed container format
+looks like this:
+
+ MAGIC
+ block*
+
+Each block is BLOCK_HEADER (a mark, the length of the block index, and the
+length of the event data), then the pickled block index, which holds one
+(offset, num, time, level, facility, from) tuple per event, then the
+pickled events themselves. Writers also append one INDEX_RECORD per block
+to a sidecar file (FOO.flog.idx, for both FOO.flog and FOO.flog.bz2), so a
+reader that wants a time range or an event number can go straight to the
+blocks that hold it. The sidecar is only a cache: anything it is missing is
+rebuilt from the block headers, and a block that was cut short (because the
+writer crashed) marks the end of the file.
+
+All offsets are in the uncompressed stream, so they work for .bz2 files
+too, although seeking in those still means decompressing. Writers can also
+compress each block on its own (ZLIB_BLOCK_MARK, with the index and the
+event data zlib-compressed separately): such a file is compressed while it
+is being written, stays readable after a crash, and can still be seeked.
+"""
+
+import os, struct, pickle, bz2, zlib, threading, Queue
+
+MAGIC = "foolscap-flog-container-v1\n"
+BLOCK_MARK = "FBLK"
+ZLIB_BLOCK_MARK = "FBLZ"
+BLOCK_HEADER = ">4sII"
+BLOCK_HEADER_SIZE = struct.calcsize(BLOCK_HEADER)
+INDEX_MAGIC = "foolscap-flog-index-v1\n"
+# offset, length, count, flags, min_time, max_time, min_num, max_num,
+# max_level
+INDEX_RECORD = ">QIIBddqqi"
+INDEX_RECORD_SIZE = struct.calcsize(INDEX_RECORD)
+
+# BlockInfo.flags
+HAS_HEADER = 1 # the block holds at least one header
+HAS_EVENTS = 2 # the block holds at least one event, so the ranges are valid
+
+def index_filename(fn):
+    """Return the name of the sidecar index for the given .flog file."""
+    if fn.endswith(".bz2"):
+        fn = fn[:-len(".bz2")]
+    return fn + ".idx"
+
+def open_flogfile(fn, mode="rb"):
+    if fn.endswith(".bz2"):
+        return bz2.BZ2File(fn, mode)
+    return open(fn, mode)
+
+def summarize_event(e):
+    """Return the (num, time, level, facility, from) that a block index
+    records for the given event (all None for a header)."""
+    if "d" not in e:
+        return (None, None, None, None, None)
+    d = e["d"]
+    return (d.get("num"), d.get("time"), d.get("level"),
+            d.get("facility"), e.get("from"))
+
+class BlockInfo:
+    """Where one block lives, and a summary of what is in it."""
+
+    def __init__(self, offset, length, count, flags=0,
+                 min_time=0.0, max_time=0.0, min_num=-1, max_num=-1,
+                 max_level=0):
+        self.offset = offset
+        self.length = length
+        self.count = count
+        self.flags = flags
+        self.min_time = min_time
+        self.max_time = max_time
+        self.min_num = min_num
+        self.max_num = max_num
+        self.max_level = max_level
+
+    def summarize(self, entries):
+        times = [t for (o,num,t,level,fac,tubid) in entries if t is not None]
+        nums = [num for (o,num,t,level,fac,tubid) in entries
+                if num is not None]
+        levels = [level for (o,num,t,level,fac,tubid) in entries
+                  if level is not None]
+        self.flags = 0
+        if len(times) < len(entries):
+            self.flags |= HAS_HEADER
+        if times:
+            self.flags |= HAS_EVENTS
+            self.min_time, self.max_time = min(times), max(times)
+        if nums:
+            self.min_num, self.max_num = min(nums), max(nums)
+        if levels:
+            self.max_level = max(levels)
+
+    def pack(self):
+        return struct.pack(INDEX_RECORD, self.offset, self.length,
+                           self.count, self.flags,
+                           self.min_time, self.max_time,
+                           self.min_num, self.max_num, self.max_level)
+
+    def unpack(cls, data):
+        return cls(*struct.unpack(INDEX_RECORD, data))
+    unpack = classmethod(unpack)
+
+    def might_match(self, selector):
+        if self.flags & HAS_HEADER:
+            return True # headers are always wanted
+        if not self.flags & HAS_EVENTS:
+            return False
+        return selector.might_match_block(self)
+
+
+class EventSelector:
+    """Which events a reader wants. Headers are always selected. Times are
+    exclusive (like 'flogtool filter --after/--before'), event numbers are
+    inclusive, and 'above' is the lowest interesting level."""
+
+    def __init__(self, after=None, before=None, first_num=None,
+                 last_num=None, above=None):
+        self.after = after
+        self.before = before
+        self.first_num = first_num
+        self.last_num = last_num
+        self.above = above
+
+    def selects_everything(self):
+        return (self.after is None and self.before is None
+                and self.first_num is None and self.last_num is None
+                and self.above is None)
+
+    def might_match_block(self, b):
+        if self.after is not None and b.max_time <= self.after:
+            return False
+        if self.before is not None and b.min_time >= self.before:
+            return False
+        if b.min_num != -1:
+            if self.first_num is not None and b.max_num < self.first_num:
+                return False
+            if self.last_num is not None and b.min_num > self.last_num:
+                return False
+        if self.above is not None and b.max_level < self.above:
+            return False
+        return True
+
+    def matches(self, num, when, level):
+        if when is None:
+            return True # header
+        if self.after is not None and when <= self.after:
+            return False
+        if self.before is not None and when >= self.before:
+            return False
+        if num is not None:
+            if self.first_num is not None and num < self.first_num:
+                return False
+            if self.last_num is not None and num > self.last_num:
+                return False
+        if self.above is not None and level < self.above:
+            return False
+        return True
+
+    def matches_event(self, e):
+        if "d" not in e:
+            return True
+        d = e["d"]
+        return self.matches(d.get("num"), d.get("time"), d.get("level"))
+
+
+class FlogWriter:
+    """I write events into an indexed container, one block at a time.
+
+    Events are held in memory until BLOCKSIZE bytes of them have
+    accumulated, which closes the block, and closed blocks are written out
+    right away. If 'buffersize' is set, nothing is written until there are
+    at least that many bytes to write (closing the current block early if
+    necessary), so several blocks can share a single write(). flush() and
+    close() write out everything, including the partial block: a crash
+    loses whatever has not been written yet.
+
+    If 'compress' is true, each block is zlib-compressed on its own."""
+
+    BLOCKSIZE = 64*1024
+
+    def __init__(self, f, index_f=None, blocksize=None, buffersize=None,
+                 compress=False):
+        self.f = f
+        self.index_f = index_f
+        self.blocksize = blocksize or self.BLOCKSIZE
+        self.buffersize = buffersize
+        self.compress = compress
+        try:
+            f.seek(0, 2) # we might be appending to an existing file
+        except IOError:
+            pass # BZ2File can't seek while writing
+        self.offset = f.tell()
+        if self.offset == 0:
+            f.write(MAGIC)
+            self.offset = len(MAGIC)
+        if index_f is not None:
+            try:
+                index_f.seek(0, 2)
+            except IOError:
+                pass
+            if index_f.tell() == 0:
+                index_f.write(INDEX_MAGIC)
+        self._events = []
+        self._entries = []
+        self._size = 0
+        self._blocks = [] # closed but not yet written
+        self._blocks_size = 0
+        self.bytes_written = 0
+        self.closed = False
+
+    def buffered_bytes(self):
+        """How much has been added but not yet written out."""
+        return self._blocks_size + self._size
+
+    def add(self, e):
+        # pickle first, so an unpicklable event leaves the block untouched
+        self.add_pickled(pickle.dumps(e, 2), summarize_event(e))
+
+    def add_pickled(self, data, summary):
+        """Add an event that has already been pickled, which saves
+        unpickling and repickling events that are just being copied.
+        'summary' is what summarize_event() returned for it."""
+        if self.closed:
+            raise ValueError("cannot add events to a closed FlogWriter")
+        self._entries.append((self._size,) + summary)
+        self._events.append(data)
+        self._size += len(data)
+        if self._size >= self.blocksize:
+            self._end_block()
+        if self.buffersize is None:
+            self._write()
+        elif self.buffered_bytes() >= self.buffersize:
+            self.flush()
+
+    def _end_block(self):
+        if not self._events:
+            return
+        index = pickle.dumps(self._entries, 2)
+        data = "".join(self._events)
+        # the offset and length are filled in when the block is encoded
+        info = BlockInfo(None, None, len(self._entries))
+        info.summarize(self._entries)
+        self._blocks.append((index, data, info))
+        self._blocks_size += BLOCK_HEADER_SIZE + len(index) + len(data)
+        self._events = []
+        self._entries = []
+        self._size = 0
+
+    def _write(self):
+        if not self._blocks:
+            return 0
+        blocks = self._blocks
+        self._blocks = []
+        self._blocks_size = 0
+        return self._write_blocks(blocks)
+
+    def _encode_block(self, index, data):
+        if self.compress:
+            index = zlib.compress(index)
+            data = zlib.compress(data)
+            mark = ZLIB_BLOCK_MARK
+        else:
+            mark = BLOCK_MARK
+        return (struct.pack(BLOCK_HEADER, mark, len(index), len(data))
+                + index + data)
+
+    def _write_blocks(self, blocks):
+        encoded = []
+        records = []
+        offset = self.offset
+        for (index, data, info) in blocks:
+            block = self._encode_block(index, data)
+            info.offset = offset
+            info.length = len(block)
+            encoded.append(block)
+            records.append(info.pack())
+            offset += len(block)
+        # the data goes first, so the index never points past it
+        self.f.write("".join(encoded))
+        if self.index_f is not None:
+            self.index_f.write("".join(records))
+        written = offset - self.offset
+        self.offset = offset
+        self.bytes_written += written
+        return written
+
+    def flush(self):
+        """Write out everything, returning the number of bytes written. The
+        files are flushed too, so a crash after this loses nothing."""
+        self._end_block()
+        written = self._write()
+        if not self.closed:
+            self._flush_files()
+        return written
+
+    def _flush_files(self):
+        for f in (self.f, self.index_f):
+            # BZ2File has no flush()
+            if f is not None and hasattr(f, "flush"):
+                f.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.f.close()
+        if self.index_f is not None:
+            self.index_f.close()
+        self.closed = True
+
+
+class BackgroundFlogWriter(FlogWriter):
+    """I am a FlogWriter that encodes (and compresses) blocks and writes
+    them from a worker thread, so the caller only pays for pickling.
+
+    Blocks are handed to the thread in order, when a FlogWriter would write
+    them. At most 'queue_size' batches of blocks may be waiting for the
+    thread: after that, the caller blocks until the thread catches up.
+    close() waits for the thread to finish, which takes about as long as
+    encoding whatever was still buffered. 'bytes_written' and 'offset' are
+    updated by the thread as it goes.
+
+    If a write fails, the exception is stored in .error and, if 'on_error'
+    was given, passed to it right away. on_error is called from the worker
+    thread."""
+
+    QUEUE_SIZE = 16
+
+    def __init__(self, f, index_f=None, blocksize=None, buffersize=None,
+                 compress=False, queue_size=None, on_error=None):
+        FlogWriter.__init__(self, f, index_f, blocksize, buffersize,
+                            compress)
+        self.error = None
+        self._on_error = on_error
+        self._queue = Queue.Queue(queue_size or self.QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _write(self):
+        if not self._blocks:
+            return 0
+        blocks = self._blocks
+        self._blocks = []
+        self._blocks_size = 0
+        self._queue.put(blocks)
+        return 0
+
+    def _flush_files(self):
+        pass # the files belong to the thread until close()
+
+    def _run(self):
+        while True:
+            blocks = self._queue.get()
+            if blocks is None:
+                break
+            try:
+                self._write_blocks(blocks)
+            except Exception, e:
+                self.error = e
+                if self._on_error:
+                    self._on_error(e)
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self.f.close()
+        if self.index_f is not None:
+            self.index_f.close()
+        self.closed = True
+
+
+def open_writer(fn, mode="wb", blocksize=None):
+    """Create a FlogWriter (and its sidecar index) for the given filename."""
+    f = open_flogfile(fn, mode)
+    index_f = open(index_filename(fn), mode)
+    return FlogWriter(f, index_f, blocksize)
+
+
+class FlogReader:
+    """I read events from either kind of .flog file.
+
+    get_events() takes the same arguments as EventSelector. For an indexed
+    container it only decodes the blocks (and, within them, the events)
+    that can match; for a legacy file it has to unpickle everything."""
+
+    def __init__(self, fn_or_f):
+        if isinstance(fn_or_f, basestring):
+            self.fn = fn_or_f
+            self.f = open_flogfile(self.fn)
+        else:
+            self.fn = None
+            self.f = fn_or_f
+        self.size = None
+        if self.fn is not None and not self.fn.endswith(".bz2"):
+            self.size = os.path.getsize(self.fn)
+        self.is_container = (self.f.read(len(MAGIC)) == MAGIC)
+        if not self.is_container:
+            self.f.seek(0)
+        self._blocks = None
+        self._last_block = None
+
+    def close(self):
+        self.f.close()
+
+    def get_events(self, after=None, before=None, first_num=None,
+                   last_num=None, above=None):
+        selector = EventSelector(after, before, first_num, last_num, above)
+        if not self.is_container:
+            return self._get_legacy_events(selector)
+        if selector.selects_everything():
+            return self._get_all_events()
+        return self._get_selected_events(selector)
+
+    def _get_legacy_events(self, selector):
+        while True:
+            try:
+                e = pickle.load(self.f)
+            except EOFError:
+                break
+            if selector.matches_event(e):
+                yield e
+
+    def _get_all_events(self):
+        # a straight sequential read: no seeks, no sidecar
+        self.f.seek(len(MAGIC))
+        while True:
+            block = self._read_block()
+            if block is None:
+                break
+            (index, data) = block
+            for e in self._decode(index, data):
+                yield e
+
+    def _get_selected_events(self, selector):
+        for b in self.get_blocks():
+            if not b.might_match(selector):
+                continue
+            self.f.seek(b.offset)
+            block = self._read_block()
+            if block is None:
+                # the sidecar promised more than the file holds
+                break
+            (index, data) = block
+            wanted = [i for (i, (o,num,t,level,fac,tubid)) in enumerate(index)
+                      if selector.matches(num, t, level)]
+            for e in self._decode(index, data, wanted):
+                yield e
+
+    def get_located_events(self):
+        """Yield (location, event) for every event (and header) in the
+        file. The location can be passed to get_event_at() to read the
+        event again later. Locations are (offset, i) pairs of integers: for
+        an indexed container, offset is where the block starts and i is the
+        position of the event within it; for a legacy file, offset is where
+        the event's pickle starts and i is -1."""
+        if not self.is_container:
+            self.f.seek(0)
+            while True:
+                offset = self.f.tell()
+                try:
+                    e = pickle.load(self.f)
+                except EOFError:
+                    break
+                yield ((offset, -1), e)
+            return
+        self.f.seek(len(MAGIC))
+        while True:
+            offset = self.f.tell()
+            block = self._read_block()
+            if block is None:
+                break
+            (index, data) = block
+            for (i, e) in enumerate(self._decode(index, data)):
+                yield ((offset, i), e)
+
+    def get_event_at(self, location):
+        """Read one event, given a location from get_located_events()."""
+        (offset, i) = location
+        if i == -1:
+            self.f.seek(offset)
+            return pickle.load(self.f)
+        # callers tend to read neighboring events, so keep the last block
+        if self._last_block is None or self._last_block[0] != offset:
+            self.f.seek(offset)
+            (index, data) = self._read_block()
+            self._last_block = (offset, index, data)
+        (ign, index, data) = self._last_block
+        return list(self._decode(index, data, [i]))[0]
+
+    def _decode(self, index, data, wanted=None):
+        if wanted is None:
+            wanted = range(len(index))
+        for i in wanted:
+            start = index[i][0]
+            if i+1 < len(index):
+                end = index[i+1][0]
+            else:
+                end = len(data)
+            yield pickle.loads(data[start:end])
+
+    def _read_block_header(self):
+        header = self.f.read(BLOCK_HEADER_SIZE)
+        if len(header) < BLOCK_HEADER_SIZE:
+            return None
+        (mark, index_length, data_length) = struct.unpack(BLOCK_HEADER,
+                                                          header)
+        if mark not in (BLOCK_MARK, ZLIB_BLOCK_MARK):
+            return None
+        index = self.f.read(index_length)
+        if len(index) < index_length:
+            return None
+        compressed = (mark == ZLIB_BLOCK_MARK)
+        if compressed:
+            index = zlib.decompress(index)
+        return (pickle.loads(index), data_length, compressed)
+
+    def _read_block(self):
+        # returns None at the end of the file, or at a truncated block
+        header = self._read_block_header()
+        if header is None:
+            return None
+        (index, data_length, compressed) = header
+        data = self.f.read(data_length)
+        if len(data) < data_length:
+            return None
+        if compressed:
+            data = zlib.decompress(data)
+        return (index, data)
+
+    def get_blocks(self):
+        """Return a list of BlockInfo for every complete block."""
+        if not self.is_container:
+            return []
+        if self._blocks is None:
+            self._blocks = self._read_sidecar()
+            if self._blocks:
+                last = self._blocks[-1]
+                offset = last.offset + last.length
+            else:
+                offset = len(MAGIC)
+            self._blocks.extend(self._scan_blocks(offset))
+        return self._blocks
+
+    def count_events(self):
+        """Return the number of events (including headers) in an indexed
+        container, without decoding them."""
+        return sum([b.count for b in self.get_blocks()])
+
+    def _read_sidecar(self):
+        blocks = []
+        if self.fn is None:
+            return blocks
+        try:
+            f = open(index_filename(self.fn), "rb")
+        except EnvironmentError:
+            return blocks
+        try:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return blocks
+            offset = len(MAGIC)
+            while True:
+                data = f.read(INDEX_RECORD_SIZE)
+                if len(data) < INDEX_RECORD_SIZE:
+                    break # a record cut short by a crash
+                b = BlockInfo.unpack(data)
+                # the sidecar is only trusted as far as it agrees with the
+                # file it describes
+                if b.offset != offset:
+                    break
+                if self.size is not None and b.offset+b.length > self.size:
+                    break
+                blocks.append(b)
+                offset = b.offset + b.length
+        finally:
+            f.close()
+        return blocks
+
+    def _scan_blocks(self, offset):
+        # rebuild index records by reading block headers. For plain files
+        # we skip over the event data without reading it.
+        blocks = []
+        self.f.seek(offset)
+        while True:
+            header = self._read_block_header()
+            if header is None:
+                break
+            (index, data_length, compressed) = header
+            length = self.f.tell() - offset + data_length
+            if self.size is not None:
+                if offset + length > self.size:
+                    break
+                self.f.seek(offset + length)
+            elif len(self.f.read(data_length)) < data_length:
+                break
+            b = BlockInfo(offset, length, len(index))
+            b.summarize(index)
+            blocks.append(b)
+            offset += length
+        return blocks
+
+
+def get_events(fn_or_f, **kwargs):
+    """Yield the events from a .flog file (legacy or indexed), given its
+    filename or an open file. Keyword arguments are passed to
+    EventSelector."""
+    return FlogReader(fn_or_f).get_events(**kwargs)
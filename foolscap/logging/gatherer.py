@@ -12,6 +12,8 @@ from twisted.application import service, internet
 from foolscap.api import Tub, Referenceable
 from foolscap.logging.interfaces import RILogGatherer, RILogObserver
 from foolscap.logging.incident import IncidentClassifierBase, TIME_FORMAT
+from foolscap.logging import flogfile, publish
+from foolscap.logging.tail import SubscriptionFilterOptions
 from foolscap.util import get_local_ip_for
 
 class BadTubID(Exception):
@@ -74,20 +76,31 @@ class GatheringBase(service.MultiService, Referenceable):
         if self.verbose:
             print "Gatherer waiting at:", self.my_furl
 
-class CreateGatherOptions(usage.Options):
+class CreateGatherOptions(SubscriptionFilterOptions):
     """flogtool create-gatherer GATHERER_DIRECTORY"""
     stdout = sys.stdout
     stderr = sys.stderr
 
     optFlags = [
         ("bzip", "b", "Compress each output file with bzip2"),
+        ("compress", "z", "Compress the output file as it is written"),
         ("quiet", "q", "Don't print instructions to stdout"),
         ]
     optParameters = [
         ("rotate", "r", None,
          "Rotate the output file every N seconds."),
+        ("flush-interval", None, None,
+         "Write buffered events out at least every N seconds (default 0.1)"),
+        ("flush-bytes", None, None,
+         "Write buffered events out once there are N bytes (default 1MiB)"),
         ]
 
+    def opt_flush_interval(self, arg):
+        self["flush-interval"] = float(arg)
+
+    def opt_flush_bytes(self, arg):
+        self["flush-bytes"] = int(arg)
+
     def parseArgs(self, gatherer_dir):
         self["basedir"] = gatherer_dir
 
@@ -98,10 +111,18 @@ class Observer(Referenceable):
     def __init__(self, nodeid_s, gatherer):
         self.nodeid_s = nodeid_s # printable string
         self.gatherer = gatherer
+        # if the publisher can't filter events for us, we do it here
+        self.filter = None
 
     def remote_msg(self, d):
+        if self.filter and not self.filter.wants(d):
+            return
         self.gatherer.msg(self.nodeid_s, d)
 
+    def remote_msgs(self, events):
+        for d in events:
+            self.remote_msg(d)
+
 class GathererService(GatheringBase):
     # create this with 'flogtool create-gatherer BASEDIR'
     # run this as 'cd BASEDIR && twistd -y gatherer.tac'
@@ -113,7 +134,8 @@ class GathererService(GatheringBase):
     long-term FURL. You can then configure your applications to connect to
     this FURL when they start and pass it a reference to their LogPublisher.
     The gatherer will subscribe to the publisher and save all the resulting
-    messages in a logs.pickle file.
+    messages in an indexed .flog file (see foolscap.logging.flogfile), with
+    a .flog.idx sidecar next to it.
 
     Applications can use code like the following to create a LogPublisher and
     pass it to the gatherer::
@@ -134,20 +156,49 @@ class GathererService(GatheringBase):
     applications that want to provide the same functionality can just
     instantiate it with a distinct basedir= and call startService.
 
+    Incoming events are buffered and written in groups: the buffer is
+    written out once it holds flush_bytes (default FLUSH_BYTES, 1MiB) of
+    events, or flush_interval seconds (default FLUSH_INTERVAL, 0.1s) after
+    the first event went into it, whichever comes first. Rotation and
+    shutdown write it out too, so a crash loses at most the last
+    flush_interval seconds or flush_bytes bytes of events. get_stats()
+    reports how much has been received and written.
+
+    With compress=True, each block of the logfile is zlib-compressed on its
+    own, in a worker thread, as it is written. The live file is then just
+    as readable (and crash-safe) as an uncompressed one, and there is no
+    need to run bzip2 after rotation.
+
+    If subscription_filter= is given, it is passed to each publisher's
+    subscribe_to_all() (see RILogPublisher), so that only the matching
+    events are sent to the gatherer.
+
     """
 
     implements(RILogGatherer)
     verbose = True
     furlFile = "log_gatherer.furl"
     tacFile = "gatherer.tac"
+    FLUSH_INTERVAL = 0.1
+    FLUSH_BYTES = 1024*1024
+    RATE_INTERVAL = 10.0 # seconds between samples for the */sec counters
 
-    def __init__(self, rotate, use_bzip, basedir=None):
+    def __init__(self, rotate, use_bzip, basedir=None,
+                 flush_interval=None, flush_bytes=None, compress=False,
+                 subscription_filter=None):
         GatheringBase.__init__(self, basedir)
+        self.subscription_filter = subscription_filter
         if rotate: # int or None
             rotator = internet.TimerService(rotate, self.do_rotate)
             rotator.setServiceParent(self)
+        self.flush_interval = flush_interval or self.FLUSH_INTERVAL
+        self.flush_bytes = flush_bytes or self.FLUSH_BYTES
+        sampler = internet.TimerService(self.RATE_INTERVAL,
+                                        self._sample_rates)
+        sampler.setServiceParent(self)
+        self.compress = compress
         bzip = None
-        if use_bzip:
+        if use_bzip and not compress:
             bzips = procutils.which("bzip2")
             if bzips:
                 bzip = bzips[0]
@@ -155,6 +206,13 @@ class GathererService(GatheringBase):
         if signal and hasattr(signal, "SIGHUP"):
             signal.signal(signal.SIGHUP, self._handle_SIGHUP)
         self._savefile = None
+        self._writer = None
+        self._flush_timer = None
+        self.events_received = 0
+        self._bytes_from_old_files = 0
+        self._rate_sample = None
+        self.events_per_second = 0.0
+        self.bytes_per_second = 0.0
 
     def _handle_SIGHUP(self, *args):
         reactor.callFromThread(self.do_rotate)
@@ -169,6 +227,14 @@ class GathererService(GatheringBase):
         now = time.time()
         self._open_savefile(now)
 
+    def stopService(self):
+        self._flush()
+        if self.compress and self._writer:
+            # don't leave the worker thread behind
+            self._writer.close()
+            self._savefile = None
+        return GatheringBase.stopService(self)
+
     def format_time(self, when):
         return time.strftime(TIME_FORMAT, time.gmtime(when)) + "Z"
 
@@ -176,22 +242,39 @@ class GathererService(GatheringBase):
         new_filename = "from-%s---to-present.flog" % self.format_time(now)
         self._savefile_name = os.path.join(self.basedir, new_filename)
         self._savefile = open(self._savefile_name, "ab", 0)
+        self._indexfile = open(flogfile.index_filename(self._savefile_name),
+                               "ab", 0)
+        if self.compress:
+            self._writer = flogfile.BackgroundFlogWriter(
+                self._savefile, self._indexfile, buffersize=self.flush_bytes,
+                compress=True, on_error=self._write_failed_in_thread)
+        else:
+            self._writer = flogfile.FlogWriter(self._savefile,
+                                               self._indexfile,
+                                               buffersize=self.flush_bytes)
         self._starting_timestamp = now
         header = {"header": {"type": "gatherer",
                              "start": self._starting_timestamp,
                              }}
-        pickle.dump(header, self._savefile)
+        self._writer.add(header)
+        self._writer.flush()
 
     def do_rotate(self):
         if not self._savefile:
             return
-        self._savefile.close()
+        self._flush()
+        self._writer.close()
+        self._bytes_from_old_files += self._writer.bytes_written
         now = time.time()
         from_time = self.format_time(self._starting_timestamp)
         to_time = self.format_time(now)
         new_name = "from-%s---to-%s.flog" % (from_time, to_time)
         new_name = os.path.join(self.basedir, new_name)
         os.rename(self._savefile_name, new_name)
+        # the sidecar index keeps the uncompressed name, so it still
+        # matches after bzip2 is done
+        os.rename(flogfile.index_filename(self._savefile_name),
+                  flogfile.index_filename(new_name))
         self._open_savefile(now)
         if self.bzip:
             # we spawn an external bzip process because it's easier than
@@ -216,8 +299,11 @@ class GathererService(GatheringBase):
         # nodeid is actually a printable string
         nodeid_s = nodeid
         o = Observer(nodeid_s, self)
-        d = publisher.callRemote("subscribe_to_all", o)
-        d.addCallback(lambda res: None)
+        d = publish.subscribe_to_all(publisher, o, False,
+                                     self.subscription_filter)
+        def _subscribed(local_filter):
+            o.filter = local_filter
+        d.addCallback(_subscribed)
         return d # mostly for testing
 
     def msg(self, nodeid_s, d):
@@ -226,9 +312,63 @@ class GathererService(GatheringBase):
              "d": d,
              }
         try:
-            pickle.dump(e, self._savefile)
+            self._writer.add(e)
         except Exception, ex:
-            print "GATHERER: unable to pickle %s: %s" % (e, ex)
+            # unpicklable, or we have already stopped
+            print "GATHERER: unable to record %s: %s" % (e, ex)
+            return
+        self.events_received += 1
+        # the writer writes out the buffer by itself once it reaches
+        # flush_bytes. The timer puts a bound on how long anything can sit
+        # in it.
+        if self._writer.buffered_bytes() and not self._flush_timer:
+            self._flush_timer = reactor.callLater(self.flush_interval,
+                                                  self._flush)
+
+    def _flush(self):
+        if self._flush_timer:
+            if self._flush_timer.active():
+                self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._writer:
+            self._writer.flush()
+
+    def _write_failed_in_thread(self, error):
+        # the BackgroundFlogWriter's worker thread calls this
+        reactor.callFromThread(self._write_failed, error)
+
+    def _write_failed(self, error):
+        print "GATHERER: unable to write %s: %s" % (self._savefile_name, error)
+
+    def get_bytes_written(self):
+        n = self._bytes_from_old_files
+        if self._writer:
+            n += self._writer.bytes_written
+        return n
+
+    def _sample_rates(self):
+        now = time.time()
+        sample = (now, self.events_received, self.get_bytes_written())
+        if self._rate_sample:
+            (then, events, nbytes) = self._rate_sample
+            if now > then:
+                self.events_per_second = (sample[1] - events) / (now - then)
+                self.bytes_per_second = (sample[2] - nbytes) / (now - then)
+        self._rate_sample = sample
+
+    def get_stats(self):
+        """Return counters for the events received and the bytes written
+        since we started, and their rates (averaged over the last
+        RATE_INTERVAL seconds)."""
+        buffered = 0
+        if self._writer:
+            buffered = self._writer.buffered_bytes()
+        return {"events": self.events_received,
+                "bytes": self.get_bytes_written(),
+                "buffered-bytes": buffered,
+                "events-per-second": self.events_per_second,
+                "bytes-per-second": self.bytes_per_second,
+                }
 
 
 LOG_GATHERER_TACFILE = """\
@@ -250,7 +390,13 @@ from twisted.application import service
 
 rotate = %(rotate)s
 use_bzip = %(use_bzip)s
-gs = gatherer.GathererService(rotate, use_bzip)
+flush_interval = %(flush_interval)r
+flush_bytes = %(flush_bytes)r
+compress = %(compress)s
+subscription_filter = %(subscription_filter)r
+gs = gatherer.GathererService(rotate, use_bzip, flush_interval=flush_interval,
+                              flush_bytes=flush_bytes, compress=compress,
+                              subscription_filter=subscription_filter)
 application = service.Application('log_gatherer')
 gs.setServiceParent(application)
 """
@@ -271,6 +417,11 @@ def create_log_gatherer(config):
     f.write(LOG_GATHERER_TACFILE % { 'path': stashed_path,
                                      'rotate': rotate,
                                      'use_bzip': bool(config["bzip"]),
+                                     'flush_interval': config["flush-interval"],
+                                     'flush_bytes': config["flush-bytes"],
+                                     'compress': bool(config["compress"]),
+                                     'subscription_filter':
+                                     config.get_filter_spec(),
                                      })
     f.close()
     if not config["quiet"]:
@@ -1,8 +1,9 @@
 
-import sys, os.path, time, pickle, bz2
+import sys, os.path, time, pickle, bz2, threading, Queue, atexit
 from pprint import pprint
 from zope.interface import implements
-from twisted.python import usage
+from twisted.python import usage, failure
+from twisted.python import log as twisted_log
 from twisted.internet import reactor
 from foolscap.logging.interfaces import IIncidentReporter
 from foolscap.logging import levels, app_versions
@@ -36,6 +37,61 @@ class IncidentQualifier:
         if self.check_event(ev) and self.handler:
             self.handler.declare_incident(ev)
 
+def _call_from_thread(f, *args):
+    # nothing will run a callFromThread() call once the reactor has stopped
+    # (or if it never started), so make the call right here instead
+    if reactor.running:
+        reactor.callFromThread(f, *args)
+    else:
+        f(*args)
+
+class IncidentWriter:
+    """I own a worker thread that writes incident logfiles, so that the
+    pickling and bz2 compression do not happen on the reactor thread. Jobs
+    are run one at a time, in the order they were submitted. The thread is
+    started when the first job arrives.
+
+    The thread is a daemon, so it cannot keep the process alive, but I
+    drain() it before the reactor shuts down and again when the interpreter
+    exits, so jobs that were already submitted are not lost."""
+
+    DRAIN_TIMEOUT = 60.0 # seconds to wait for the jobs at shutdown
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    def call(self, f, *args):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+            reactor.addSystemEventTrigger("before", "shutdown", self.drain)
+            atexit.register(self.drain)
+        self._queue.put((f, args))
+
+    def drain(self, timeout=None):
+        """Wait for every job submitted so far to finish, or for 'timeout'
+        seconds (DRAIN_TIMEOUT by default), whichever comes first."""
+        if self._thread is None or not self._thread.isAlive():
+            return
+        if timeout is None:
+            timeout = self.DRAIN_TIMEOUT
+        done = threading.Event()
+        self._queue.put((done.set, ()))
+        done.wait(timeout)
+
+    def _run(self):
+        while True:
+            (f, args) = self._queue.get()
+            try:
+                f(*args)
+            except:
+                _call_from_thread(twisted_log.err, failure.Failure(),
+                                  "error while recording an incident")
+
+incident_writer = IncidentWriter()
+
 class IncidentReporter:
     """Once an Incident has been declared, I am responsible for making a
     durable record all relevant log events. I do this by creating a logfile
@@ -49,6 +105,12 @@ class IncidentReporter:
     I am created with a reference to a FoolscapLogger instance, from which I
     will grab the contents of the history buffer.
 
+    I take a snapshot of the history buffer right away, but the logfile is
+    written by the IncidentWriter thread. If the triggering event is at
+    SYNCHRONOUS_LEVEL or above, the program may be about to exit (log.BAD
+    is commonly followed by sys.exit), so I write the file before
+    incident_declared() returns instead.
+
     When I have closed the incident logfile, I will notify the logger by
     calling their incident_recorded() method, passing it the local filename
     of the logfile I created and the triggering event. This can be used to
@@ -58,6 +120,8 @@ class IncidentReporter:
 
     TRAILING_DELAY = 5.0 # gather 5 seconds of post-trigger events
     TRAILING_EVENT_LIMIT = 100 # or 100 events, whichever comes first
+    SYNCHRONOUS_LEVEL = levels.BAD
+    writer = incident_writer
 
     def __init__(self, basedir, logger, tubid_s):
         self.basedir = basedir
@@ -73,6 +137,8 @@ class IncidentReporter:
 
     def incident_declared(self, triggering_event):
         self.trigger = triggering_event
+        self.synchronous = (triggering_event.get("level", 0)
+                            >= self.SYNCHRONOUS_LEVEL)
         # choose a name for the logfile
         now = time.time()
         unique = os.urandom(4)
@@ -82,9 +148,6 @@ class IncidentReporter:
         self.abs_filename = os.path.join(self.basedir, filename)
         self.abs_filename_bz2 = self.abs_filename + ".bz2"
         self.abs_filename_bz2_tmp = self.abs_filename + ".bz2.tmp"
-        # open logfile. We use both an uncompressed one and a compressed one.
-        self.f1 = open(self.abs_filename, "wb")
-        self.f2 = bz2.BZ2File(self.abs_filename_bz2_tmp, "wb")
 
         # write header with triggering_event
         header = {"header": {"type": "incident",
@@ -92,8 +155,6 @@ class IncidentReporter:
                              "versions": app_versions.versions,
                              "pid": os.getpid(),
                              }}
-        pickle.dump(header, self.f1)
-        pickle.dump(header, self.f2)
 
         if self.TRAILING_DELAY is not None:
             # subscribe to events that occur after this one
@@ -101,18 +162,14 @@ class IncidentReporter:
             self.remaining_events = self.TRAILING_EVENT_LIMIT
             self.logger.addObserver(self.trailing_event)
 
-        # use self.logger.buffers, copy events into logfile
-        events = list(self.logger.get_buffered_events())
-        events.sort(lambda a,b: cmp(a['num'], b['num']))
-        for e in events:
-            wrapper = {"from": self.tubid_s,
-                       "rx_time": now,
-                       "d": e}
-            pickle.dump(wrapper, self.f1)
-            pickle.dump(wrapper, self.f2)
-
-        self.f1.flush()
-        # the BZ2File has no flush method
+        # snapshot the history buffer. get_buffered_events() yields the
+        # events in order. The events themselves are never modified once
+        # they've been logged, so we don't need to copy them.
+        wrappers = [{"from": self.tubid_s,
+                     "rx_time": now,
+                     "d": e}
+                    for e in self.logger.get_buffered_events()]
+        self._call(self._open_logfile, header, wrappers)
 
         if self.TRAILING_DELAY is None:
             self.active = False
@@ -122,6 +179,25 @@ class IncidentReporter:
             self.timer = reactor.callLater(self.TRAILING_DELAY,
                                            self.stop_recording)
 
+    def _call(self, f, *args):
+        if self.synchronous:
+            f(*args)
+        else:
+            self.writer.call(f, *args)
+
+    def _open_logfile(self, header, wrappers):
+        # open logfile. We use both an uncompressed one and a compressed one.
+        self.f1 = open(self.abs_filename, "wb")
+        self.f2 = bz2.BZ2File(self.abs_filename_bz2_tmp, "wb")
+        self._write_events([header] + wrappers)
+
+    def _write_events(self, wrappers):
+        for wrapper in wrappers:
+            pickle.dump(wrapper, self.f1)
+            pickle.dump(wrapper, self.f2)
+        self.f1.flush()
+        # the BZ2File has no flush method
+
     def trailing_event(self, ev):
         if not self.still_recording:
             return
@@ -131,8 +207,7 @@ class IncidentReporter:
             wrapper = {"from": self.tubid_s,
                        "rx_time": time.time(),
                        "d": ev}
-            pickle.dump(wrapper, self.f1)
-            pickle.dump(wrapper, self.f2)
+            self._call(self._write_events, [wrapper])
             return
 
         self.stop_recording()
@@ -155,16 +230,39 @@ class IncidentReporter:
         eventually(self.finished_recording)
 
     def finished_recording(self):
+        if self.synchronous:
+            self._close_logfile()
+            self._announce()
+        else:
+            self.writer.call(self._close_logfile_in_thread)
+
+    def _close_logfile(self):
         self.f2.close()
+        # make sure the compressed logfile is on disk before we announce it
+        fd = os.open(self.abs_filename_bz2_tmp, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
         os.rename(self.abs_filename_bz2_tmp, self.abs_filename_bz2)
         # the compressed logfile has closed successfully. We no longer care
         # about the uncompressed one.
         self.f1.close()
         os.unlink(self.abs_filename)
 
+    def _close_logfile_in_thread(self):
+        self._close_logfile()
+        _call_from_thread(self._announce)
+
+    def _announce(self):
         # now we can tell the world about our new incident report
-        eventually(self.logger.incident_recorded,
-                   self.abs_filename_bz2, self.name, self.trigger)
+        if reactor.running:
+            eventually(self.logger.incident_recorded,
+                       self.abs_filename_bz2, self.name, self.trigger)
+        else:
+            # an eventual-send would never be delivered
+            self.logger.incident_recorded(self.abs_filename_bz2, self.name,
+                                          self.trigger)
 
 class NonTrailingIncidentReporter(IncidentReporter):
     TRAILING_DELAY = None
@@ -8,11 +8,17 @@ Incarnation = (str, ChoiceOf(str, None))
 Header = DictOf(str, Any())
 Event = DictOf(str, Any()) # this has message:, level:, facility:, etc
 EventWrapper = DictOf(str, Any()) # this has from:, rx_time:, and d:
+# level:, include-facilities:, exclude-facilities:, noisy-rate:
+SubscriptionFilterSpec = DictOf(str, Any())
 
 class RILogObserver(RemoteInterface):
     __remote_name__ = "RILogObserver.foolscap.lothar.com"
     def msg(logmsg=Event):
         return None
+    def msgs(logmsgs=ListOf(Event, maxLength=1000)):
+        """Deliver several events at once, in order. Publishers fall back to
+        msg() for observers that don't implement this."""
+        return None
     def done():
         return None
 
@@ -56,10 +62,28 @@ class RILogPublisher(RemoteInterface):
         return int
 
     def subscribe_to_all(observer=RILogObserver,
-                         catch_up=Optional(bool, False)):
+                         catch_up=Optional(bool, False),
+                         filter=Optional(SubscriptionFilterSpec, {})):
         """
         Call unsubscribe() on the returned RISubscription object to stop
         receiving messages.
+
+        If filter= is provided, only the events that pass it are sent to the
+        observer (including catch-up events). It is a dictionary with the
+        following optional keys:
+
+         level: discard events below this severity level
+         include-facilities: a list of facility prefixes. If present, only
+                             events whose facility starts with one of them
+                             are sent.
+         exclude-facilities: a list of facility prefixes. Events whose
+                             facility starts with one of them are discarded.
+         noisy-rate: a number from 0.0 to 1.0 that says what fraction of the
+                     NOISY events (and below) should be sent.
+
+        Older publishers do not accept filter= (they reject the call with a
+        Violation), so subscribers should be prepared to retry without it
+        and do their own filtering.
         """
         return RISubscription
     def unsubscribe(subscription=Any()):
@@ -1,13 +1,13 @@
 
-import os, sys, time, pickle, weakref
+import os, sys, time, weakref
 import traceback
-import collections
+import collections, heapq
 from twisted.python import log as twisted_log
 from twisted.python import failure
 from foolscap import eventual
 from foolscap.logging.interfaces import IIncidentReporter
 from foolscap.logging.incident import IncidentQualifier, IncidentReporter
-from foolscap.logging import app_versions
+from foolscap.logging import app_versions, flogfile
 
 from foolscap.logging.levels import NOISY, OPERATIONAL, UNUSUAL, \
      INFREQUENT, CURIOUS, WEIRD, SCARY, BAD
@@ -33,6 +33,25 @@ def format_message(e):
         return e.get('message', "[no message]") + " [formatting failed]"
 
 
+def _estimate_size(value, depth):
+    if isinstance(value, (str, unicode)):
+        return len(value)
+    if isinstance(value, (int, long, float, bool)) or value is None:
+        return 8
+    if depth > 2:
+        return 100
+    if isinstance(value, (tuple, list)):
+        return sum([_estimate_size(v, depth+1) for v in value])
+    if isinstance(value, dict):
+        return sum([_estimate_size(k, depth+1) + _estimate_size(v, depth+1)
+                    for (k,v) in value.items()])
+    return 1000 # Failures, mostly, which carry a traceback
+
+def estimate_event_size(event):
+    """Return a rough guess of how many bytes this event will occupy once
+    serialized. This is cheaper than actually serializing it."""
+    return _estimate_size(event, 0)
+
 class Count:
     """A fixed version of itertools.count .
 
@@ -52,10 +71,61 @@ class Count:
         self.n += 1
         return self.n
 
+def _copy_failure(f):
+    # we need to avoid pickling the exception class, since that will require
+    # the original application code to unpickle, and log viewers may not
+    # have it installed. A CopiedFailure works great for this purpose. It
+    # also lets go of the traceback's frames, which the buffered event would
+    # otherwise keep alive. TODO: I'd prefer to not use a local import here,
+    # but doing at the top level causes a circular import failure.
+    from foolscap.call import FailureSlicer, CopiedFailure
+    if isinstance(f, CopiedFailure):
+        return f
+    fs = FailureSlicer(f)
+    f2 = CopiedFailure()
+    f2.setCopyableState(fs.getStateToCopy(f, _FakeBroker))
+    return f2
+
+class _FakeBroker:
+    unsafeTracebacks = True
+
+class _EventBuffer(collections.deque):
+    """The events for one (facility, level), oldest first. This remembers
+    the approximate size of each event, so the logger can enforce a byte
+    budget without re-measuring the events it evicts."""
+
+    def __init__(self):
+        collections.deque.__init__(self)
+        self.sizes = collections.deque()
+        self.nbytes = 0
+
+    def add(self, event, size):
+        self.append(event)
+        self.sizes.append(size)
+        self.nbytes += size
+
+    def evict(self):
+        # discard the oldest event, and return its size
+        self.popleft()
+        size = self.sizes.popleft()
+        self.nbytes -= size
+        return size
+
+    def measure(self):
+        # recompute the size of everything we hold, and return the total
+        self.sizes = collections.deque([estimate_event_size(e)
+                                        for e in self])
+        self.nbytes = sum(self.sizes)
+        return self.nbytes
+
 class FoolscapLogger:
     DEFAULT_SIZELIMIT = 100
     DEFAULT_THRESHOLD = NOISY
     MAX_RECORDED_INCIDENTS = 20 # records filenames of incident logfiles
+    # set this (or $FLOGCHECKFORMAT) to make msg() check that every event
+    # can be formatted, and complain right away if it can't. Otherwise the
+    # problem is only noticed by whoever formats it.
+    check_formatting = False
 
     def __init__(self):
         self.incarnation = self.get_incarnation()
@@ -63,9 +133,14 @@ class FoolscapLogger:
         self.facility_explanations = {}
         self.buffer_sizes = {} # k: facility or None, v: dict(level->sizelimit)
         self.buffer_sizes[None] = {}
-        self.buffers = {} # k: facility or None, v: dict(level->deque)
+        self.buffers = {} # k: facility or None, v: dict(level->_EventBuffer)
+        # if set, this limits the (approximate) total size of all buffers
+        self.buffer_budget = None
+        self.buffered_bytes = 0
         self.thresholds = {}
+        self._default_threshold = self.DEFAULT_THRESHOLD
         self._observers = []
+        self._pending_events = [] # waiting for delivery to _observers
         self._immediate_observers = []
         self._immediate_incident_observers = []
         self.logdir = None # nowhere to put our incidents
@@ -135,11 +210,77 @@ class FoolscapLogger:
         if facility not in self.buffer_sizes:
             self.buffer_sizes[facility] = {}
         self.buffer_sizes[facility][level] = sizelimit
+        # trim any existing buffers that are now too large
+        for (f, b1) in self.buffers.items():
+            if facility is not None and f != facility:
+                continue
+            buffer = b1.get(level)
+            if buffer is None:
+                continue
+            limit = self._get_buffer_size(f, level)
+            while len(buffer) > limit:
+                self.buffered_bytes -= buffer.evict()
+
+    def _get_buffer_size(self, facility, level):
+        d2 = self.buffer_sizes.get(facility)
+        if d2:
+            return d2.get(level, self.DEFAULT_SIZELIMIT)
+        return self.DEFAULT_SIZELIMIT
+
+    def set_buffer_budget(self, maxbytes):
+        """Limit the approximate total size of all buffered events to
+        MAXBYTES, in addition to the per-buffer message counts. When the
+        budget is exceeded, the oldest events of the lowest level are
+        discarded first. Use None to remove the limit."""
+        self.buffer_budget = maxbytes
+        self.buffered_bytes = 0
+        if maxbytes is not None:
+            for b1 in self.buffers.values():
+                for buffer in b1.values():
+                    self.buffered_bytes += buffer.measure()
+            self._enforce_budget()
+
+    def _enforce_budget(self):
+        while self.buffered_bytes > self.buffer_budget:
+            # find the oldest event of the lowest level, in any facility
+            victim = None
+            for b1 in self.buffers.values():
+                for (level, buffer) in b1.items():
+                    if not buffer:
+                        continue
+                    key = (level, buffer[0]['num'])
+                    if victim is None or key < victim[0]:
+                        victim = (key, buffer)
+            if victim is None:
+                break
+            self.buffered_bytes -= victim[1].evict()
+
+    def get_buffer_occupancy(self):
+        """Return a dictionary that describes what the in-memory buffers
+        are holding. 'events' and 'bytes' are totals, 'byte-budget' is the
+        limit set by set_buffer_budget(), and 'buffers' maps (facility,
+        level) to an (events, bytes) tuple. Sizes are only measured when a
+        budget is in effect, otherwise they are reported as zero."""
+        buffers = {}
+        events = 0
+        for (facility, b1) in self.buffers.items():
+            for (level, buffer) in b1.items():
+                buffers[(facility, level)] = (len(buffer), buffer.nbytes)
+                events += len(buffer)
+        return {"events": events,
+                "bytes": self.buffered_bytes,
+                "byte-budget": self.buffer_budget,
+                "buffers": buffers,
+                }
 
     def set_generation_threshold(self, level, facility=None):
+        # the threshold without a facility applies to every facility that
+        # doesn't have one of its own
         self.thresholds[facility] = level
+        if facility is None:
+            self._default_threshold = level
     def get_generation_threshold(self, facility=None):
-        return self.thresholds.get(facility, self.DEFAULT_THRESHOLD)
+        return self.thresholds.get(facility, self._default_threshold)
 
     def msg(self, *args, **kwargs):
         """
@@ -157,23 +298,25 @@ class FoolscapLogger:
         else:
             num = kwargs['num']
         facility = kwargs.get('facility')
-        if "level" not in kwargs:
-            kwargs['level'] = OPERATIONAL
-        level = kwargs["level"]
-        threshold = self.get_generation_threshold(facility)
-        if level < threshold:
+        level = kwargs.get('level', OPERATIONAL)
+        if level < self.thresholds.get(facility, self._default_threshold):
             return num # not worth logging
 
         event = kwargs
+        event['level'] = level
 
         if "format" in event:
             pass
         elif "message" in event:
-            event['message'] = str(event['message'])
+            if type(event['message']) is not str:
+                event['message'] = str(event['message'])
         elif args:
-            event['message'], posargs = str(args[0]), args[1:]
-            if posargs:
-                event['args'] = posargs
+            message = args[0]
+            if type(message) is not str:
+                message = str(message)
+            event['message'] = message
+            if len(args) > 1:
+                event['args'] = args[1:]
         else:
             event['message'] = ""
 
@@ -181,28 +324,15 @@ class FoolscapLogger:
             event['time'] = time.time()
 
         if "failure" in event:
-            f = event["failure"]
-            # we need to avoid pickling the exception class, since that will
-            # require the original application code to unpickle, and log
-            # viewers may not have it installed. A CopiedFailure works great
-            # for this purpose. TODO: I'd prefer to not use a local import
-            # here, but doing at the top level causes a circular import
-            # failure.
-            from foolscap.call import FailureSlicer, CopiedFailure
-            class FakeBroker:
-                unsafeTracebacks = True
-            if not isinstance(f, CopiedFailure):
-                fs = FailureSlicer(f)
-                f2 = CopiedFailure()
-                f2.setCopyableState(fs.getStateToCopy(f, FakeBroker))
-                event["failure"] = f2
-
-        # verify that we can stringify the event correctly
-        try:
-            format_message(event)
-        except Exception, e:
-            print "problem in log message %s: %r %s" % (event, e, e)
-            pass
+            event["failure"] = _copy_failure(event["failure"])
+
+        if self.check_formatting:
+            # verify that we can stringify the event correctly
+            try:
+                format_message(event)
+            except Exception, e:
+                print "problem in log message %s: %r %s" % (event, e, e)
+                pass
         if event.get('stacktrace', False) is True:
             event['stacktrace'] = traceback.format_stack()
         event['incarnation'] = self.incarnation
@@ -228,36 +358,44 @@ class FoolscapLogger:
         # send to observers
         for o in self._immediate_observers:
             o(event)
-        for o in self._observers:
-            eventual.eventually(o, event)
+        if self._observers:
+            # all the events from this turn are delivered together, with a
+            # single eventual-send
+            if not self._pending_events:
+                eventual.eventually(self._deliver_events)
+            self._pending_events.append(event)
 
         # buffer locally
         d1 = self.buffers.get(facility)
         if not d1:
             d1 = self.buffers[facility] = {}
         buffer = d1.get(level)
-        if not buffer:
-            buffer = d1[level] = collections.deque()
-        buffer.append(event)
-
-        # enforce size limits on local buffers
-        d2 = self.buffer_sizes.get(facility)
-        if d2:
-            sizelimit = d2.get(level, self.DEFAULT_SIZELIMIT)
+        if buffer is None:
+            buffer = d1[level] = _EventBuffer()
+        if self.buffer_budget is None:
+            buffer.add(event, 0)
         else:
-            sizelimit = self.DEFAULT_SIZELIMIT
-        while len(buffer) > sizelimit:
-            buffer.popleft()
+            size = estimate_event_size(event)
+            buffer.add(event, size)
+            self.buffered_bytes += size
+
+        # enforce size limits on local buffers. set_buffer_size() trims the
+        # existing buffers, so we never have more than one extra event here.
+        if len(buffer) > self._get_buffer_size(facility, level):
+            self.buffered_bytes -= buffer.evict()
+        if self.buffer_budget is not None:
+            self._enforce_budget()
 
         # check with incident reporter. This is done synchronously rather
         # than via the usual eventual-send to allow the application to do:
         #  log.msg("abandon ship", level=log.BAD)
         #  sys.exit(1)
         #
-        # This means the IncidentReporter will do most of its work right
-        # here. The reporter is not allowed to make any foolscap calls, and
-        # the call to incident_recorded() is required to pass through an
-        # eventual-send.
+        # This means the IncidentReporter will take its snapshot of the
+        # buffers right here (and, for the most severe triggers, write the
+        # logfile too). The reporter is not allowed to make any foolscap
+        # calls, and the call to incident_recorded() is required to pass
+        # through an eventual-send.
 
         if self.active_incident_qualifier:
             try:
@@ -266,6 +404,16 @@ class FoolscapLogger:
             except:
                 print failure.Failure() # for debugging
 
+    def _deliver_events(self):
+        events, self._pending_events = self._pending_events, []
+        observers = self._observers[:]
+        for event in events:
+            for o in observers:
+                try:
+                    o(event)
+                except:
+                    twisted_log.err()
+
     def declare_incident(self, triggering_event):
         self.incidents_declared += 1
         ir = self.get_active_incident_reporter()
@@ -275,7 +423,7 @@ class FoolscapLogger:
         if self.logdir: # just in case
             ir = self.incident_reporter_factory(self.logdir, self, "local")
             self.active_incident_reporter_weakref = weakref.ref(ir)
-            ir.incident_declared(triggering_event) # this takes a few seconds
+            ir.incident_declared(triggering_event)
 
     def incident_recorded(self, filename, name, trigger):
         # 'name' is incident-TIMESTAMP-UNIQUE, whereas filename is an
@@ -301,13 +449,25 @@ class FoolscapLogger:
         return self._logport
 
     def get_buffered_events(self):
-        # iterates over all current log events in no particular order. The
-        # caller should sort them by event number. If this isn't iterated
-        # quickly enough, more events may arrive.
-        for facility,b1 in self.buffers.iteritems():
-            for level,q in b1.iteritems():
-                for event in q:
-                    yield event
+        # iterates over all current log events, sorted by event number. Each
+        # buffer is already in order, so we just merge them. We take a copy
+        # of each buffer first, so events that arrive while the caller is
+        # iterating will not be included.
+        heap = []
+        for b1 in self.buffers.values():
+            for q in b1.values():
+                if q:
+                    events = list(q)
+                    heap.append((events[0]['num'], 0, events))
+        heapq.heapify(heap)
+        while heap:
+            (num, i, events) = heap[0]
+            yield events[i]
+            i += 1
+            if i < len(events):
+                heapq.heapreplace(heap, (events[i]['num'], i, events))
+            else:
+                heapq.heappop(heap)
 
 
 theLogger = FoolscapLogger()
@@ -318,6 +478,7 @@ err = theLogger.err
 setLogDir = theLogger.setLogDir
 explain_facility = theLogger.explain_facility
 set_buffer_size = theLogger.set_buffer_size
+set_buffer_budget = theLogger.set_buffer_budget
 set_generation_threshold = theLogger.set_generation_threshold
 get_generation_threshold = theLogger.get_generation_threshold
 
@@ -428,22 +589,26 @@ def bridgeLogsToTwisted(filter=None,
 
 class LogFileObserver:
     def __init__(self, filename, level=OPERATIONAL):
-        if filename.endswith(".bz2"):
-            import bz2
-            self._logFile = bz2.BZ2File(filename, "w")
-        else:
-            self._logFile = open(filename, "wb")
+        # events are written in indexed blocks (see flogfile), which are
+        # only complete once flushed. We flush at the end of each turn that
+        # logged something, so a crash loses at most that turn's events.
+        self._logFile = flogfile.open_writer(filename)
         self._level = level
+        self._flush_scheduled = False
         header = {"header": {"type": "log-file-observer",
                              "threshold": level,
                              "versions": app_versions.versions,
                              "pid": os.getpid(),
                              }}
-        pickle.dump(header, self._logFile)
+        self._add(header)
 
     def stop_on_shutdown(self):
         from twisted.internet import reactor
+        import atexit
         reactor.addSystemEventTrigger("after", "shutdown", self._stop)
+        # programs that exit without stopping the reactor still get their
+        # last block written
+        atexit.register(self._logFile.close)
 
     def msg(self, event):
         threshold = self._level
@@ -454,11 +619,22 @@ class LogFileObserver:
                  "rx_time": time.time(),
                  "d": event,
                  }
-            pickle.dump(e, self._logFile, 2)
+            self._add(e)
+
+    def _add(self, e):
+        self._logFile.add(e)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            eventual.eventually(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self._logFile and not self._logFile.closed:
+            self._logFile.flush()
 
     def _stop(self):
         self._logFile.close()
-        del self._logFile
+        self._logFile = None
 
 
 # remove the key, so any child processes won't try to log to (and thus
@@ -478,6 +654,9 @@ if _flogfile:
         print >>sys.stderr, "FLOGFILE: unable to write to %s, ignoring" % \
               (_flogfile,)
 
+if "FLOGCHECKFORMAT" in os.environ:
+    FoolscapLogger.check_formatting = True
+
 if "FLOGTWISTED" in os.environ:
     bridgeLogsFromTwisted()
 
@@ -0,0 +1,161 @@
+
+import os, shutil, tempfile, marshal, pickle, heapq
+from twisted.python import usage
+from foolscap.logging import flogfile
+from foolscap.logging.filter import FilterOptions, EventFilter, describe_filter
+
+try:
+    import multiprocessing
+except ImportError:
+    # python2.5 and older: decode the input files one at a time
+    multiprocessing = None
+
+def default_jobs():
+    if multiprocessing is None:
+        return 1
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+class MergeOptions(FilterOptions):
+    synopsis = "Usage: flogtool merge [options] OLDFILE.flog.. NEWFILE.flog"
+
+    optParameters = [
+        ["jobs", "j", None,
+         "number of worker processes that decode input files (default: one per CPU)"],
+        ]
+
+    def parseArgs(self, *files):
+        if len(files) < 2:
+            raise usage.UsageError("need at least one input file and an output file")
+        self.oldfiles = list(files[:-1])
+        self.newfile = files[-1]
+        if self.newfile in self.oldfiles:
+            raise usage.UsageError("the output file cannot also be an input file")
+
+    def opt_jobs(self, arg):
+        self['jobs'] = int(arg)
+        if self['jobs'] < 1:
+            raise usage.UsageError("--jobs must be at least 1")
+
+    def postOptions(self):
+        if self['jobs'] is None:
+            self['jobs'] = default_jobs()
+
+
+def sort_file(task):
+    """Read one input file and write the events that pass the filter,
+    sorted by time, to a run file. This runs in a worker process, so it
+    takes and returns only simple values: it returns the run filename, the
+    number of events in the input, and the number that were kept.
+
+    The run file is a series of marshalled records: first the list of
+    (summary, pickle) pairs for the headers, then one (time, summary,
+    pickle) tuple per event."""
+    (oldfile, runfile, filter_args) = task
+    event_filter = EventFilter(*filter_args)
+    (after, before, above) = filter_args[:3]
+    reader = flogfile.FlogReader(oldfile)
+    headers = []
+    events = []
+    total = 0
+    # --after/--before/--above let indexed files skip whole blocks. A
+    # legacy file has to be unpickled anyway, and it must be read in full
+    # to count its events.
+    if reader.is_container:
+        events_in = reader.get_events(after=after, before=before, above=above)
+    else:
+        events_in = reader.get_events()
+    for e in events_in:
+        total += 1
+        if not event_filter.wants(e):
+            continue
+        summary = flogfile.summarize_event(e)
+        data = pickle.dumps(e, 2)
+        if "d" in e:
+            # the sequence number keeps equal-time events in file order
+            events.append((e['d']['time'], len(events), summary, data))
+        else:
+            headers.append((summary, data))
+    if reader.is_container:
+        # count the events we never had to read
+        total = reader.count_events()
+    reader.close()
+    events.sort()
+    f = open(runfile, "wb")
+    marshal.dump(headers, f)
+    for (when, seq, summary, data) in events:
+        marshal.dump((when, summary, data), f)
+    f.close()
+    return (runfile, total, len(headers) + len(events))
+
+def read_run(f):
+    while True:
+        try:
+            yield marshal.load(f)
+        except EOFError:
+            return
+
+class Merge:
+
+    def run(self, options):
+        stdout = options.stdout
+        describe_filter(options, stdout)
+        filter_args = (options['after'], options['before'], options['above'],
+                       options['from'], options['strip-facility'])
+        tmpdir = tempfile.mkdtemp(prefix="flogtool-merge-")
+        try:
+            tasks = [(oldfile, os.path.join(tmpdir, "run-%d" % i), filter_args)
+                     for (i, oldfile) in enumerate(options.oldfiles)]
+            results = self.sort_files(tasks, options['jobs'])
+            writer = flogfile.open_writer(options.newfile)
+            runs = [open(r[0], "rb") for r in results]
+            try:
+                self.merge_runs(runs, writer)
+            finally:
+                for f in runs:
+                    f.close()
+            writer.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        total = sum([r[1] for r in results])
+        copied = sum([r[2] for r in results])
+        print >>stdout, "merged %d of %d events from %d files into new file" % \
+              (copied, total, len(options.oldfiles))
+
+    def sort_files(self, tasks, jobs):
+        jobs = min(jobs, len(tasks))
+        if multiprocessing is None or jobs < 2:
+            return [sort_file(task) for task in tasks]
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(sort_file, tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    def merge_runs(self, runs, writer):
+        # all headers go first, in input-file order
+        for f in runs:
+            for (summary, data) in marshal.load(f):
+                writer.add_pickled(data, summary)
+        # then a k-way merge of the sorted runs. Ties go to the earlier
+        # input file, and the file index keeps the comparison from ever
+        # reaching the records themselves.
+        heap = []
+        for (i, f) in enumerate(runs):
+            records = read_run(f)
+            for record in records:
+                heap.append((record[0], i, record, records))
+                break
+        heapq.heapify(heap)
+        while heap:
+            (ign, i, (when, summary, data), records) = heap[0]
+            writer.add_pickled(data, summary)
+            for record in records:
+                heapq.heapreplace(heap, (record[0], i, record, records))
+                break
+            else:
+                heapq.heappop(heap)
@@ -4,25 +4,87 @@ import pickle
 from collections import deque
 from zope.interface import implements
 from twisted.python import filepath
+from twisted.internet.error import ConnectionLost, ConnectionDone
 from foolscap.referenceable import Referenceable
+from foolscap.ipb import DeadReferenceError
+from foolscap.tokens import Violation
 from foolscap.logging.interfaces import RISubscription, RILogPublisher
 from foolscap.logging import app_versions
+from foolscap.logging.log import estimate_event_size, NOISY, OPERATIONAL
 from foolscap.eventual import eventually
 
+class SubscriptionFilter:
+    """I decide which events a subscriber wants to hear about. I am created
+    with the filter spec that was passed to subscribe_to_all() (see
+    RILogPublisher for the keys it may contain). Unrecognized keys are
+    ignored. A malformed spec raises ValueError.
+
+    NOISY events are sampled deterministically: with noisy-rate=0.25, every
+    fourth one is kept."""
+
+    def __init__(self, spec):
+        try:
+            self.level = spec.get("level")
+            if self.level is not None:
+                self.level = int(self.level)
+            self.include = tuple([str(p) for p in
+                                  spec.get("include-facilities") or []])
+            self.exclude = tuple([str(p) for p in
+                                  spec.get("exclude-facilities") or []])
+            self.noisy_rate = spec.get("noisy-rate")
+            if self.noisy_rate is not None:
+                self.noisy_rate = float(self.noisy_rate)
+        except (TypeError, ValueError), e:
+            raise ValueError("bad subscription filter %r: %s" % (spec, e))
+        if self.noisy_rate is not None and not 0.0 <= self.noisy_rate <= 1.0:
+            raise ValueError("noisy-rate must be between 0.0 and 1.0")
+        self._noisy_credit = 0.0
+
+    def wants(self, event):
+        level = event.get("level", OPERATIONAL)
+        if self.level is not None and level < self.level:
+            return False
+        if self.include or self.exclude:
+            facility = event.get("facility") or ""
+            if self.include:
+                for prefix in self.include:
+                    if facility.startswith(prefix):
+                        break
+                else:
+                    return False
+            for prefix in self.exclude:
+                if facility.startswith(prefix):
+                    return False
+        if self.noisy_rate is not None and level <= NOISY:
+            self._noisy_credit += self.noisy_rate
+            if self._noisy_credit < 1.0:
+                return False
+            self._noisy_credit -= 1.0
+        return True
+
 class Subscription(Referenceable):
     implements(RISubscription)
     # used as a marker, and as an unsubscribe() method. We use this to manage
     # the outbound size-limited queue.
     MAX_QUEUE_SIZE = 2000
     MAX_IN_FLIGHT = 10
+    # events are delivered in batches, with a msgs() call. Observers from
+    # before msgs() existed get one msg() call per event. The batch size
+    # must stay within the ListOf() limit of RILogObserver.msgs .
+    MAX_BATCH_EVENTS = 100
+    MAX_BATCH_BYTES = 64*1024
 
-    def __init__(self, observer, logger):
+    def __init__(self, observer, logger, filter=None):
         self.observer = observer
         self.logger = logger
+        self.filter = filter # a SubscriptionFilter, or None to send everything
         self.subscribed = False
+        self.catchup_queue = deque()
         self.queue = deque()
         self.in_flight = 0
         self.marked_for_sending = False
+        # None until we learn whether the observer accepts msgs()
+        self.use_batches = None
         #self.messages_dropped = 0
 
     def subscribe(self, catch_up):
@@ -33,14 +95,15 @@ class Subscription(Referenceable):
         self.logger.addImmediateObserver(self.send)
         self._nod_marker = self.observer.notifyOnDisconnect(self.unsubscribe)
         if catch_up:
-            # send any catch-up events in a single batch, before we allow any
-            # other events to be generated (and sent). This lets the
-            # subscriber see events in sorted order. We bypass the bounded
-            # queue for this.
-            events = list(self.logger.get_buffered_events())
-            events.sort(lambda a,b: cmp(a['num'], b['num']))
-            for e in events:
-                self.observer.callRemoteOnly("msg", e)
+            # queue any catch-up events before we allow any other events to
+            # be generated (and sent). This lets the subscriber see events in
+            # sorted order. They go into their own queue, so they don't count
+            # against the size limit.
+            events = self.logger.get_buffered_events()
+            if self.filter:
+                events = [e for e in events if self.filter.wants(e)]
+            self.catchup_queue.extend(events)
+            self.mark_for_sending()
 
     def unsubscribe(self):
         if self.subscribed:
@@ -51,24 +114,72 @@ class Subscription(Referenceable):
         return self.unsubscribe()
 
     def send(self, event):
+        if self.filter and not self.filter.wants(event):
+            return
         if len(self.queue) < self.MAX_QUEUE_SIZE:
             self.queue.append(event)
         else:
             # preserve old messages, discard new ones.
             #self.messages_dropped += 1
             pass
+        self.mark_for_sending()
+
+    def mark_for_sending(self):
         if not self.marked_for_sending:
             self.marked_for_sending = True
             eventually(self.start_sending)
 
+    def _next_event(self):
+        if self.catchup_queue:
+            return self.catchup_queue.popleft()
+        return self.queue.popleft()
+
     def start_sending(self):
         self.marked_for_sending = False
-        while self.queue and (self.MAX_IN_FLIGHT - self.in_flight > 0):
-            event = self.queue.popleft()
+        if not self.subscribed:
+            return
+        while ((self.catchup_queue or self.queue)
+               and (self.MAX_IN_FLIGHT - self.in_flight > 0)):
+            if self.use_batches is False:
+                event = self._next_event()
+                self.in_flight += 1
+                d = self.observer.callRemote("msg", event)
+                d.addCallback(self._event_received)
+                d.addErrback(self._error)
+                continue
+            if self.use_batches is None and self.in_flight:
+                # wait until the first batch tells us what the observer
+                # can handle
+                break
+            batch = []
+            size = 0
+            while ((self.catchup_queue or self.queue)
+                   and len(batch) < self.MAX_BATCH_EVENTS
+                   and size < self.MAX_BATCH_BYTES):
+                event = self._next_event()
+                batch.append(event)
+                size += estimate_event_size(event)
             self.in_flight += 1
-            d = self.observer.callRemote("msg", event)
-            d.addCallback(self._event_received)
-            d.addErrback(self._error)
+            d = self.observer.callRemote("msgs", batch)
+            d.addCallbacks(self._batch_received, self._batch_failed,
+                           errbackArgs=(batch,))
+
+    def _batch_received(self, res):
+        self.use_batches = True
+        self._event_received(res)
+
+    def _batch_failed(self, f, batch):
+        if (self.use_batches is None
+            and not f.check(DeadReferenceError, ConnectionLost,
+                            ConnectionDone)):
+            # an observer that predates msgs(): resend the batch one event
+            # at a time, ahead of everything else
+            self.use_batches = False
+            batch.reverse()
+            self.catchup_queue.extendleft(batch)
+            self._event_received(None)
+            return
+        self._error(f)
 
     def _event_received(self, res):
         self.in_flight -= 1
@@ -81,14 +192,40 @@ class Subscription(Referenceable):
         #            dropped=count,
         #            facility="foolscap.log.publisher",
         #            level=log.UNUSUAL)
-        if not self.marked_for_sending:
-            self.marked_for_sending = True
-            eventually(self.start_sending)
+        self.mark_for_sending()
 
     def _error(self, f):
         #print "PUBLISH FAILED: %s" % f
         self.unsubscribe()
 
+def subscribe_to_all(publisher, observer, catch_up=False, filter_spec=None):
+    """Subscribe OBSERVER to the remote RILogPublisher, asking the publisher
+    to apply FILTER_SPEC (if any). Returns a Deferred that fires with a
+    SubscriptionFilter that the observer must apply to the events it
+    receives, or None if the publisher is doing all the filtering. The
+    former happens when the publisher is too old to accept a filter."""
+    if not filter_spec:
+        if catch_up:
+            d = publisher.callRemote("subscribe_to_all", observer, True)
+        else:
+            # provide compatibility with foolscap-0.2.4 and earlier, which
+            # didn't accept a catchup= argument
+            d = publisher.callRemote("subscribe_to_all", observer)
+        d.addCallback(lambda res: None)
+        return d
+    # check the spec before sending it anywhere
+    local_filter = SubscriptionFilter(filter_spec)
+    d = publisher.callRemote("subscribe_to_all", observer, catch_up,
+                             filter=filter_spec)
+    d.addCallback(lambda res: None)
+    def _old_publisher(f):
+        f.trap(Violation)
+        d2 = subscribe_to_all(publisher, observer, catch_up)
+        d2.addCallback(lambda res: local_filter)
+        return d2
+    d.addErrback(_old_publisher)
+    return d
+
 class IncidentSubscription(Referenceable):
     implements(RISubscription)
 
@@ -179,8 +316,11 @@ class LogPublisher(Referenceable):
         return os.getpid()
 
 
-    def remote_subscribe_to_all(self, observer, catch_up=False):
-        s = Subscription(observer, self._logger)
+    def remote_subscribe_to_all(self, observer, catch_up=False, filter={}):
+        f = None
+        if filter:
+            f = SubscriptionFilter(filter)
+        s = Subscription(observer, self._logger, f)
         eventually(s.subscribe, catch_up)
         # allow the call to return before we send them any events
         return s
@@ -5,7 +5,7 @@ from twisted.internet import reactor
 from twisted.python import usage
 from foolscap import base32
 from foolscap.api import Tub, Referenceable, fireEventually
-from foolscap.logging import log
+from foolscap.logging import log, levels, publish
 from foolscap.referenceable import SturdyRef
 from foolscap.util import format_time, FORMAT_TIME_MODES
 from interfaces import RILogObserver
@@ -39,7 +39,67 @@ class LogSaver(Referenceable):
     def disconnected(self):
         del self.f
 
-class TailOptions(usage.Options):
+class SubscriptionFilterOptions(usage.Options):
+    """Options for commands that subscribe to a log publisher, which ask
+    the publisher to send only some of its events."""
+
+    optParameters = [
+        ("level", None, None,
+         "Only receive events at this severity level (a number, or a name "
+         "like UNUSUAL) or above"),
+        ("include-facility", None, None,
+         "Only receive events whose facility starts with this prefix "
+         "(can be given more than once)"),
+        ("exclude-facility", None, None,
+         "Do not receive events whose facility starts with this prefix "
+         "(can be given more than once)"),
+        ("noisy-rate", None, None,
+         "Only receive this fraction (0.0 to 1.0) of the NOISY events"),
+        ]
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self["include-facility"] = []
+        self["exclude-facility"] = []
+
+    def opt_level(self, arg):
+        try:
+            self["level"] = int(arg)
+        except ValueError:
+            level = getattr(levels, arg.upper(), None)
+            if not isinstance(level, int):
+                raise usage.UsageError("--level= must be a number or one of "
+                                       "NOISY, OPERATIONAL, UNUSUAL, "
+                                       "INFREQUENT, CURIOUS, WEIRD, SCARY, "
+                                       "BAD")
+            self["level"] = level
+
+    def opt_include_facility(self, arg):
+        self["include-facility"].append(arg)
+
+    def opt_exclude_facility(self, arg):
+        self["exclude-facility"].append(arg)
+
+    def opt_noisy_rate(self, arg):
+        rate = float(arg)
+        if not 0.0 <= rate <= 1.0:
+            raise usage.UsageError("--noisy-rate= must be between 0 and 1")
+        self["noisy-rate"] = rate
+
+    def get_filter_spec(self):
+        # returns a filter spec for RILogPublisher.subscribe_to_all, or None
+        spec = {}
+        if self["level"] is not None:
+            spec["level"] = self["level"]
+        if self["include-facility"]:
+            spec["include-facilities"] = self["include-facility"]
+        if self["exclude-facility"]:
+            spec["exclude-facilities"] = self["exclude-facility"]
+        if self["noisy-rate"] is not None:
+            spec["noisy-rate"] = self["noisy-rate"]
+        return spec or None
+
+class TailOptions(SubscriptionFilterOptions):
     synopsis = "Usage: flogtool tail (LOGPORT.furl/furlfile/nodedir)"
 
     optFlags = [
@@ -80,6 +140,8 @@ class LogPrinter(Referenceable):
             f = open(options["save-to"], "wb")
             self.saver = LogSaver(target_tubid_s[:8], f)
         self.output = output
+        # if the publisher can't filter events for us, we do it here
+        self.filter = None
 
     def got_versions(self, versions, pid=None):
         print >>self.output, "Remote Versions:"
@@ -89,6 +151,8 @@ class LogPrinter(Referenceable):
             self.saver.emit_header(versions, pid)
 
     def remote_msg(self, d):
+        if self.filter and not self.filter.wants(d):
+            return
         if self.options['verbose']:
             self.simple_print(d)
         else:
@@ -96,6 +160,10 @@ class LogPrinter(Referenceable):
         if self.saver:
             self.saver.remote_msg(d)
 
+    def remote_msgs(self, events):
+        for d in events:
+            self.remote_msg(d)
+
     def simple_print(self, d):
         print >>self.output, d
 
@@ -157,14 +225,13 @@ class LogTail:
             return d
         d.addCallback(_ask_for_versions)
         catch_up = bool(self.options["catch-up"])
-        if catch_up:
-            d.addCallback(lambda res:
-                          publisher.callRemote("subscribe_to_all", lp, True))
-        else:
-            # provide compatibility with foolscap-0.2.4 and earlier, which
-            # didn't accept a catchup= argument
-            d.addCallback(lambda res:
-                          publisher.callRemote("subscribe_to_all", lp))
+        filter_spec = self.options.get_filter_spec()
+        d.addCallback(lambda res:
+                      publish.subscribe_to_all(publisher, lp, catch_up,
+                                               filter_spec))
+        def _subscribed(local_filter):
+            lp.filter = local_filter
+        d.addCallback(_subscribed)
         d.addErrback(self._error)
         return d
 
@@ -1,11 +1,13 @@
 
-import pickle, time, urllib
+import time, urllib, bz2, shutil, tempfile
+from array import array
+from bisect import bisect_left, bisect_right
 from twisted.internet import reactor
 from twisted.application import internet
 from twisted.python import usage
 from foolscap import base32
 from foolscap.eventual import fireEventually
-from foolscap.logging import log
+from foolscap.logging import log, flogfile
 from foolscap.util import format_time, FORMAT_TIME_MODES
 from foolscap.pb import parse_strport
 from twisted.web import server, static, html, resource
@@ -16,6 +18,9 @@ class WebViewerOptions(usage.Options):
     optFlags = [
         ("quiet", "q", "Don't print instructions to stdout"),
         ("open", "o", "Open the page in your webbrowser automatically"),
+        ("streaming", "s", "Index the logfile instead of loading it into "
+         "memory, and read events from disk as pages are viewed. Use this "
+         "for large files."),
         ]
 
     optParameters = [
@@ -23,6 +28,8 @@ class WebViewerOptions(usage.Options):
          "strports specification of where the web server should listen."),
         ("timestamps", "t", "short-local",
          "Format for timestamps: " + " ".join(FORMAT_TIME_MODES)),
+        ("page-size", None, 1000,
+         "Show at most this many (root) events on each page"),
         ]
 
     def parseArgs(self, dumpfile):
@@ -34,6 +41,11 @@ class WebViewerOptions(usage.Options):
                                    ", ".join(FORMAT_TIME_MODES))
         self["timestamps"] = arg
 
+    def opt_page_size(self, arg):
+        self["page-size"] = int(arg)
+        if self["page-size"] < 1:
+            raise usage.UsageError("--page-size= must be at least 1")
+
 FLOG_CSS = """
 span.MODELINE {
  font-size: 60%;
@@ -138,7 +150,9 @@ class Welcome(resource.Resource):
                     data += " <li>Incident Triggers:\n"
                     data += "  <ul>\n"
                     for t in self.viewer.triggers:
-                        le = self.viewer.number_map[t]
+                        le = self.viewer.get_event_by_number(t)
+                        if le is None:
+                            continue
                         data += "   <li>"
                         href_base = "/all-events?timestamps=%s" % timestamps
                         data += le.to_html(href_base, timestamps)
@@ -160,6 +174,40 @@ class Welcome(resource.Resource):
         req.setHeader("content-type", "text/html")
         return data
 
+def get_arg(req, name, default=None, convert=str):
+    try:
+        return convert(req.args[name][0])
+    except (KeyError, IndexError, ValueError):
+        return default
+
+def paginate(url, page, page_size, total):
+    """Return the (start, end) of the given page, and some HTML that links
+    to the other pages. 'url' must already have a query string."""
+    num_pages = max(1, (total + page_size - 1) // page_size)
+    page = min(max(page, 0), num_pages-1)
+    start = page * page_size
+    end = min(start + page_size, total)
+    if num_pages == 1:
+        return start, end, ""
+    links = []
+    if page > 0:
+        links.append('<a href="%s&page=0">first</a>' % url)
+        links.append('<a href="%s&page=%d">previous</a>' % (url, page-1))
+    if page < num_pages-1:
+        links.append('<a href="%s&page=%d">next</a>' % (url, page+1))
+        links.append('<a href="%s&page=%d">last</a>' % (url, num_pages-1))
+    pager = ('<div>page %d of %d (events %d-%d of %d): %s</div>\n'
+             % (page+1, num_pages, start+1, end, total, " ".join(links)))
+    return start, end, pager
+
+def in_window(when, after, before):
+    # like 'flogtool filter', both ends are exclusive
+    if after is not None and when <= after:
+        return False
+    if before is not None and when >= before:
+        return False
+    return True
+
 class Summary(resource.Resource):
     def __init__(self, viewer):
         self._viewer = viewer
@@ -172,13 +220,14 @@ class Summary(resource.Resource):
             (first, last, num_events, levels,
              pid, versions) = self._viewer.summaries[lf]
             events = levels[levelnum]
-            return SummaryView(events, levelnum)
+            return SummaryView(events, levelnum, self._viewer.page_size)
         return resource.Resource.getChild(self, path, req)
 
 class SummaryView(resource.Resource):
-    def __init__(self, events, levelnum):
+    def __init__(self, events, levelnum, page_size):
         self._events = events
         self._levelnum = levelnum
+        self._page_size = page_size
         resource.Resource.__init__(self)
 
     def render(self, req):
@@ -189,10 +238,14 @@ class SummaryView(resource.Resource):
         data += "<body>\n"
         data += "<h1>Events at level %d</h1>\n" % self._levelnum
 
+        (start, end, pager) = paginate("?", get_arg(req, "page", 0, int),
+                                       self._page_size, len(self._events))
+        data += pager
         data += "<ul>\n"
-        for e in self._events:
+        for e in self._events[start:end]:
             data += "<li>" + e.to_html("/all-events") + "</li>\n"
         data += "</ul>\n"
+        data += pager
         data += "</body>\n"
         data += "</html>\n"
         return data
@@ -207,6 +260,13 @@ class EventView(resource.Resource):
     def render(self, req):
         sortby = req.args.get("sort", ["nested"])[0]
         timestamps = req.args.get("timestamps", ["short-local"])[0]
+        after = get_arg(req, "after", None, float)
+        before = get_arg(req, "before", None, float)
+        window = ""
+        if after is not None:
+            window += "&after=%r" % after
+        if before is not None:
+            window += "&before=%r" % before
 
         data = "<html>"
         data += "<head><title>Foolscap Log Viewer</title>\n"
@@ -215,12 +275,13 @@ class EventView(resource.Resource):
         data += "<body>\n"
         data += "<h1>Event Log</h1>\n"
 
-        data += "%d root events " % len(self.viewer.root_events)
+        roots = self.viewer.get_event_list("nested", after, before)
+        data += "%d root events " % len(roots)
 
-        url = "/all-events?sort=%s" % sortby
+        url = "/all-events?sort=%s%s" % (sortby, window)
         other_timestamps = ['<a href="%s&timestamps=short-local">local</a>' % url,
                             '<a href="%s&timestamps=utc">utc</a>' % url]
-        url = "/all-events?timestamps=%s" % timestamps
+        url = "/all-events?timestamps=%s%s" % (timestamps, window)
         other_sortby = ['<a href="%s&sort=nested">nested</a>' % url,
                         '<a href="%s&sort=number">number</a>' % url,
                         '<a href="%s&sort=time">time</a>' % url]
@@ -232,28 +293,31 @@ class EventView(resource.Resource):
                             '</span>\n'])
         data += modeline
 
+        if sortby == "nested":
+            events = roots
+        elif sortby in ("number", "time"):
+            events = self.viewer.get_event_list(sortby, after, before)
+        else:
+            data += "<b>unknown sort argument '%s'</b>\n" % sortby
+            events = []
+        url = "/all-events?sort=%s&timestamps=%s%s" % (sortby, timestamps,
+                                                       window)
+        (start, end, pager) = paginate(url, get_arg(req, "page", 0, int),
+                                       self.viewer.page_size, len(events))
+        data += pager
+
         data += "<ul>\n"
         if sortby == "nested":
-            for e in self.viewer.root_events:
+            for e in events[start:end]:
                 data += self._emit_events(0, e, timestamps)
-        elif sortby == "number":
-            numbers = sorted(self.viewer.number_map.keys())
-            for n in numbers:
-                e = self.viewer.number_map[n]
-                data += '<li><span class="%s">' % e.level_class()
-                data += e.to_html(timestamps=timestamps)
-                data += '</span></li>\n'
-        elif sortby == "time":
-            events = self.viewer.number_map.values()
-            events.sort(lambda a,b: cmp(a.e['d']['time'], b.e['d']['time']))
-            for e in events:
+        else:
+            for e in events[start:end]:
                 data += '<li><span class="%s">' % e.level_class()
                 data += e.to_html(timestamps=timestamps)
                 data += '</span></li>\n'
-        else:
-            data += "<b>unknown sort argument '%s'</b>\n" % sortby
 
         data += "</ul>\n"
+        data += pager
         req.setHeader("content-type", "text/html")
         return data
 
@@ -331,6 +395,256 @@ class LogEvent:
             data += " [INCIDENT-TRIGGER]"
         return data
 
+class IndexedEvents:
+    """A read-only sequence of LogEvents, given an EventIndex and the
+    positions of the events in it. Each event is read from disk when it is
+    accessed, and slicing gives another IndexedEvents."""
+
+    def __init__(self, index, positions):
+        self.index = index
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return IndexedEvents(self.index, self.positions[i])
+        return self.index.get_event(self.positions[i])
+
+    def __iter__(self):
+        for pos in self.positions:
+            yield self.index.get_event(pos)
+
+class _SortedTimes:
+    # the times of some events, in the order given by 'positions', so that
+    # bisect can search them
+    def __init__(self, times, positions):
+        self.times = times
+        self.positions = positions
+    def __len__(self):
+        return len(self.positions)
+    def __getitem__(self, i):
+        return self.times[self.positions[i]]
+
+class EventIndex:
+    """I let the web-viewer find the events in some .flog files without
+    holding them in memory. I read the files once, and record a handful of
+    numbers for each event in arrays: where the event lives on disk, its
+    time, level, and event number, and its place in the parent/child tree.
+    Events are read back (and turned into LogEvents) only when a page that
+    shows them is rendered. The orderings by event number and by time are
+    computed the first time they are asked for.
+
+    Seeking in a .bz2 file means decompressing everything in front of the
+    target, so those are decompressed into a temporary file first."""
+
+    def __init__(self, logfiles):
+        self.readers = []
+        # one entry per event, and an event's 'position' indexes them all
+        self.files = array('B')
+        self.offsets = array('d') # exact up to 2**53
+        self.subs = array('i')
+        self.times = array('d')
+        self.tubs = array('H')
+        self.nums = array('l')
+        self.first_child = array('i')
+        self.last_child = array('i')
+        self.next_sibling = array('i')
+        self.roots = array('i')
+        # 'from' tubids, and where each one's events are, by number. Each
+        # tub gets a list of runs of increasing event numbers, which start
+        # over when an application is restarted.
+        self.tubids = []
+        self._tub_numbers = {}
+        self._runs = []
+        self.trigger_positions = {}
+        self.summaries = {}
+        self._by_number = None
+        self._by_time = None
+
+        trigger_numbers = []
+        first_event_from = None
+        for (filenum, lf) in enumerate(logfiles):
+            f = self._open(lf)
+            reader = flogfile.FlogReader(f)
+            self.readers.append(reader)
+            first = self._scan(filenum, lf, reader, trigger_numbers)
+            if first_event_from is None:
+                first_event_from = first
+        self.triggers = [(first_event_from, num) for num in trigger_numbers]
+
+    def _open(self, fn):
+        if not fn.endswith(".bz2"):
+            return open(fn, "rb")
+        f = tempfile.TemporaryFile()
+        src = bz2.BZ2File(fn, "r")
+        try:
+            shutil.copyfileobj(src, f)
+        finally:
+            src.close()
+        f.seek(0)
+        return f
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+        self.readers = []
+
+    def _scan(self, filenum, lf, reader, trigger_numbers):
+        (first_event_time, last_event_time) = (None, None)
+        first_event_from = None
+        num_events = 0
+        levels = {}
+        pid = None
+        versions = {}
+        try:
+            for (location, e) in reader.get_located_events():
+                if "header" in e:
+                    h = e["header"]
+                    if h["type"] == "incident":
+                        trigger_numbers.append(h["trigger"]["num"])
+                    pid = h.get("pid")
+                    versions = h.get("versions", {})
+                if "d" not in e:
+                    continue # skip headers
+                d = e['d']
+                if first_event_from is None:
+                    first_event_from = e['from']
+                pos = self._add(filenum, location, e)
+                number = d.get("num", None)
+                if number is not None and number in trigger_numbers:
+                    self.trigger_positions[pos] = True
+
+                when = d.get("time")
+                if when is not None:
+                    if first_event_time is None or when < first_event_time:
+                        first_event_time = when
+                    if last_event_time is None or when > last_event_time:
+                        last_event_time = when
+                num_events += 1
+                level = d.get("level", log.OPERATIONAL)
+                if level not in levels:
+                    levels[level] = array('i')
+                levels[level].append(pos)
+        except ValueError, ex:
+            print "truncated pickle file? (%s): %s" % (lf, ex)
+
+        for level in levels:
+            levels[level] = IndexedEvents(self, levels[level])
+        self.summaries[lf] = ( (None, first_event_time),
+                               (None, last_event_time),
+                               num_events, levels, pid, versions )
+        return first_event_from
+
+    def _add(self, filenum, location, e):
+        d = e['d']
+        pos = len(self.offsets)
+        tubid = e['from']
+        tub = self._tub_numbers.get(tubid)
+        if tub is None:
+            tub = self._tub_numbers[tubid] = len(self.tubids)
+            self.tubids.append(tubid)
+            self._runs.append([])
+        (offset, sub) = location
+        self.files.append(filenum)
+        self.offsets.append(offset)
+        self.subs.append(sub)
+        self.times.append(d.get("time", 0.0))
+        self.tubs.append(tub)
+        num = d.get("num", -1)
+        self.nums.append(num)
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        self.next_sibling.append(-1)
+
+        parent = -1
+        if "parent" in d:
+            parent = self._find(tub, d["parent"])
+        if parent == -1:
+            self.roots.append(pos)
+        elif self.first_child[parent] == -1:
+            self.first_child[parent] = self.last_child[parent] = pos
+        else:
+            self.next_sibling[self.last_child[parent]] = pos
+            self.last_child[parent] = pos
+
+        if num != -1:
+            runs = self._runs[tub]
+            if runs and num > runs[-1][0][-1]:
+                runs[-1][0].append(num)
+                runs[-1][1].append(pos)
+            else:
+                runs.append((array('l', [num]), array('i', [pos])))
+        return pos
+
+    def _find(self, tub, num):
+        # the most recent event from this tub with the given number
+        runs = self._runs[tub]
+        for i in range(len(runs)-1, -1, -1):
+            (nums, positions) = runs[i]
+            j = bisect_left(nums, num)
+            if j < len(nums) and nums[j] == num:
+                return positions[j]
+        return -1
+
+    def get_event(self, pos):
+        reader = self.readers[self.files[pos]]
+        e = reader.get_event_at((int(self.offsets[pos]), self.subs[pos]))
+        le = LogEvent(e)
+        le.is_trigger = pos in self.trigger_positions
+        children = []
+        child = self.first_child[pos]
+        while child != -1:
+            children.append(child)
+            child = self.next_sibling[child]
+        if children:
+            le.children = IndexedEvents(self, children)
+        return le
+
+    def get_event_by_number(self, index):
+        (tubid, num) = index
+        tub = self._tub_numbers.get(tubid)
+        if tub is None:
+            return None
+        pos = self._find(tub, num)
+        if pos == -1:
+            return None
+        return self.get_event(pos)
+
+    def get_event_list(self, sortby, after=None, before=None):
+        if sortby == "time":
+            if self._by_time is None:
+                self._by_time = array('i', sorted(xrange(len(self.times)),
+                                                  key=self.times.__getitem__))
+            positions = self._by_time
+            if after is not None or before is not None:
+                times = _SortedTimes(self.times, positions)
+                start = 0
+                if after is not None:
+                    start = bisect_right(times, after)
+                end = len(positions)
+                if before is not None:
+                    end = bisect_left(times, before)
+                positions = positions[start:end]
+            return IndexedEvents(self, positions)
+        if sortby == "nested":
+            positions = self.roots
+        else:
+            if self._by_number is None:
+                key = lambda pos: (self.tubids[self.tubs[pos]],
+                                   self.nums[pos])
+                positions = [pos for pos in xrange(len(self.nums))
+                             if self.nums[pos] != -1]
+                positions.sort(key=key)
+                self._by_number = array('i', positions)
+            positions = self._by_number
+        if after is not None or before is not None:
+            positions = array('i', [pos for pos in positions
+                                    if in_window(self.times[pos],
+                                                 after, before)])
+        return IndexedEvents(self, positions)
+
 class Reload(resource.Resource):
 
     def __init__(self, viewer):
@@ -343,6 +657,9 @@ class Reload(resource.Resource):
         return ''
 
 class WebViewer:
+    index = None # an EventIndex, in streaming mode
+    streaming = False
+    page_size = 1000
 
     def run(self, options):
         d = fireEventually(options)
@@ -374,6 +691,8 @@ class WebViewer:
 
         if not options["quiet"]:
             print "scanning.."
+        self.streaming = bool(options["streaming"])
+        self.page_size = int(options["page-size"])
         self.logfiles = [options.dumpfile]
         self.load_logfiles()
 
@@ -388,11 +707,47 @@ class WebViewer:
 
     def load_logfiles(self):
         #self.summary = {} # keyed by logfile name
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        if self.streaming:
+            self.index = EventIndex(self.logfiles)
+            self.summaries = self.index.summaries
+            self.root_events = self.index.get_event_list("nested")
+            self.number_map = None
+            self.triggers = self.index.triggers
+            return
         (self.summaries,
          self.root_events,
          self.number_map,
          self.triggers) = self.process_logfiles(self.logfiles)
 
+    def get_event_by_number(self, index):
+        # index is a (from, num) tuple. Returns a LogEvent, or None.
+        if self.index is not None:
+            return self.index.get_event_by_number(index)
+        return self.number_map.get(index)
+
+    def get_event_list(self, sortby, after=None, before=None):
+        """Return a sequence of LogEvents: the root events (for 'nested'),
+        or all the events sorted by 'number' or 'time'. If after= or
+        before= is given, only the events in that time window are
+        included."""
+        if self.index is not None:
+            return self.index.get_event_list(sortby, after, before)
+        if sortby == "nested":
+            events = self.root_events
+        elif sortby == "number":
+            numbers = sorted(self.number_map.keys())
+            events = [self.number_map[n] for n in numbers]
+        else:
+            events = self.number_map.values()
+            events.sort(lambda a,b: cmp(a.e['d']['time'], b.e['d']['time']))
+        if after is not None or before is not None:
+            events = [e for e in events
+                      if in_window(e.e['d']['time'], after, before)]
+        return events
+
     def process_logfiles(self, logfiles):
         summaries = {}
         # build up a tree of events based upon parent/child relationships
@@ -407,6 +762,7 @@ class WebViewer:
             num_events = 0
             levels = {}
             pid = None
+            versions = {}
 
             for e in self.get_events(lf):
                 if "header" in e:
@@ -474,18 +830,9 @@ class WebViewer:
         return summaries, roots, number_map, triggers
 
     def get_events(self, fn):
-        if fn.endswith(".bz2"):
-            import bz2
-            f = bz2.BZ2File(fn, "r")
-        else:
-            f = open(fn, "rb")
-        while True:
-            try:
-                e = pickle.load(f)
+        try:
+            for e in flogfile.get_events(fn):
                 yield e
-            except EOFError:
-                break
-            except ValueError, ex:
-                print "truncated pickle file? (%s): %s" % (fn, ex)
-                break
+        except ValueError, ex:
+            print "truncated pickle file? (%s): %s" % (fn, ex)
 
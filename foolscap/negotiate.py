@@ -51,6 +51,10 @@ PLAINTEXT, ENCRYPTED, DECIDING, BANANA, ABANDONED = range(5)
 #  2 (0.1.1): no changes to offer or decision
 #             reqID=0 was commandeered for use by callRemoteOnly()
 #  3 (0.1.3): added PING and PONG tokens
+#  4 (0.6.5): top-level (add-vocab) sequences are accepted by the Broker
+#  5 (0.6.5): RIBroker.decref_batch is available
+#  6 (0.6.5): top-level (batch) sequences carry several calls and answers
+#  7 (0.6.5): added the LANE token, to interleave several outbound lanes
 
 class Negotiation(protocol.Protocol):
     """This is the first protocol to speak over the wire. It is responsible
@@ -156,7 +160,7 @@ class Negotiation(protocol.Protocol):
     forceNegotiation = None
 
     minVersion = 3
-    maxVersion = 3
+    maxVersion = 7
 
     brokerClass = broker.Broker
 
@@ -633,6 +637,16 @@ class Negotiation(protocol.Protocol):
                     self.theirCertificate = them
             except crypto.CertificateError:
                 pass
+            if self.tub:
+                # only remember the session for the client side of a
+                # connection to the Tub we asked for
+                tubID = None
+                if self.isClient and self.theirCertificate:
+                    digest = self.theirCertificate.digest("sha1")
+                    if crypto.digest32(digest) == self.target.getTubID():
+                        tubID = self.target.getTubID()
+                self.tub.tlsHandshakeCompleted(tubID,
+                                               self.transport.getHandle())
 
         hello = self.parseLines(header)
         if hello.has_key("error"):
@@ -862,6 +876,27 @@ class Negotiation(protocol.Protocol):
         # changes were made to the offer or decision blocks.
         return self.evaluateNegotiationVersion1(offer)
 
+    def evaluateNegotiationVersion4(self, offer):
+        # version 4 allows either side to send top-level (add-vocab)
+        # sequences, for adaptive VOCAB compression. No changes were made to
+        # the offer or decision blocks.
+        return self.evaluateNegotiationVersion1(offer)
+
+    def evaluateNegotiationVersion5(self, offer):
+        # version 5 adds the decref_batch method to RIBroker. No changes
+        # were made to the offer or decision blocks.
+        return self.evaluateNegotiationVersion1(offer)
+
+    def evaluateNegotiationVersion6(self, offer):
+        # version 6 lets the Broker accept (batch) sequences. No changes
+        # were made to the offer or decision blocks.
+        return self.evaluateNegotiationVersion1(offer)
+
+    def evaluateNegotiationVersion7(self, offer):
+        # version 7 adds the LANE token. No changes were made to the offer
+        # or decision blocks.
+        return self.evaluateNegotiationVersion1(offer)
+
     def compareOfferAndExisting(self, offer, existing, lp):
         """Compare the new offer against the existing connection, and
         decide which to keep.
@@ -1107,6 +1142,25 @@ class Negotiation(protocol.Protocol):
         # function
         return self.acceptDecisionVersion1(decision)
 
+    def acceptDecisionVersion4(self, decision):
+        # this adds top-level add-vocab sequences, so we can use the same
+        # accept function
+        return self.acceptDecisionVersion1(decision)
+
+    def acceptDecisionVersion5(self, decision):
+        # this adds RIBroker.decref_batch, so we can use the same accept
+        # function
+        return self.acceptDecisionVersion1(decision)
+
+    def acceptDecisionVersion6(self, decision):
+        # this adds the (batch) sequence, so we can use the same accept
+        # function
+        return self.acceptDecisionVersion1(decision)
+
+    def acceptDecisionVersion7(self, decision):
+        # this adds the LANE token, so we can use the same accept function
+        return self.acceptDecisionVersion1(decision)
+
     def loopbackDecision(self):
         # if we were talking to ourselves, what negotiation decision would we
         # reach? This is used for loopback connections
@@ -1131,6 +1185,15 @@ class Negotiation(protocol.Protocol):
         # certificate from the client, but do not verify it against a list of
         # root CAs
         self.log("startTLS, client=%s" % self.isClient)
+        if self.tub and cert is self.tub.myCertificate:
+            # share the Tub's context, and offer the last session we had
+            # with this peer
+            opts = self.tub.getTLSOptions(self.isClient)
+            if self.isClient:
+                session = self.tub.getTLSSession(self.target.getTubID())
+                opts = crypto.ResumingOptions(opts, session)
+            self.transport.startTLS(opts)
+            return
         kwargs = {}
         if cert:
             kwargs['privateKey'] = cert.privateKey.original
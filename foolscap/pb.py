@@ -331,6 +331,16 @@ class Tub(service.MultiService):
 
         self._handle_old_duplicate_connections = False
         self._expose_remote_exception_types = True
+        self._adaptive_vocab = None
+
+        # TLS contexts are built once per side (see getTLSOptions), and we
+        # remember the last session we had with each peer so the next
+        # connection to them can skip most of the handshake
+        self._tlsOptions = {} # maps isClient to crypto.MyOptions
+        self._tlsSessions = {} # maps tubID to an SSL session
+        self._tlsStats = {"full-handshakes": 0,
+                          "resumed-handshakes": 0,
+                          }
 
     def setOption(self, name, value):
         if name == "logLocalFailures":
@@ -377,6 +387,28 @@ class Tub(service.MultiService):
             self._handle_old_duplicate_connections = int(value)
         elif name == "expose-remote-exception-types":
             self._expose_remote_exception_types = bool(value)
+        elif name == "adaptive-vocab":
+            # add frequently-sent strings (method names, dict keys, copyable
+            # names) to the outbound VOCAB table of each new connection. The
+            # value is a boolean, or a dict with any of 'threshold',
+            # 'tableSize', and 'window' (see Banana.enableVocabLearning).
+            # Only connections to peers that negotiate banana version 4 or
+            # later are affected.
+            if value is True:
+                value = {}
+            elif not value:
+                value = None
+            else:
+                value = dict(value)
+                for key in value:
+                    if key not in ("threshold", "tableSize", "window"):
+                        raise KeyError("unknown adaptive-vocab parameter '%s'"
+                                       % key)
+                limit = broker.Broker.incomingVocabTableSizeLimit
+                if value.get("tableSize", 0) > limit:
+                    raise ValueError("adaptive-vocab tableSize must not "
+                                     "exceed %d" % limit)
+            self._adaptive_vocab = value
         else:
             raise KeyError("unknown option name '%s'" % name)
 
@@ -480,6 +512,42 @@ class Tub(service.MultiService):
 
         return cert
 
+    def getTLSOptions(self, isClient):
+        """Return the context factory to use for the client or server side
+        of a TLS connection. There is one of each per Tub, so connections
+        share an SSL.Context and its session cache."""
+        opts = self._tlsOptions.get(isClient)
+        if opts is None:
+            kwargs = {}
+            cert = self.myCertificate
+            if cert:
+                kwargs['privateKey'] = cert.privateKey.original
+                kwargs['certificate'] = cert.original
+            opts = crypto.MyOptions(**kwargs)
+            self._tlsOptions[isClient] = opts
+        return opts
+
+    def getTLSSession(self, tubID):
+        return self._tlsSessions.get(tubID)
+
+    def tlsHandshakeCompleted(self, tubID, conn):
+        # called by the Negotiation once the peer's Hello has arrived over
+        # TLS, at which point the handshake has finished. tubID is set when
+        # we were the client, and the server proved to be that Tub.
+        reused = crypto.sessionWasReused(conn)
+        if reused is True:
+            self._tlsStats["resumed-handshakes"] += 1
+        elif reused is False:
+            self._tlsStats["full-handshakes"] += 1
+        if tubID:
+            self._tlsSessions[tubID] = conn.get_session()
+
+    def getTLSStats(self):
+        """Return a dictionary that counts the TLS handshakes this Tub has
+        completed: 'full-handshakes' and 'resumed-handshakes'. Handshakes
+        whose outcome pyOpenSSL cannot report are not counted."""
+        return self._tlsStats.copy()
+
     def getCertData(self):
         # the string returned by this method can be used as the certData=
         # argument to create a new Tub with the same identity. TODO: actually
@@ -1080,7 +1148,7 @@ class Tub(service.MultiService):
                        + [("unauth",broker)
                           for broker in self.unauthenticatedBrokers])
         for tubref,broker in all_brokers:
-            inbound = broker.inboundDeliveryQueue[:]
+            inbound = list(broker.inboundDeliveryQueue)
             outbound = [pr
                         for (reqID, pr) in
                         sorted(broker.waitingForAnswers.items()) ]
@@ -423,9 +423,95 @@ class RemoteReference(RemoteReferenceOnly):
         del d
         return None
 
+    def getMethod(self, _name):
+        """Return a callable which invokes the given remote method, like
+        callRemote(_name, ...) but without looking up the method's schema
+        each time. It accepts _priority= and _callOnly= (which makes it
+        behave like callRemoteOnly). It always uses the RemoteInterface's
+        constraints, so _useSchema=, _resultConstraint=, and
+        _methodConstraint= raise TypeError."""
+        # this raises Violation right away if the interface doesn't have
+        # such a method
+        (interfaceName,
+         methodName,
+         methodSchema) = self._getMethodInfo(_name)
+        return RemoteMethod(self, interfaceName, methodName, methodSchema)
+
+    def callRemoteMany(self, calls):
+        """Invoke several remote methods at once. 'calls' is a sequence of
+        (methname, args, kwargs) tuples, and I return a list with one
+        Deferred for each, which behaves just like the one callRemote would
+        have returned. The calls are delivered in order. If the far end
+        understands it, they are all sent in a single (batch) sequence.
+
+        A call with a bad method name or arguments fails only its own
+        Deferred, and the rest are still sent. Calls with different
+        _priority= arguments go out in separate batches, one per lane."""
+        broker = self.tracker.broker
+        if not broker._banana_decision_version >= 6:
+            # older peers only know how to take one call at a time
+            return [self.callRemote(name, *args, **kwargs)
+                    for (name, args, kwargs) in calls]
+        results = []
+        batches = {} # maps priority to a list of (slicer, onFailure)
+        for (name, args, kwargs) in calls:
+            try:
+                (req, slicer, callOnly,
+                 priority) = self._prepareCall(broker, name, tuple(args),
+                                               dict(kwargs))
+                if req and not callOnly:
+                    broker.addRequest(req)
+            except:
+                results.append(defer.fail())
+                continue
+            if req is None:
+                # a callOnly to a broker that has gone away
+                results.append(defer.succeed(None))
+            elif callOnly:
+                results.append(defer.succeed(None))
+                batches.setdefault(priority, []).append((slicer, None))
+            else:
+                results.append(req.deferred)
+                batches.setdefault(priority, []).append((slicer, req.fail))
+        priorities = batches.keys()
+        priorities.sort()
+        for priority in priorities:
+            self._sendBatch(broker, batches[priority], priority)
+        return results
+
+    def _sendBatch(self, broker, batch, priority):
+        # any call that cannot be serialized is failed by the BatchSlicer,
+        # and the rest of the batch is still sent. If the whole batch fails,
+        # fail everything that is still waiting (PendingRequest.fail ignores
+        # requests that already finished).
+        def _failAll(f):
+            for (child, fail) in batch:
+                if fail:
+                    fail(f)
+        if len(batch) == 1:
+            obj = batch[0][0] # a batch of one is just a call
+        else:
+            obj = call.BatchSlicer(batch)
+        try:
+            d = broker.send(obj, priority)
+            d.addErrback(_failAll)
+        except:
+            _failAll(failure.Failure())
+
     def _callRemote(self, _name, *args, **kwargs):
-        req = None
         broker = self.tracker.broker
+        (req, slicer, callOnly, priority) = self._prepareCall(broker, _name,
+                                                              args, kwargs)
+        if req is None:
+            # DeadReferenceError is silently consumed
+            return
+        return self._sendRequest(broker, req, slicer, callOnly, priority)
+
+    def _prepareCall(self, broker, _name, args, kwargs):
+        # validate a call and build the PendingRequest and CallSlicer for
+        # it, without committing to sending anything. If this is a callOnly
+        # to a broker that has already gone away, req will be None.
+        req = None
 
         # remember that "none" is not a valid constraint, so we use it to
         # mean "not set by the caller", which means we fall back to whatever
@@ -435,6 +521,7 @@ class RemoteReference(RemoteReferenceOnly):
         resultConstraint = kwargs.get("_resultConstraint", "none")
         useSchema = kwargs.get("_useSchema", True)
         callOnly = kwargs.get("_callOnly", False)
+        priority = kwargs.get("_priority", ipb.PRIORITY_NORMAL)
 
         if "_methodConstraint" in kwargs:
             del kwargs["_methodConstraint"]
@@ -444,11 +531,12 @@ class RemoteReference(RemoteReferenceOnly):
             del kwargs["_useSchema"]
         if "_callOnly" in kwargs:
             del kwargs["_callOnly"]
+        if "_priority" in kwargs:
+            del kwargs["_priority"]
 
         if callOnly:
             if broker.disconnected:
-                # DeadReferenceError is silently consumed
-                return
+                return (None, None, True, priority)
             reqID = 0
         else:
             # newRequestID() could fail with a DeadReferenceError
@@ -497,7 +585,10 @@ class RemoteReference(RemoteReferenceOnly):
 
         clid = self.tracker.clid
         slicer = call.CallSlicer(reqID, clid, methodName, args, kwargs)
+        return (req, slicer, callOnly, priority)
 
+    def _sendRequest(self, broker, req, slicer, callOnly=False,
+                     priority=ipb.PRIORITY_NORMAL):
         # up to this point, we are not committed to sending anything to the
         # far end. The various phases of commitment are:
 
@@ -534,7 +625,7 @@ class RemoteReference(RemoteReferenceOnly):
 
         try:
             # commitment point 2
-            d = broker.send(slicer)
+            d = broker.send(slicer, priority)
             # d will fire when the last argument has been serialized. It will
             # errback if the arguments (or any of their children) could not
             # be serialized. We need to catch this case and errback the
@@ -581,6 +672,76 @@ class RemoteReference(RemoteReferenceOnly):
         return interfaceName, methodName, methodSchema
 
 
+class RemoteMethod(object):
+    """I am a remote method of a RemoteReference, as returned by
+    rref.getMethod(name). Calling me is the same as calling
+    rref.callRemote(name, *args, **kwargs), except that the method's
+    schema was only looked up once, when I was created. Like callRemote, I
+    always return a Deferred, unless I am called with _callOnly=True, in
+    which case I behave like callRemoteOnly and return None. Once the
+    connection has been lost, I fail with DeadReferenceError."""
+
+    # callRemote options that a handle cannot honour, because its
+    # constraints were fixed when it was created
+    unsupportedOptions = ("_useSchema", "_resultConstraint",
+                          "_methodConstraint")
+
+    def __init__(self, rref, interfaceName, methodName, methodSchema):
+        self.rref = rref
+        self.broker = rref.tracker.broker
+        self.clid = rref.tracker.clid
+        self.interfaceName = interfaceName
+        self.methodName = methodName
+        self.methodSchema = methodSchema
+        self.responseConstraint = None
+        if methodSchema:
+            self.responseConstraint = methodSchema.getResponseConstraint()
+
+    def __repr__(self):
+        return "<RemoteMethod %s of %r>" % (self.methodName, self.rref)
+
+    def __call__(self, *args, **kwargs):
+        for name in self.unsupportedOptions:
+            if name in kwargs:
+                raise TypeError("%s() does not accept %s= when called "
+                                "through getMethod()"
+                                % (self.methodName, name))
+        if kwargs.pop("_callOnly", False):
+            # like callRemoteOnly: there is no response, and errors (other
+            # than schema violations) are silently consumed
+            d = defer.maybeDeferred(self._call, args, kwargs, True)
+            del d
+            return None
+        return defer.maybeDeferred(self._call, args, kwargs)
+
+    def _call(self, args, kwargs, callOnly=False):
+        priority = kwargs.pop("_priority", ipb.PRIORITY_NORMAL)
+        if callOnly:
+            if self.broker.disconnected:
+                return None
+            reqID = 0
+        else:
+            # newRequestID() could fail with a DeadReferenceError
+            reqID = self.broker.newRequestID()
+        if self.methodSchema:
+            try:
+                self.methodSchema.checkAllArgs(args, kwargs, False)
+            except Violation, v:
+                v.setLocation("%s.%s(%s)" % (self.interfaceName,
+                                             self.methodName,
+                                             v.getLocation()))
+                raise
+        req = call.PendingRequest(reqID, self.rref, self.interfaceName,
+                                  self.methodName)
+        req.interfaceName = self.interfaceName
+        req.methodName = self.methodName
+        req.setConstraint(self.responseConstraint)
+        slicer = call.CallSlicer(reqID, self.clid, self.methodName,
+                                 args, kwargs)
+        return self.rref._sendRequest(self.broker, req, slicer, callOnly,
+                                      priority)
+
+
 class RemoteMethodReferenceTracker(RemoteReferenceTracker):
     def getRef(self):
         if self.ref is None:
@@ -630,6 +791,15 @@ class LocalReferenceable(object):
         d.addErrback(lambda f: None)
         return None
 
+    def callRemoteMany(self, calls):
+        return [self.callRemote(methname, *args, **kwargs)
+                for (methname, args, kwargs) in calls]
+
+    def getMethod(self, methname):
+        def _call(*args, **kwargs):
+            return self.callRemote(methname, *args, **kwargs)
+        return _call
+
 registerAdapter(LocalReferenceable, ipb.IReferenceable, ipb.IRemoteReference)
 
 
@@ -759,7 +929,8 @@ class TheirReferenceUnslicer(slicer.LeafUnslicer):
         if self.giftID != 0:
             rb = self.broker.remote_broker
             # if we lose the connection, they'll decref the gift anyway
-            rb.callRemoteOnly("decgift", giftID=self.giftID, count=1)
+            rb.callRemoteOnly("decgift", giftID=self.giftID, count=1,
+                              _priority=ipb.PRIORITY_HIGH)
         return rref
 
     def describe(self):
@@ -159,6 +159,7 @@ class RemoteMethodSchema(object):
 
     name = None # method name, set when the RemoteInterface is parsed
     interface = None # points to the RemoteInterface which defines the method
+    _argCheckers = None # set by _compile() on first use
 
     # under development
     def __init__(self, method=None, _response=None, __options=[], **kwargs):
@@ -225,6 +226,22 @@ class RemoteMethodSchema(object):
         self.options = {} # return, wait, reliable, etc
 
 
+    def _compile(self):
+        # build the tables that the per-call checks use, the first time
+        # they are needed: Optional() wrappers are removed, and constraints
+        # which accept everything (like Any) are skipped entirely
+        self._argPositions = {}
+        for i, argname in enumerate(self.argumentNames):
+            self._argPositions[argname] = i
+        self._requiredArgs = tuple(self.required)
+        self._resultChecker = getChecker(self.responseConstraint)
+        checkers = {}
+        for argname, c in self.argConstraints.items():
+            if isinstance(c, Optional):
+                c = c.constraint
+            checkers[argname] = getChecker(c)
+        self._argCheckers = checkers
+
     def getPositionalArgConstraint(self, argnum):
         if argnum >= len(self.argumentNames):
             raise Violation("too many positional arguments: %d >= %d" %
@@ -238,11 +255,10 @@ class RemoteMethodSchema(object):
 
     def getKeywordArgConstraint(self, argname,
                                 num_posargs=0, previous_kwargs=[]):
-        previous_args = self.argumentNames[:num_posargs]
-        for pkw in previous_kwargs:
-            assert pkw not in previous_args
-            previous_args.append(pkw)
-        if argname in previous_args:
+        if self._argCheckers is None:
+            self._compile()
+        if (argname in previous_kwargs
+            or self._argPositions.get(argname, num_posargs) < num_posargs):
             raise Violation("got multiple values for keyword argument '%s'"
                             % (argname,))
         c = self.argConstraints.get(argname)
@@ -260,41 +276,67 @@ class RemoteMethodSchema(object):
     def getResponseConstraint(self):
         return self.responseConstraint
 
-    def checkAllArgs(self, args, kwargs, inbound):
-        # first we map the positional arguments
-        allargs = {}
-        if len(args) > len(self.argumentNames):
+    def checkAllArgs(self, args, kwargs, inbound, validated=()):
+        if self._argCheckers is None:
+            self._compile()
+        checkers = self._argCheckers
+        positions = self._argPositions
+        names = self.argumentNames
+        numargs = len(args)
+        if numargs > len(names):
             raise Violation("method takes %d positional arguments (%d given)"
-                            % (len(self.argumentNames), len(args)))
-        for i,argvalue in enumerate(args):
-            allargs[self.argumentNames[i]] = argvalue
-        for argname,argvalue in kwargs.items():
-            if argname in allargs:
+                            % (len(names), numargs))
+        for argname in kwargs:
+            if positions.get(argname, numargs) < numargs:
                 raise Violation("got multiple values for keyword argument '%s'"
                                 % (argname,))
-            allargs[argname] = argvalue
-
-        for argname, argvalue in allargs.items():
-            accept, constraint = self.getKeywordArgConstraint(argname)
-            if not accept:
-                # this argument will be ignored by the far end. TODO: emit a
-                # warning
-                pass
-            try:
-                constraint.checkObject(argvalue, inbound)
-            except Violation, v:
-                v.setLocation("%s=" % argname)
-                raise
-
-        for argname in self.required:
-            if argname not in allargs:
+
+        for i in range(numargs):
+            checker = checkers[names[i]]
+            if checker and i not in validated:
+                try:
+                    checker(args[i], inbound)
+                except Violation, v:
+                    v.setLocation("%s=" % names[i])
+                    raise
+        for argname, argvalue in kwargs.items():
+            if argname in checkers:
+                checker = checkers[argname]
+            elif self.ignoreUnknown or self.acceptUnknown:
+                # the far end will ignore this argument, or pass it through
+                # unchecked. TODO: emit a warning for ignored arguments
+                continue
+            else:
+                raise Violation("unknown argument '%s'" % argname)
+            if checker and argname not in validated:
+                try:
+                    checker(argvalue, inbound)
+                except Violation, v:
+                    v.setLocation("%s=" % argname)
+                    raise
+
+        for argname in self._requiredArgs:
+            if argname not in kwargs and positions[argname] >= numargs:
                 raise Violation("missing required argument '%s'" % argname)
 
     def checkResults(self, results, inbound):
-        if self.responseConstraint:
+        if self._argCheckers is None:
+            self._compile()
+        if self._resultChecker:
             # this might raise a Violation. The caller will annotate its
             # location appropriately: they have more information than we do.
-            self.responseConstraint.checkObject(results, inbound)
+            self._resultChecker(results, inbound)
+
+def getChecker(constraint):
+    """Return the constraint's checkObject method, or None if it would
+    accept any object (because the constraint does not override
+    Constraint.checkObject)."""
+    if constraint is None:
+        return None
+    checkObject = getattr(constraint.__class__, "checkObject", None)
+    if getattr(checkObject, "im_func", None) is Constraint.checkObject.im_func:
+        return None
+    return constraint.checkObject
 
 class UnconstrainedMethod(object):
     """I am a method constraint that accepts any arguments and any return
@@ -314,7 +356,7 @@ class UnconstrainedMethod(object):
     def getKeywordArgConstraint(self, argname, num_posargs=0,
                                 previous_kwargs=[]):
         return (True, Any())
-    def checkAllArgs(self, args, kwargs, inbound):
+    def checkAllArgs(self, args, kwargs, inbound, validated=()):
         pass # accept everything
     def getResponseConstraint(self):
         return Any()
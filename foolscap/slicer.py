@@ -1,6 +1,6 @@
 # -*- test-case-name: foolscap.test.test_banana -*-
 
-from twisted.python.components import registerAdapter
+from twisted.python.components import registerAdapter, globalRegistry
 from twisted.python import log
 from zope.interface import implements
 from twisted.internet.defer import Deferred
@@ -8,6 +8,35 @@ import tokens
 from tokens import Violation, BananaError
 from foolscap.ipb import IBroker
 
+# RootSlicer.slicerForObject remembers which factory produces the Slicer
+# for each class, so it only has to do adapter lookups the first time it
+# sees a class. This maps class -> (providedBy spec, factory or None). Any
+# code which registers a new ISlicer or ICopyable adapter must call
+# invalidateSlicerCache(): SlicerClass and registerCopier do so. Adapters
+# registered directly through twisted's registerAdapter are caught by
+# checkSlicerCache(), which watches the adapter registry's generation.
+SlicerCache = {}
+_slicerCacheGeneration = [None]
+
+def invalidateSlicerCache():
+    SlicerCache.clear()
+
+def checkSlicerCache():
+    generation = getattr(globalRegistry, "_generation", None)
+    if generation is None or generation != _slicerCacheGeneration[0]:
+        SlicerCache.clear()
+        _slicerCacheGeneration[0] = generation
+
+# the types which Banana.sendPrimitives() can encode without a Slicer. These
+# are exact types: subclasses of int or str may have Slicers of their own.
+PrimitiveTypes = frozenset([int, long, float, str, bool])
+
+def allPrimitive(seq):
+    for i in seq:
+        if type(i) not in PrimitiveTypes:
+            return False
+    return True
+
 class SlicerClass(type):
     # auto-register Slicers
     def __init__(self, name, bases, dict):
@@ -16,6 +45,7 @@ class SlicerClass(type):
         #reg = dict.get('slicerRegistry')
         if typ:
             registerAdapter(self, typ, tokens.ISlicer)
+            invalidateSlicerCache()
 
 
 class BaseSlicer(object):
@@ -56,6 +86,12 @@ class BaseSlicer(object):
             yield t
     def sliceBody(self, streamable, banana):
         raise NotImplementedError
+    def slicePrimitives(self):
+        # Slicers whose body can be a plain sequence of ints, longs, floats,
+        # strs, and bools may return that sequence here (exactly what
+        # sliceBody would yield), and Banana will encode all of it in one
+        # pass. Return None to have sliceBody() used instead.
+        return None
     def childAborted(self, f):
         return f
 
@@ -148,6 +184,11 @@ class BaseUnslicer(object):
     opentype = None
     implements(tokens.IUnslicer)
 
+    # Unslicers which keep their children in a list named .list (and
+    # enforce .maxLength on it) can set this to a constraint's taster, to
+    # let Banana.decodePrimitives() append primitive tokens directly
+    primitiveTaster = None
+
     def __init__(self):
         pass
 
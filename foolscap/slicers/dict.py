@@ -3,7 +3,7 @@
 from twisted.python import log
 from twisted.internet.defer import Deferred
 from foolscap.tokens import Violation, BananaError
-from foolscap.slicer import BaseSlicer, BaseUnslicer
+from foolscap.slicer import BaseSlicer, BaseUnslicer, allPrimitive
 from foolscap.constraint import OpenerConstraint, Any, IConstraint
 from foolscap.util import AsyncAND
 
@@ -16,6 +16,15 @@ class DictSlicer(BaseSlicer):
             yield key
             yield value
 
+    def slicePrimitives(self):
+        body = []
+        for key,value in self.obj.items():
+            body.append(key)
+            body.append(value)
+        if allPrimitive(body):
+            return body
+        return None
+
 class DictUnslicer(BaseUnslicer):
     opentype = ('dict',)
 
@@ -126,6 +135,17 @@ class OrderedDictSlicer(DictSlicer):
             yield key
             yield value
 
+    def slicePrimitives(self):
+        keys = self.obj.keys()
+        keys.sort()
+        body = []
+        for key in keys:
+            body.append(key)
+            body.append(self.obj[key])
+        if allPrimitive(body):
+            return body
+        return None
+
 
 class DictConstraint(OpenerConstraint):
     opentypes = [("dict",)]
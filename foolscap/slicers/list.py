@@ -3,8 +3,9 @@
 from twisted.python import log
 from twisted.internet.defer import Deferred
 from foolscap.tokens import Violation
-from foolscap.slicer import BaseSlicer, BaseUnslicer
-from foolscap.constraint import OpenerConstraint, Any, IConstraint
+from foolscap.slicer import BaseSlicer, BaseUnslicer, allPrimitive
+from foolscap.constraint import OpenerConstraint, Any, IConstraint, \
+     IntegerConstraint, ByteStringConstraint
 from foolscap.util import AsyncAND
 
 
@@ -17,6 +18,11 @@ class ListSlicer(BaseSlicer):
         for i in self.obj:
             yield i
 
+    def slicePrimitives(self):
+        if allPrimitive(self.obj):
+            return self.obj
+        return None
+
 class ListUnslicer(BaseUnslicer):
     opentype = ("list",)
 
@@ -30,6 +36,12 @@ class ListUnslicer(BaseUnslicer):
         assert isinstance(constraint, ListConstraint)
         self.maxLength = constraint.maxLength
         self.itemConstraint = constraint.constraint
+        if (isinstance(self.itemConstraint,
+                       (IntegerConstraint, ByteStringConstraint))
+            and not self.debug):
+            # ListOf(int) and ListOf(str) only need checkToken, so Banana
+            # can decode their items without calling us for each one
+            self.primitiveTaster = self.itemConstraint.taster
 
     def start(self, count):
         #self.opener = foo # could replace it if we wanted to
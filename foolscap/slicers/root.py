@@ -1,28 +1,71 @@
 # -*- test-case-name: foolscap.test.test_banana -*-
 
 import types
-from zope.interface import implements
+from collections import deque
+from zope.interface import implements, providedBy, implementedBy
 from twisted.internet.defer import Deferred
 from foolscap import tokens
 from foolscap.tokens import Violation, BananaError
 from foolscap.slicer import BaseUnslicer, ReferenceSlicer
 from foolscap.slicer import UnslicerRegistry, BananaUnslicerRegistry
+from foolscap.slicer import SlicerCache, checkSlicerCache
 from foolscap.slicers.vocab import ReplaceVocabularyTable, AddToVocabularyTable
 from foolscap import copyable # does this create a cycle?
 from twisted.python import log
+from twisted.python.components import globalRegistry
+
+def _provides(obj):
+    # the object is its own Slicer
+    return obj
+
+class _CopierSlicerFactory:
+    def __init__(self, copier):
+        self.copier = copier
+    def __call__(self, obj):
+        copier = self.copier(obj)
+        if copier:
+            return tokens.ISlicer(copier)
+        return None
+
+class SendLane:
+    """I am one queue of top-level objects waiting to be sent. The objects
+    in a lane are serialized in order, one after another. When the far end
+    accepts LANE tokens, the Banana may switch between lanes at any token
+    boundary, so an object in one lane does not have to wait for a large
+    (or streaming) object in another."""
+
+    objectSentDeferred = None # fires when the current object is done
+    producingDeferred = None # fires when an idle lane gets something to do
+    streamable = True
+    blocked = False # waiting for producingDeferred or a streaming Slicer
+    stack = None # the Banana's slicerStack for this lane
+
+    def __init__(self, number, weight):
+        self.number = number
+        self.weight = weight
+        self.sendQueue = deque() # (obj, objectSentDeferred)
+        # the weighted scheduler charges 1/weight each time it picks us
+        self.virtualTime = 0.0
+
+    def __repr__(self):
+        return "<SendLane %d>" % self.number
 
 class RootSlicer:
     implements(tokens.ISlicer, tokens.IRootSlicer)
 
     streamableInGeneral = True
-    producingDeferred = None
-    objectSentDeferred = None
     slicerTable = {}
     debug = False
 
     def __init__(self, protocol):
         self.protocol = protocol
-        self.sendQueue = []
+        self.lanes = [SendLane(0, 1)]
+        self.lane = self.lanes[0] # the one that the Banana is producing
+
+    def addLane(self, weight):
+        lane = SendLane(len(self.lanes), weight)
+        self.lanes.append(lane)
+        return lane
 
     def allowStreaming(self, streamable):
         self.streamableInGeneral = streamable
@@ -31,10 +74,48 @@ class RootSlicer:
         pass
 
     def slicerForObject(self, obj):
-        # could use a table here if you think it'd be faster than an
-        # adapter lookup
         if self.debug: log.msg("slicerForObject(%s)" % type(obj))
 
+        # most objects are handled by a factory remembered from the last
+        # object of the same class. Objects which declare interfaces of
+        # their own get a different spec, and miss the cache.
+        checkSlicerCache()
+        cls = getattr(obj, "__class__", type(obj))
+        spec = providedBy(obj)
+        cached = SlicerCache.get(cls)
+        if cached is not None and cached[0] is spec:
+            factory = cached[1]
+            if factory:
+                slicer = factory(obj)
+                if slicer:
+                    return slicer
+                # an adapter is allowed to refuse, so do it the slow way
+                return self._slicerForObject(obj)
+        else:
+            factory = self._findSlicerFactory(obj, cls, spec)
+            if factory:
+                return self._slicerForObject(obj)
+
+        return self._slicerFromTable(obj)
+
+    def _findSlicerFactory(self, obj, cls, spec):
+        # figure out which adapter _slicerForObject() will use for 'obj',
+        # and remember it for the other instances of its class. Returns
+        # None if no adapter applies, meaning slicerTable will be used.
+        factory = None
+        if spec.isOrExtends(tokens.ISlicer):
+            factory = _provides
+        else:
+            factory = globalRegistry.lookup1(spec, tokens.ISlicer)
+            if not factory:
+                copier = globalRegistry.lookup1(spec, copyable.ICopyable)
+                if copier:
+                    factory = _CopierSlicerFactory(copier)
+        if spec is implementedBy(cls):
+            SlicerCache[cls] = (spec, factory)
+        return factory
+
+    def _slicerForObject(self, obj):
         # do the adapter lookup first, so that registered adapters override
         # UnsafeSlicerTable's InstanceSlicer
         slicer = tokens.ISlicer(obj, None)
@@ -54,6 +135,9 @@ class RootSlicer:
             s = tokens.ISlicer(copier)
             return s
 
+        return self._slicerFromTable(obj)
+
+    def _slicerFromTable(self, obj):
         slicerFactory = self.slicerTable.get(type(obj))
         if slicerFactory:
             if self.debug: log.msg(" got slicerFactory %s" % slicerFactory)
@@ -70,41 +154,47 @@ class RootSlicer:
     def __iter__(self):
         return self # we are our own iterator
     def next(self):
-        if self.objectSentDeferred:
-            self.objectSentDeferred.callback(None)
-            self.objectSentDeferred = None
-        if self.sendQueue:
-            (obj, self.objectSentDeferred) = self.sendQueue.pop()
-            self.streamable = self.streamableInGeneral
+        # this is called for whichever lane the Banana is producing
+        lane = self.lane
+        if lane.objectSentDeferred:
+            # the object is completely serialized: make sure its bytes have
+            # reached the transport before telling anyone
+            self.protocol.flushOutbound()
+            lane.objectSentDeferred.callback(None)
+            lane.objectSentDeferred = None
+        if lane.sendQueue:
+            (obj, lane.objectSentDeferred) = lane.sendQueue.popleft()
+            self.streamable = lane.streamable = self.streamableInGeneral
             return obj
         if self.protocol.debugSend:
             print "LAST BAG"
-        self.producingDeferred = Deferred()
-        self.streamable = True
-        return self.producingDeferred
+        lane.producingDeferred = Deferred()
+        self.streamable = lane.streamable = True
+        return lane.producingDeferred
 
     def childAborted(self, f):
-        assert self.objectSentDeferred
-        self.objectSentDeferred.errback(f)
-        self.objectSentDeferred = None
+        lane = self.lane
+        assert lane.objectSentDeferred
+        lane.objectSentDeferred.errback(f)
+        lane.objectSentDeferred = None
         return None
 
-    def send(self, obj):
+    def send(self, obj, lane=0):
         # obj can also be a Slicer, say, a CallSlicer. We return a Deferred
-        # which fires when the object has been fully serialized.
-        idle = (len(self.protocol.slicerStack) == 1) and not self.sendQueue
+        # which fires when the object has been fully serialized. If we have
+        # fewer lanes than that, the last one is used.
+        lane = self.lanes[min(lane, len(self.lanes)-1)]
         objectSentDeferred = Deferred()
-        self.sendQueue.append((obj, objectSentDeferred))
-        if idle:
+        lane.sendQueue.append((obj, objectSentDeferred))
+        if lane.producingDeferred:
             # wake up
             if self.protocol.debugSend:
                 print " waking up to send"
-            if self.producingDeferred:
-                d = self.producingDeferred
-                self.producingDeferred = None
-                # TODO: consider reactor.callLater(0, d.callback, None)
-                # I'm not sure it's actually necessary, though
-                d.callback(None)
+            d = lane.producingDeferred
+            lane.producingDeferred = None
+            # TODO: consider reactor.callLater(0, d.callback, None)
+            # I'm not sure it's actually necessary, though
+            d.callback(None)
         return objectSentDeferred
 
     def describe(self):
@@ -112,12 +202,14 @@ class RootSlicer:
 
     def connectionLost(self, why):
         # abandon everything we wanted to send
-        if self.objectSentDeferred:
-            self.objectSentDeferred.errback(why)
-            self.objectSentDeferred = None
-        for obj, d in self.sendQueue:
-            d.errback(why)
-        self.sendQueue = []
+        for lane in self.lanes:
+            if lane.objectSentDeferred:
+                lane.objectSentDeferred.errback(why)
+                lane.objectSentDeferred = None
+            queue = lane.sendQueue
+            lane.sendQueue = deque()
+            for obj, d in queue:
+                d.errback(why)
 
 class ScopedRootSlicer(RootSlicer):
     # this combines RootSlicer with foolscap.slicer.ScopedSlicer . The funny
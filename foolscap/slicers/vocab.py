@@ -16,6 +16,9 @@ class ReplaceVocabSlicer(BaseSlicer):
     # this works somewhat like a dictionary
     opentype = ('set-vocab',)
     trackReferences = False
+    # the new table is used as soon as finish() is called, so the Banana
+    # must not switch to another lane before our CLOSE is sent
+    holdsLane = True
 
     def slice(self, streamable, banana):
         # we need to implement slice() (instead of merely sliceBody) so we
@@ -109,6 +112,7 @@ class ReplaceVocabUnslicer(LeafUnslicer):
 class AddVocabSlicer(BaseSlicer):
     opentype = ('add-vocab',)
     trackReferences = False
+    holdsLane = True # see ReplaceVocabSlicer
 
     def __init__(self, value):
         assert isinstance(value, str)
@@ -168,6 +172,7 @@ class AddVocabUnslicer(BaseUnslicer):
         assert not isinstance(obj, Deferred)
         assert ready_deferred is None
         if self.index is None:
+            self.protocol.checkIncomingVocabularyIndex(obj)
             self.index = obj
         else:
             self.value = obj
@@ -52,6 +52,9 @@ class InstanceSlicer(OrderedDictSlicer):
         for t in OrderedDictSlicer.sliceBody(self, streamable, banana):
             yield t
 
+    def slicePrimitives(self):
+        return None
+
 class ModuleSlicer(slicer.BaseSlicer):
     opentype = ('module',)
     trackReferences = True
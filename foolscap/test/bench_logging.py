@@ -0,0 +1,48 @@
+
+from foolscap.logging import log
+
+class B(object):
+    def setup_logger(self, threshold):
+        """ A logger with one regular observer, as in an application that
+        writes its log to a file or publishes it to a gatherer. """
+        self.logger = log.FoolscapLogger()
+        self.logger.set_generation_threshold(threshold)
+        self.received = 0
+        def observer(event):
+            self.received += 1
+        self.logger.addObserver(observer)
+
+    def bench_msg(self, N, level=log.NOISY):
+        """ Log N messages with positional args, then let the observer see
+        them. """
+        msg = self.logger.msg
+        for i in range(N):
+            msg("message %d of %d", i, N, level=level, facility="app.bench")
+        reactor.runUntilCurrent()
+
+def msgs_per_second(b, threshold, N):
+    res = benchutil.rep_bench(b.bench_msg, N,
+                              initfunc=lambda n: b.setup_logger(threshold),
+                              runreps=1, runiters=5, quiet=True)
+    return 1 / res["best"]
+
+# log.msg(level=NOISY) rate (msgs/sec, best of 5, N=10**5), when NOISY
+# messages are generated (threshold=NOISY) and when they are discarded
+# (threshold=OPERATIONAL), before and after FoolscapLogger.msg stopped
+# formatting every event and started delivering each turn's events to the
+# observers with a single eventual-send:
+#
+#                  NOISY    OPERATIONAL
+#   before:        105k     100k
+#   after:         230k     1390k
+
+import sys
+from twisted.internet import reactor
+from pyutil import benchutil
+b = B()
+for N in 10**4, 10**5:
+    for threshold in log.NOISY, log.OPERATIONAL:
+        print "%8d threshold=%2d: %d msgs/sec" % (N, threshold,
+                                                  msgs_per_second(b, threshold,
+                                                                  N))
+        sys.stdout.flush()
@@ -0,0 +1,62 @@
+
+from pyutil import benchutil
+from foolscap.api import RemoteInterface
+from foolscap.schema import ListOf, ByteStringConstraint, Any
+
+class RIBenchSchema(RemoteInterface):
+    def ten(a=int, b=int, c=str, d=str, e=bool, f=float,
+            g=ListOf(int), h=ByteStringConstraint(20, regexp=r"^\w+$"),
+            i=Any(), j=(int, str)):
+        return ListOf(int)
+
+class B(object):
+    def setup_args(self):
+        self.schema = RIBenchSchema["ten"]
+        self.args = (1, 2, "three", "four", True, 6.0, range(7), "eight",
+                     None, (10, "ten"))
+        self.result = range(10)
+
+    def bench_outbound(self, N):
+        """ What RemoteReference.callRemote checks before sending. """
+        checkAllArgs = self.schema.checkAllArgs
+        args = self.args
+        for n in xrange(N):
+            checkAllArgs(args, {}, False)
+
+    def bench_inbound(self, N):
+        """ What the ArgumentUnslicer checks as each argument arrives, then
+        what Broker._doCall checks before invoking the method, and what
+        _callFinished checks before sending the answer. """
+        schema = self.schema
+        args = self.args
+        result = self.result
+        constraints = [schema.getPositionalArgConstraint(i)[1]
+                       for i in range(len(args))]
+        validated = set(range(len(args)))
+        for n in xrange(N):
+            for i in range(len(args)):
+                constraints[i].checkObject(args[i], True)
+            schema.checkAllArgs(args, {}, True, validated)
+            schema.checkResults(result, False)
+
+def usecs_per_call(bench, N):
+    res = benchutil.rep_bench(bench, N, runreps=1, runiters=5, quiet=True)
+    return 1e6 * res["best"]
+
+# schema-checking time per call (usecs, best of 5, N=10**5) for the
+# 10-argument method above, before and after RemoteMethodSchema compiled
+# its constraints into a table of checkers. Before, the receiving side
+# checked the arguments' tokens as they arrived and then ran the whole
+# checkAllArgs() again in Broker._doCall. Now it checks each finished
+# argument as it arrives and only looks for missing arguments afterwards.
+#
+#                  outbound   inbound
+#   before:        22.0       25.1
+#   after:         8.6        14.8
+
+if __name__ == "__main__":
+    b = B()
+    b.setup_args()
+    N = 10**5
+    print "outbound: %.1f usecs/call" % usecs_per_call(b.bench_outbound, N)
+    print "inbound:  %.1f usecs/call" % usecs_per_call(b.bench_inbound, N)
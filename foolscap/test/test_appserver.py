@@ -6,7 +6,7 @@ from twisted.internet import defer
 from twisted.application import service
 
 from foolscap.api import Tub, eventually
-from foolscap.appserver import cli, server, client
+from foolscap.appserver import cli, server, client, services
 from foolscap.test.common import ShouldFailMixin, crypto_available, StallMixin
 
 class RequiresCryptoBase:
@@ -297,6 +297,21 @@ class CLI(RequiresCryptoBase, unittest.TestCase):
         d.addCallback(_check_list)
         return d
 
+class ServiceArgs(unittest.TestCase):
+    def test_parse(self):
+        parse = services.parse_service_args
+        self.failUnlessEqual(parse("('a', \"b'c\")\n"), ("a", "b'c"))
+        self.failUnlessEqual(parse("('a',)"), ("a",))
+        self.failUnlessEqual(parse("()"), ())
+        # add_service() writes whatever sequence it was given, and
+        # git-foolscap gives it a list
+        self.failUnlessEqual(parse(repr(["--accept-stdin", "/", "git"])),
+                             ("--accept-stdin", "/", "git"))
+        self.failUnlessEqual(parse("[]"), ())
+        for bad in ["('a', 'b']", "['a')", "('a', __import__('os'))",
+                    "'a'", "{'a': 'b'}"]:
+            self.failUnlessRaises(services.BadServiceArguments, parse, bad)
+
 class Server(RequiresCryptoBase, unittest.TestCase, ShouldFailMixin):
     def setUp(self):
         RequiresCryptoBase.setUp(self)
@@ -352,6 +367,65 @@ class Server(RequiresCryptoBase, unittest.TestCase, ShouldFailMixin):
         return d
     
 
+    def test_service_table(self):
+        basedir = "appserver/Server/service_table"
+        os.makedirs(basedir)
+        serverdir = os.path.join(basedir, "fl")
+        incomingdir = os.path.join(basedir, "incoming")
+        os.mkdir(incomingdir)
+        swissnums = []
+        def _add(ign):
+            d1 = self.run_cli("add", serverdir, "upload-file", incomingdir)
+            def _added((rc,out,err)):
+                self.failUnlessEqual(rc, 0)
+                furl = out.splitlines()[1].split()[-1]
+                swissnums.append(furl[furl.rfind("/")+1:])
+            d1.addCallback(_added)
+            return d1
+        d = self.run_cli("create", serverdir)
+        d.addCallback(_add)
+        def _start_server(ign):
+            self.ap = server.AppServer(serverdir, StringIO())
+            self.ap.setServiceParent(self.s)
+            return self.ap.when_ready()
+        d.addCallback(_start_server)
+        def _check_cached(ign):
+            ap = self.ap
+            s1 = ap.lookup(swissnums[0])
+            self.failUnless(s1)
+            self.failUnlessIdentical(ap.lookup(swissnums[0]), s1)
+            self.failUnlessEqual(ap.lookup("bogus"), None)
+            self.s1 = s1
+        d.addCallback(_check_cached)
+        # services added while the server is running are noticed
+        d.addCallback(_add)
+        def _check_added(ign):
+            ap = self.ap
+            s2 = ap.lookup(swissnums[1])
+            self.failUnless(s2)
+            self.failIfIdentical(s2, self.s1)
+            self.failUnlessIdentical(ap.lookup(swissnums[0]), self.s1)
+            # and so are removed ones
+            servicedir = os.path.join(serverdir, "services", swissnums[0])
+            for fn in os.listdir(servicedir):
+                os.unlink(os.path.join(servicedir, fn))
+            os.rmdir(servicedir)
+            self.failUnlessEqual(ap.lookup(swissnums[0]), None)
+            self.failIf(self.s1.running)
+            # edits to an existing service are picked up by a reload. This
+            # one is written as a list, the way doc/examples/git-foolscap
+            # passes its arguments to add_service()
+            f = open(os.path.join(serverdir, "services", swissnums[1],
+                                  "service_args"), "w")
+            f.write(repr(["--mode=0600", incomingdir]) + "\n")
+            f.close()
+            ap.load_services()
+            s3 = ap.lookup(swissnums[1])
+            self.failIfIdentical(s3, s2)
+            self.failUnlessEqual(s3.options["mode"], 0600)
+        d.addCallback(_check_added)
+        return d
+
 class Upload(RequiresCryptoBase, unittest.TestCase, ShouldFailMixin):
     def setUp(self):
         RequiresCryptoBase.setUp(self)
@@ -497,7 +571,53 @@ class Upload(RequiresCryptoBase, unittest.TestCase, ShouldFailMixin):
         d.addCallback(_check_client4)
 
         return d
-    
+
+class FakeSource:
+    def __init__(self):
+        self.reads = []
+    def callRemote(self, methname, size):
+        d = defer.Deferred()
+        self.reads.append((size, d))
+        return d
+
+class FileUploaderReader(unittest.TestCase):
+    def test_window(self):
+        f = StringIO()
+        source = FakeSource()
+        r = services.FileUploaderReader(f, source, blocksize=10, window=3)
+        d = r.read_file()
+        fired = []
+        d.addCallback(fired.append)
+        self.failUnlessEqual([size for (size,rd) in source.reads], [10]*3)
+        # responses that arrive out of order are still written in order
+        source.reads[1][1].callback("bbb")
+        self.failUnlessEqual(f.getvalue(), "")
+        self.failUnlessEqual(len(source.reads), 4)
+        source.reads[0][1].callback("aaa")
+        self.failUnlessEqual(f.getvalue(), "aaabbb")
+        self.failUnlessEqual(len(source.reads), 5)
+        # once we see EOF, we stop reading, and finish when the rest are in
+        source.reads[2][1].callback("")
+        self.failUnlessEqual(len(source.reads), 5)
+        self.failUnlessEqual(fired, [])
+        source.reads[3][1].callback("")
+        source.reads[4][1].callback("")
+        self.failUnlessEqual(fired, [None])
+        self.failUnlessEqual(f.getvalue(), "aaabbb")
+
+    def test_error(self):
+        f = StringIO()
+        source = FakeSource()
+        r = services.FileUploaderReader(f, source, blocksize=10, window=2)
+        d = r.read_file()
+        failures = []
+        d.addErrback(failures.append)
+        source.reads[0][1].errback(ValueError("oops"))
+        source.reads[1][1].errback(ValueError("oops again"))
+        self.failUnlessEqual(len(failures), 1)
+        self.failUnless(failures[0].check(ValueError))
+        self.failUnlessEqual(len(source.reads), 2)
+
 class Client(unittest.TestCase):
 
     def run_client(self, *args):
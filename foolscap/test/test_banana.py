@@ -4,13 +4,17 @@ from twisted.python import reflect
 from twisted.python.failure import Failure
 from twisted.python.components import registerAdapter
 from twisted.internet import defer
+from zope.interface import alsoProvides
 
 from foolscap.tokens import ISlicer, Violation, BananaError
 from foolscap.tokens import BananaFailure, tokenNames, \
      OPEN, CLOSE, ABORT, INT, LONGINT, NEG, LONGNEG, FLOAT, STRING
-from foolscap import slicer, schema, storage, banana, vocab
+from foolscap import slicer, schema, storage, banana, vocab, copyable
 from foolscap.eventual import fireEventually, flushEventualQueue
+from foolscap.slicers.vocab import AddToVocabularyTable
 from foolscap.slicers.allslicers import RootSlicer, DictUnslicer, TupleUnslicer
+from foolscap.slicers.allslicers import ListSlicer, DictSlicer, \
+     OrderedDictSlicer
 from foolscap.constraint import IConstraint
 from foolscap.banana import int2b128, long_to_bytes
 
@@ -44,6 +48,9 @@ def bERROR(str):
 def bABORT(count):
     assert count < 128
     return chr(count) + "\x8A"
+def bLANE(number):
+    assert number < 128
+    return chr(number) + "\x90"
 # DecodeTest (24): turns tokens into objects, tests objects and UFs
 # EncodeTest (13): turns objects/instance into tokens, tests tokens
 # FailedInstanceTests (2): 1:turn instances into tokens and fail, 2:reverse
@@ -55,6 +62,8 @@ def bABORT(count):
 
 # VocabTest1 (2): test setOutgoingVocabulary and an inbound Vocab sequence
 # VocabTest2 (1): send object, test bytestream w/vocab-encoding
+# SendLanes (3): interleave objects from several lanes, test tokens
+# ReceiveLanes (3): bytestream with LANE tokens, check objects
 # Sliceable (2): turn instance into tokens (with ISliceable, test tokens
 
 def tOPEN(count):
@@ -83,6 +92,9 @@ class TokenBanana(banana.Banana):
     def sendAbort(self, count=0):
         self.sendToken(("ABORT",))
 
+    def sendLaneToken(self, number):
+        self.sendToken(("LANE", number))
+
     def sendError(self, msg):
         #print "TokenBanana.sendError(%s)" % msg
         pass
@@ -96,12 +108,12 @@ class TokenBanana(banana.Banana):
         return d
     def _testSlice_1(self, res):
         assert len(self.slicerStack) == 1
-        assert not self.rootSlicer.sendQueue
+        assert not self.rootSlicer.lane.sendQueue
         assert isinstance(self.slicerStack[0][0], RootSlicer)
         return self.tokens
 
     def __del__(self):
-        assert not self.rootSlicer.sendQueue
+        assert not self.rootSlicer.lane.sendQueue
 
 def untokenize(tokens):
     data = []
@@ -227,6 +239,12 @@ class TestTransport(StringIO.StringIO):
     def loseConnection(self):
         pass
 
+class CountingTransport(TestTransport):
+    writes = 0
+    def write(self, data):
+        self.writes += 1
+        TestTransport.write(self, data)
+
 class _None: pass
 
 class TestBananaMixin:
@@ -453,6 +471,19 @@ class DecodeTest(UnbananaTestMixin, unittest.TestCase):
         self.failUnlessEqual(f.value.where, "<RootUnslicer>.{}")
         self.failUnlessEqual(f.value.args[0], "unhashable key '[1, 2]'")
 
+    def test_add_vocab(self):
+        "add-vocab"
+        self.do([tOPEN(0),'add-vocab', 4, "apple", tCLOSE(0)])
+        self.failUnlessEqual(self.banana.incomingVocabulary[4], "apple")
+
+    def test_add_vocab_limit(self):
+        "add-vocab beyond the table size limit"
+        self.banana.incomingVocabTableSizeLimit = 10
+        f = self.shouldDropConnection([tOPEN(0),'add-vocab', 10, "apple",
+                                       tCLOSE(0)])
+        self.failUnless("outside the VOCAB table" in f.value.args[0])
+        self.failIf(10 in self.banana.incomingVocabulary)
+
     def test_instance(self):
         "instance"
         f1 = Foo(); f1.a = 1; f1.b = [2,3]
@@ -1320,6 +1351,70 @@ class ByteStream(TestBananaMixin, unittest.TestCase):
         d.addCallback(self.wantEqual, expected)
         return d
 
+    def test_coalesce(self):
+        # all the tokens of a single object should be delivered to the
+        # transport in a single write()
+        self.banana.transport = t = CountingTransport()
+        obj = [1, "two", [3.0, -4], 2**40]
+        d = self.encode(obj)
+        def _check(res):
+            self.failUnlessEqual(t.writes, 1)
+            self.failUnlessEqual(self.decode(res), obj)
+        d.addCallback(_check)
+        return d
+
+    def test_high_water_mark(self):
+        self.banana.transport = t = CountingTransport()
+        self.banana.outboundHighWaterMark = 100
+        obj = [["a"*60] for i in range(10)]
+        d = self.encode(obj)
+        def _check(res):
+            self.failUnless(t.writes > 1, t.writes)
+            self.failUnlessEqual(self.decode(res), obj)
+        d.addCallback(_check)
+        return d
+
+    def test_primitives(self):
+        # containers of primitive values take a shortcut through
+        # Banana.sendPrimitives, which must produce the same bytes as the
+        # regular Slicers
+        shared = [7, 8]
+        objs = [[1, -2, "three", 4.0, True, False, 2**40, -2**40, ""],
+                (1, "two", 3L),
+                {"a": 1, "b": [2, 3], 4: "c", 5.0: True},
+                (shared, shared, [shared]),
+                [[], (), {}],
+                set([1, 2, 3]),
+                ]
+        def _encode(res, obj):
+            self.makeBanana()
+            return self.encode(obj)
+        fast = []
+        d = defer.succeed(None)
+        for obj in objs:
+            d.addCallback(_encode, obj)
+            d.addCallback(fast.append)
+        def _disable(res):
+            def _disabled(self):
+                return None
+            for slicerClass in (ListSlicer, DictSlicer, OrderedDictSlicer):
+                self.patch(slicerClass, "slicePrimitives", _disabled)
+        d.addCallback(_disable)
+        for i in range(len(objs)):
+            d.addCallback(_encode, objs[i])
+            d.addCallback(lambda res, i=i: self.failUnlessEqual(res, fast[i]))
+        return d
+
+    def test_primitives_bool(self):
+        obj = [True, 1]
+        expected = join(bOPEN("list", 0),
+                         bOPEN("boolean", 1), bINT(1), bCLOSE(1),
+                         bINT(1),
+                        bCLOSE(0))
+        d = self.encode(obj)
+        d.addCallback(self.wantEqual, expected)
+        return d
+
 class InboundByteStream(TestBananaMixin, unittest.TestCase):
 
     def check(self, obj, stream):
@@ -1395,6 +1490,32 @@ class InboundByteStream(TestBananaMixin, unittest.TestCase):
                         bCLOSE(2),
                         bCLOSE(1)))
 
+    def checkFragmented(self, obj, stream, chunksize):
+        self.makeBanana()
+        results = []
+        d = self.banana.prepare()
+        d.addCallback(results.append)
+        for i in range(0, len(stream), chunksize):
+            self.failIf(results)
+            self.banana.dataReceived(stream[i:i+chunksize])
+        self.failIf(self.banana.violation)
+        self.failIf(self.banana.disconnectReason)
+        self.failUnlessEqual(results, [obj])
+
+    def testFragmented(self):
+        # tokens which are split across several calls to dataReceived, in
+        # the header, the type byte, or the body
+        obj = [1, 130, -130, 2**40, 1.5, "a"*130, ("tuple", "c"*1025)]
+        stream = join(bOPEN('list',1), bINT(1), "\x02\x01\x81",
+                      "\x02\x01\x83", "\x06\x85\x01\x00\x00\x00\x00\x00",
+                      "\x84\x3f\xf8\x00\x00\x00\x00\x00\x00",
+                      "\x02\x01\x82" + "a"*130,
+                      bOPEN('tuple',2), bSTR("tuple"),
+                      "\x01\x08\x82" + "c"*1025,
+                      bCLOSE(2), bCLOSE(1))
+        for chunksize in (1, 2, 3, 7, 100, 1000, len(stream)):
+            self.checkFragmented(obj, stream, chunksize)
+
     def TRUE(self):
         return join(bOPEN("boolean",2), bINT(1), bCLOSE(2))
     def FALSE(self):
@@ -1515,6 +1636,54 @@ class InboundByteStream2(TestBananaMixin, unittest.TestCase):
                       "<RootUnslicer>.[1].[2]",
                       schema.ListOf(schema.ListOf(int, maxLength=2)))
 
+    def testConstrainedListPrimitives(self):
+        # ListOf(int) and ListOf(str) are decoded by
+        # Banana.decodePrimitives, which must behave like the slow path
+        # even when the tokens arrive in pieces
+        ints = [0, 1, 127, 128, -1, -128, 2**31-1, -2**31] * 20
+        stream = join(bOPEN('list',1),
+                      "".join([self.encodeInt(i) for i in ints]),
+                      bCLOSE(1))
+        self.conformFragmented(stream, ints, schema.ListOf(int))
+        strings = ["", "a", "b"*200, "vocab"] * 20
+        body = []
+        for s in strings:
+            if s == "vocab":
+                body.append("\x01\x87")
+            else:
+                int2b128(len(s), body.append)
+                body.append("\x82" + s)
+        stream = join(bOPEN('list',1), "".join(body), bCLOSE(1))
+        self.banana.incomingVocabulary = {1: "vocab"}
+        self.conformFragmented(stream, strings,
+                               schema.ListOf(schema.StringConstraint(200)))
+        self.violate2(stream, "<RootUnslicer>.[2]",
+                      schema.ListOf(schema.StringConstraint(199)))
+        self.violate2(join(bOPEN('list',1), bINT(1), bINT(2), bINT(3),
+                           bCLOSE(1)),
+                      "<RootUnslicer>.[2]",
+                      schema.ListOf(int, maxLength=2))
+
+    def encodeInt(self, i):
+        data = []
+        if i >= 0:
+            int2b128(i, data.append)
+            data.append(INT)
+        else:
+            int2b128(-i, data.append)
+            data.append(NEG)
+        return "".join(data)
+
+    def conformFragmented(self, stream, obj, constraint):
+        for size in (1, 2, 3, 7, 100, len(stream)):
+            self.setConstraints(constraint, None)
+            results = []
+            d = self.banana.prepare()
+            d.addCallback(results.append)
+            for i in range(0, len(stream), size):
+                self.banana.dataReceived(stream[i:i+size])
+            self.failUnlessEqual(results, [obj])
+
     def testConstrainedTuple(self):
         self.conform2(join(bOPEN('tuple',1), bINT(1), bINT(2),
                            bCLOSE(1)),
@@ -1952,6 +2121,191 @@ class VocabTest2(TestBananaMixin, unittest.TestCase):
         return d
 
 
+class VocabLearning(TestBananaMixin, unittest.TestCase):
+    def decodeAll(self, stream):
+        b = storage.StorageBanana()
+        b.slicerClass = storage.UnsafeStorageRootSlicer
+        b.unslicerClass = storage.UnsafeStorageRootUnslicer
+        objects = []
+        b.receiveChild = lambda obj, ready_deferred: objects.append(obj)
+        b.connectionMade()
+        b.dataReceived(stream)
+        return b, objects
+
+    def test_disabled(self):
+        d = self.encode(["apple"] * 10)
+        d.addCallback(fireEventually)
+        def _check(res):
+            self.failUnlessEqual(self.banana.outgoingVocabulary, {})
+            self.failUnlessEqual(self.banana.getVocabStats()["strings-sent"],
+                                 0)
+        d.addCallback(_check)
+        return d
+
+    def test_learn(self):
+        self.banana.enableVocabLearning(threshold=2)
+        d = self.encode(["apple", "apple", "banana"])
+        # the second "apple" schedules an (add-vocab), which is queued
+        # behind the list, so the list itself is sent in full
+        d.addCallback(fireEventually)
+        def _check1(res):
+            self.failUnlessEqual(self.banana.outgoingVocabulary,
+                                 {"apple": 0})
+            self.failIf(self.banana.pendingVocabAdditions)
+            return self.encode(["apple", "banana"])
+        d.addCallback(_check1)
+        def _check2(stream):
+            # "apple" is now sent as VOCAB(0). Serialization is synchronous,
+            # so the stream also includes the additions that were queued
+            # while this list was being sent.
+            self.failUnlessIn(bOPEN("list", 2) + "\x00\x87" +
+                              bSTR("banana") + bCLOSE(2), stream)
+            stats = self.banana.getVocabStats()
+            self.failUnless(stats["vocab-tokens-sent"] >= 1, stats)
+            self.failUnless(stats["vocab-bytes-saved"] >= 5, stats)
+            self.failUnless("banana" in self.banana.outgoingVocabulary)
+            self.failUnlessEqual(stats["table-size"],
+                                 stats["vocab-additions"])
+            b, objects = self.decodeAll(stream)
+            self.failUnlessEqual(objects[:3],
+                                 [["apple", "apple", "banana"],
+                                  AddToVocabularyTable,
+                                  ["apple", "banana"]])
+            expected = dict([(index, string) for (string, index)
+                             in self.banana.outgoingVocabulary.items()])
+            self.failUnlessEqual(b.incomingVocabulary, expected)
+        d.addCallback(_check2)
+        return d
+
+    def test_window(self):
+        # strings which do not repeat within the window are forgotten
+        self.banana.enableVocabLearning(threshold=2, window=2)
+        d = self.encode(["apple", "banana", "cherry", "apple"])
+        d.addCallback(fireEventually)
+        def _check(res):
+            self.failUnlessEqual(self.banana.outgoingVocabulary, {})
+            self.failUnlessEqual(self.banana.getVocabStats()["candidates"], 2)
+        d.addCallback(_check)
+        return d
+
+    def test_limits(self):
+        self.banana.enableVocabLearning(threshold=2, tableSize=1)
+        d = self.encode(["ab", "ab", "x"*101, "x"*101,
+                         "apple", "apple", "banana", "banana"])
+        d.addCallback(fireEventually)
+        def _check(res):
+            # short and long strings are not eligible, and the table stops
+            # growing when it is full
+            self.failUnlessEqual(self.banana.outgoingVocabulary,
+                                 {"apple": 0})
+            self.failUnlessEqual(self.banana.getVocabStats()["vocab-additions"],
+                                 1)
+        d.addCallback(_check)
+        return d
+
+
+class ManyTokens(slicer.BaseSlicer):
+    opentype = ("list",)
+    def sliceBody(self, streamable, banana):
+        return iter(self.obj)
+
+class SendLanes(unittest.TestCase):
+    def setUp(self):
+        self.banana = TokenBanana()
+        self.banana.slicerClass = storage.UnsafeStorageRootSlicer
+        self.banana.unslicerClass = storage.UnsafeStorageRootUnslicer
+        self.banana.connectionMade()
+        self.banana.enableSendLanes()
+        self.banana.tokens = []
+
+    def tearDown(self):
+        return flushEventualQueue()
+
+    def test_streaming(self):
+        # while one lane waits for a streaming Slicer, another can go
+        d1 = self.banana.send(ErrorfulSlicer("deferred-good", True), 2)
+        d2 = self.banana.send(ErrorfulSlicer("success", True), 0)
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(lambda res:
+                      self.failUnlessEqual(self.banana.tokens,
+                                           [("LANE", 2), tOPEN(0), 1,
+                                            ("LANE", 0),
+                                            tOPEN(1), 1, "success", 3,
+                                            tCLOSE(1),
+                                            ("LANE", 2), 3, tCLOSE(0)]))
+        return d
+
+    def test_weights(self):
+        # a large object shares the connection with objects in more urgent
+        # lanes, by weight
+        self.banana.laneQuantum = 2
+        self.banana.pauseProducing() # as if the transport were full
+        d1 = self.banana.send(ManyTokens(range(20)), 2)
+        d2 = self.banana.send(ManyTokens(["a", "b", "c", "d", "e"]), 0)
+        self.failUnlessEqual(self.banana.tokens, [])
+        self.banana.resumeProducing()
+        d = defer.gatherResults([d1, d2])
+        def _check(res):
+            tokens = self.banana.tokens
+            # the urgent object was finished first, but the large one
+            # was not held up completely
+            self.failUnless(tokens.index("e") < tokens.index(19), tokens)
+            self.failUnless(tokens.index(("LANE", 2)) < tokens.index("e"),
+                            tokens)
+            self.failUnlessEqual([t for t in tokens if type(t) is int],
+                                 range(20))
+        d.addCallback(_check)
+        return d
+
+    def test_order(self):
+        # objects in one lane keep their order, even when they are queued
+        # behind a streaming object
+        d1 = self.banana.send(ErrorfulSlicer("deferred-good", True), 1)
+        d2 = self.banana.send(ManyTokens(["second"]), 1)
+        d3 = self.banana.send(ManyTokens(["third"]), 1)
+        d = defer.gatherResults([d1, d2, d3])
+        d.addCallback(lambda res:
+                      self.failUnlessEqual(self.banana.tokens,
+                                           [("LANE", 1), tOPEN(0), 1, 3,
+                                            tCLOSE(0),
+                                            tOPEN(1), "list", "second",
+                                            tCLOSE(1),
+                                            tOPEN(2), "list", "third",
+                                            tCLOSE(2)]))
+        return d
+
+class ReceiveLanes(TestBananaMixin, unittest.TestCase):
+    def decodeAll(self, stream):
+        objects = []
+        self.banana.receiveChild = (lambda obj, ready_deferred:
+                                    objects.append(obj))
+        self.banana.dataReceived(stream)
+        return objects
+
+    def test_interleaved(self):
+        stream = join(bLANE(1), bOPEN("list", 0), bSTR("a"),
+                      bLANE(0), bOPEN("list", 1), bINT(1), bCLOSE(1),
+                      bLANE(1), bSTR("b"), bCLOSE(0),
+                      bLANE(0), bOPEN("list", 2), bINT(2), bCLOSE(2))
+        objects = self.decodeAll(stream)
+        self.failUnlessEqual(objects, [[1], ["a", "b"], [2]])
+        self.failUnlessEqual(len(self.banana.receiveStack), 1)
+
+    def test_partial(self):
+        # a lane can be left in the middle of an OPEN sequence's index
+        stream1 = join(bLANE(2), chr(0), "\x88", bLANE(0),
+                       bOPEN("list", 1), bINT(1), bCLOSE(1))
+        objects = self.decodeAll(stream1)
+        self.failUnlessEqual(objects, [[1]])
+        objects = self.decodeAll(join(bLANE(2), bSTR("list"), bSTR("x"),
+                                      bCLOSE(0)))
+        self.failUnlessEqual(objects, [["x"]])
+
+    def test_too_many_lanes(self):
+        f = self.shouldDropConnection(bLANE(banana.Banana.maxReceiveLanes))
+        self.failUnlessIn("LANE 8 is too large", str(f))
+
+
 class SliceableByItself(slicer.BaseSlicer):
     def __init__(self, value):
         self.value = value
@@ -1970,6 +2324,19 @@ class _AndICanHelp(slicer.BaseSlicer):
         yield {"value": self.obj.value}
 registerAdapter(_AndICanHelp, CouldBeSliceable, ISlicer)
 
+class LateSliceable:
+    def __init__(self, value):
+        self.value = value
+class LateCopiable:
+    def __init__(self, value):
+        self.value = value
+
+class Chameleon:
+    def getTypeToCopy(self):
+        return "chameleon"
+    def getStateToCopy(self):
+        return {"value": 48}
+
 class Sliceable(unittest.TestCase):
     def setUp(self):
         self.banana = TokenBanana()
@@ -2000,6 +2367,51 @@ class Sliceable(unittest.TestCase):
                        tCLOSE(0)])
         return d
 
+    def failUnlessUnsendable(self, obj):
+        d = self.do(obj)
+        d.addCallbacks(lambda res: self.fail("should have failed"),
+                       lambda f: f.trap(Violation))
+        return d
+
+    def testLateAdapter(self):
+        # slicerForObject caches the adapter lookup for each class, and must
+        # notice adapters that are registered afterwards
+        d = self.failUnlessUnsendable(LateSliceable(44))
+        def _register(res):
+            registerAdapter(_AndICanHelp, LateSliceable, ISlicer)
+            return self.do(LateSliceable(45))
+        d.addCallback(_register)
+        d.addCallback(self.failUnlessEqual,
+                      [tOPEN(0),
+                       tOPEN(1), "dict", "value", 45, tCLOSE(1),
+                       tCLOSE(0)])
+        return d
+
+    def testLateCopier(self):
+        d = self.failUnlessUnsendable(LateCopiable(46))
+        def _register(res):
+            copyable.registerCopier(LateCopiable,
+                                    lambda obj: ("late", {"value": obj.value}))
+            return self.do(LateCopiable(47))
+        d.addCallback(_register)
+        d.addCallback(self.failUnlessEqual,
+                      [tOPEN(0), "copyable", "late", "value", 47, tCLOSE(0)])
+        return d
+
+    def testProvidedByInstance(self):
+        # an instance which declares its own interfaces must not be handled
+        # like the rest of its class
+        d = self.failUnlessUnsendable(Chameleon())
+        def _provide(res):
+            c = Chameleon()
+            alsoProvides(c, copyable.ICopyable)
+            return self.do(c)
+        d.addCallback(_provide)
+        d.addCallback(self.failUnlessEqual,
+                      [tOPEN(0), "copyable", "chameleon", "value", 48,
+                       tCLOSE(0)])
+        d.addCallback(lambda res: self.failUnlessUnsendable(Chameleon()))
+        return d
 
 
 # TODO: vocab test:
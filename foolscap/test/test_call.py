@@ -8,8 +8,10 @@ if False:
     from twisted.python import log
     log.startLogging(sys.stderr)
 
+from zope.interface import implements
 from twisted.python import log
 from twisted.trial import unittest
+from twisted.internet import defer
 from twisted.internet.main import CONNECTION_LOST, CONNECTION_DONE
 from twisted.python.failure import Failure
 from twisted.application import service
@@ -19,13 +21,33 @@ from foolscap.eventual import flushEventualQueue
 from foolscap.test.common import HelperTarget, TargetMixin, ShouldFailMixin
 from foolscap.test.common import RIMyTarget, Target, TargetWithoutInterfaces, \
      BrokenTarget
-from foolscap.api import RemoteException, UnauthenticatedTub, DeadReferenceError
+from foolscap.api import RemoteException, UnauthenticatedTub, \
+     DeadReferenceError, RemoteInterface, Referenceable, \
+     PRIORITY_HIGH, PRIORITY_LOW
+from foolscap.schema import ByteStringConstraint
 from foolscap.call import CopiedFailure
 from foolscap.logging import log as flog
 
 class Unsendable:
     pass
 
+class RIDigits(RemoteInterface):
+    # the regexp can only be checked once the whole string has arrived
+    def digits(s=ByteStringConstraint(regexp=r"^\d+$")): return int
+
+class DigitsTarget(Referenceable):
+    implements(RIDigits)
+    def remote_digits(self, s):
+        return int(s)
+
+
+class Pinger(Referenceable):
+    def remote_ping(self):
+        return "pong"
+    def remote_callback(self, rref):
+        rref.callRemoteOnly("set", obj="called")
+        return "done"
+
 
 class TestCall(TargetMixin, ShouldFailMixin, unittest.TestCase):
     def setUp(self):
@@ -336,6 +358,23 @@ class TestCall(TargetMixin, ShouldFailMixin, unittest.TestCase):
         self.failUnlessSubstring(" methodname=add", f.value)
         self.failUnlessSubstring("<arguments arg[b]>", f.value)
 
+    def testFailWrongArgsRemote2(self):
+        # the argument's tokens are fine, but the finished value violates
+        # the constraint: the recipient catches it as soon as it arrives
+        rr, target = self.setupTarget(DigitsTarget(), True)
+        d = rr.callRemote("digits", "123")
+        d.addCallback(lambda res: self.failUnlessEqual(res, 123))
+        d.addCallback(lambda res:
+                      self.shouldFail(Violation, "testFailWrongArgsRemote2",
+                                      "regexp failed to match",
+                                      rr.callRemote, "digits", s="12x",
+                                      _useSchema=False))
+        def _check(res):
+            f = res[0]
+            self.failUnlessSubstring("<arguments arg[s]>", f.value)
+        d.addCallback(_check)
+        return d
+
     def testFailWrongReturnRemote(self):
         rr, target = self.setupTarget(BrokenTarget(), True)
         d = rr.callRemote("add", 3, 4) # violates return constraint
@@ -392,6 +431,29 @@ class TestCall(TargetMixin, ShouldFailMixin, unittest.TestCase):
         return d
     testStallOrdering.timeout = 5
 
+    def testPipelinedOrdering(self):
+        # a burst of calls that arrive together are all delivered in order,
+        # and one that fails doesn't hold up the ones behind it
+        rr, target = self.setupTarget(Target())
+        dl = []
+        for i in range(20):
+            if i == 10:
+                d = self.shouldFail(ValueError, "testPipelinedOrdering",
+                                    "you asked me to fail",
+                                    rr.callRemote, "fail")
+            else:
+                d = rr.callRemote("add", a=i, b=1)
+            dl.append(d)
+        d = defer.gatherResults(dl)
+        def _check(res):
+            del res[10] # the Failure, already checked by shouldFail
+            self.failUnlessEqual(res, [i+1 for i in range(20) if i != 10])
+            self.failUnlessEqual(target.calls,
+                                 [(i,1) for i in range(20) if i != 10])
+            self.failIf(self.targetBroker.inboundDeliveryQueue)
+        d.addCallback(_check)
+        return d
+
     def testDisconnect_during_call(self):
         rr, target = self.setupTarget(HelperTarget())
         d = rr.callRemote("hang")
@@ -424,6 +486,49 @@ class TestCall(TargetMixin, ShouldFailMixin, unittest.TestCase):
                                       rr.callRemote, "hang"))
         return d
 
+    def test_getMethod(self):
+        rr, target = self.setupTarget(Target(), True)
+        add = rr.getMethod("add")
+        self.failUnlessRaises(Violation, rr.getMethod, "bogus")
+        d = add(1, 2)
+        d.addCallback(lambda res: self.failUnlessEqual(res, 3))
+        d.addCallback(lambda res: add(a=3, b=4))
+        d.addCallback(lambda res: self.failUnlessEqual(res, 7))
+        d.addCallback(lambda res:
+                      self.failUnlessEqual(target.calls, [(1,2), (3,4)]))
+        # the schema is still checked on every call
+        d.addCallback(lambda res:
+                      self.shouldFail(Violation, "getMethod.1",
+                                      "RIMyTarget.add(b=)",
+                                      add, 1, "two"))
+        def _disconnect(res):
+            rr.tracker.broker.transport.loseConnection(Failure(CONNECTION_LOST))
+            return flushEventualQueue()
+        d.addCallback(_disconnect)
+        d.addCallback(lambda res:
+                      self.shouldFail(DeadReferenceError, "getMethod.2",
+                                      "Calling Stale Broker",
+                                      add, 5, 6))
+        return d
+
+    def test_getMethod_priority(self):
+        # a handle takes the same _priority= hint as callRemote
+        rr, target = self.setupTarget(Target(), True)
+        lanes = []
+        orig = self.callingBroker.send
+        def _send(obj, lane=0):
+            lanes.append(lane)
+            return orig(obj, lane)
+        self.callingBroker.send = _send
+        add = rr.getMethod("add")
+        d = add(1, 2, _priority=PRIORITY_HIGH)
+        def _check(res):
+            self.failUnlessEqual(res, 3)
+            self.failUnlessEqual(target.calls, [(1,2)])
+            self.failUnlessEqual(lanes, [PRIORITY_HIGH])
+        d.addCallback(_check)
+        return d
+
     def test_connection_done_is_deadref(self):
         rr, target = self.setupTarget(HelperTarget())
         d = rr.callRemote("hang")
@@ -522,6 +627,285 @@ class TestCall(TargetMixin, ShouldFailMixin, unittest.TestCase):
         return d
 
 
+class AdaptiveVocab(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        # pretend we negotiated a peer that accepts top-level add-vocab
+        self.callingBroker._banana_decision_version = 4
+        self.targetBroker._banana_decision_version = 4
+
+    def test_old_peer(self):
+        # peers which did not negotiate version 4 may not send add-vocab
+        self.targetBroker._banana_decision_version = 3
+        root = self.targetBroker.rootUnslicer
+        e = self.failUnlessRaises(Violation, root.doOpen, ("add-vocab",))
+        self.failUnless("requires banana-decision-version 4" in str(e), e)
+        self.targetBroker._banana_decision_version = 4
+        root.doOpen(("add-vocab",))
+
+    def test_learn(self):
+        self.callingBroker.enableVocabLearning(threshold=2)
+        rr, target = self.setupTarget(HelperTarget())
+        d = rr.callRemote("set", obj={"key-one": 1})
+        d.addCallback(lambda res: rr.callRemote("set", obj={"key-one": 2}))
+        d.addCallback(lambda res: rr.callRemote("set", obj={"key-one": 3}))
+        def _check(res):
+            self.failUnlessEqual(target.obj, {"key-one": 3})
+            stats = self.callingBroker.getVocabStats()
+            self.failUnless(stats["vocab-additions"] >= 2, stats)
+            self.failUnless(stats["vocab-tokens-sent"] > 0, stats)
+            # the target has learned the words the caller added
+            for word, index in self.callingBroker.outgoingVocabulary.items():
+                self.failUnlessEqual(
+                    self.targetBroker.incomingVocabulary[index], word)
+            self.failUnless("key-one" in
+                            self.callingBroker.outgoingVocabulary)
+        d.addCallback(_check)
+        return d
+
+
+class DecrefBatching(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        # pretend we negotiated a peer that understands decref_batch
+        self.callingBroker._banana_decision_version = 5
+        self.batches = []
+        orig = self.targetBroker.remote_decref_batch
+        def _record(decrefs):
+            self.batches.append(decrefs)
+            return orig(decrefs)
+        self.targetBroker.remote_decref_batch = _record
+
+    def releaseAll(self, numrefs):
+        rrs = [self.setupTarget(HelperTarget())[0] for i in range(numrefs)]
+        clids = [rr.tracker.clid for rr in rrs]
+        for clid in clids:
+            self.failUnless(self.targetBroker.myReferenceByCLID.has_key(clid))
+        del rrs
+        gc.collect()
+        def _check():
+            return not self.callingBroker.yourReferenceByCLID
+        d = self.poll(_check)
+        def _released(res):
+            for clid in clids:
+                self.failIf(self.targetBroker.myReferenceByCLID.has_key(clid))
+            return clids
+        d.addCallback(_released)
+        return d
+
+    def test_one_batch(self):
+        d = self.releaseAll(3)
+        def _check(clids):
+            self.failUnlessEqual(len(self.batches), 1)
+            self.failUnlessEqual(sorted(self.batches[0]),
+                                 [(clid, 1) for clid in clids])
+        d.addCallback(_check)
+        return d
+
+    def test_size_threshold(self):
+        self.callingBroker.decrefBatchSize = 2
+        d = self.releaseAll(3)
+        def _check(clids):
+            self.failUnlessEqual([len(b) for b in self.batches], [2, 1])
+        d.addCallback(_check)
+        return d
+
+    def test_old_peer(self):
+        # peers which did not negotiate version 5 get individual decrefs
+        self.callingBroker._banana_decision_version = 4
+        d = self.releaseAll(2)
+        d.addCallback(lambda clids: self.failIf(self.batches))
+        return d
+
+
+def recordOpens(broker):
+    # the opentypes of the top-level sequences that broker receives
+    opens = []
+    orig = broker.rootUnslicer.doOpen
+    def _doOpen(opentype):
+        opens.append(opentype)
+        return orig(opentype)
+    broker.rootUnslicer.doOpen = _doOpen
+    return opens
+
+class BatchCalls(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        # pretend we negotiated a peer that understands (batch) sequences
+        self.callingBroker._banana_decision_version = 6
+        self.targetBroker._banana_decision_version = 6
+        self.targetOpens = recordOpens(self.targetBroker)
+        self.callingOpens = recordOpens(self.callingBroker)
+
+    def collect(self, dl):
+        # the result (or Failure) of each call, in the order they were made
+        d = defer.DeferredList(dl, consumeErrors=True)
+        d.addCallback(lambda res: [value for (success, value) in res])
+        return d
+
+    def test_refuse_batch(self):
+        # peers which did not negotiate version 6 may not send (batch)
+        self.targetBroker._banana_decision_version = 5
+        root = self.targetBroker.rootUnslicer
+        e = self.failUnlessRaises(Violation, root.doOpen, ("batch",))
+        self.failUnless("requires banana-decision-version 6" in str(e), e)
+        self.targetBroker._banana_decision_version = 6
+        root.doOpen(("batch",))
+
+    def test_batch(self):
+        rr, target = self.setupTarget(Target(), True)
+        dl = rr.callRemoteMany([("add", (1, 2), {}),
+                                ("fail", (), {}),
+                                ("add", (), {"a": 3, "b": 4}),
+                                ("bogus", (), {}), # rejected locally
+                                ("add", ("five", 6), {}), # violates schema
+                                ("add", [7], {"b": 8}),
+                                ])
+        self.failUnlessEqual(len(dl), 6)
+        d = self.collect(dl)
+        def _check(res):
+            self.failUnlessEqual(res[0], 3)
+            self.failUnless(isinstance(res[1], Failure))
+            self.failUnless(res[1].check(ValueError), res[1])
+            self.failUnlessEqual(res[2], 7)
+            self.failUnless(res[3].check(Violation), res[3])
+            self.failUnless(res[4].check(Violation), res[4])
+            self.failUnlessEqual(res[5], 15)
+            # the calls were delivered in order
+            self.failUnlessEqual(target.calls, [(1,2), (3,4), (7,8)])
+            # the four calls which were sent went out together, and so did
+            # their answers
+            self.failUnlessEqual(self.targetOpens, [("batch",)])
+            self.failUnlessEqual(self.callingOpens, [("batch",)])
+            self.failIf(self.callingBroker.waitingForAnswers)
+        d.addCallback(_check)
+        return d
+
+    def test_unsendable(self):
+        # an argument that cannot be serialized fails only its own call
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        dl = rr.callRemoteMany([("add", (1, 2), {}),
+                                ("free", (Unsendable(),), {}),
+                                ("add", (3, 4), {}),
+                                ])
+        d = self.collect(dl)
+        def _check(res):
+            self.failUnlessEqual(res[0], 3)
+            self.failUnless(res[1].check(Violation), res[1])
+            self.failUnlessEqual(res[2], 7)
+            self.failUnlessEqual(target.calls, [(1,2), (3,4)])
+            self.failIf(self.callingBroker.waitingForAnswers)
+        d.addCallback(_check)
+        return d
+
+    def test_unsendable_answer(self):
+        # an answer that cannot be serialized fails only its own call, and
+        # is logged
+        rr, target = self.setupTarget(HelperTarget())
+        target.obj = Unsendable()
+        logged = []
+        def _observe(event):
+            if "unable to serialize" in event.get("message", ""):
+                logged.append(event)
+        flog.theLogger.addObserver(_observe)
+        self.addCleanup(flog.theLogger.removeObserver, _observe)
+        dl = rr.callRemoteMany([("get", (), {}),
+                                ("set", (), {"obj": 1}),
+                                ])
+        d = self.collect(dl)
+        def _check(res):
+            self.failUnless(res[0].check(Violation), res[0])
+            self.failUnlessEqual(res[1], True)
+            self.failUnlessEqual(self.callingOpens, [("batch",)])
+            self.failUnlessEqual(len(logged), 1)
+            self.failIf(self.callingBroker.waitingForAnswers)
+        d.addCallback(_check)
+        return d
+
+    def test_old_peer(self):
+        # peers which did not negotiate version 6 get individual calls, and
+        # send individual answers
+        self.callingBroker._banana_decision_version = 5
+        self.targetBroker._banana_decision_version = 5
+        rr, target = self.setupTarget(Target(), True)
+        dl = rr.callRemoteMany([("add", (1, 2), {}),
+                                ("add", (3, 4), {}),
+                                ])
+        d = self.collect(dl)
+        def _check(res):
+            self.failUnlessEqual(res, [3, 7])
+            self.failUnlessEqual(self.targetOpens, [("call",), ("call",)])
+            self.failUnlessEqual(self.callingOpens,
+                                 [("answer",), ("answer",)])
+        d.addCallback(_check)
+        return d
+
+    def test_answers_first(self):
+        # answers held back for a batch go out before anything else that a
+        # later call in the same turn sends
+        rr, target = self.setupTarget(Pinger())
+        helper = HelperTarget()
+        dl = rr.callRemoteMany([("ping", (), {}),
+                                ("callback", (helper,), {}),
+                                ])
+        d = self.collect(dl)
+        def _check(res):
+            self.failUnlessEqual(res, ["pong", "done"])
+            self.failUnlessEqual(self.callingOpens,
+                                 [("answer",), ("call",), ("answer",)])
+        d.addCallback(_check)
+        def _called():
+            return getattr(helper, "obj", None) == "called"
+        d.addCallback(lambda res: self.poll(_called))
+        return d
+
+
+class Priorities(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        # pretend we negotiated a peer that understands LANE tokens
+        for b in (self.callingBroker, self.targetBroker):
+            b._banana_decision_version = 7
+            b.enableSendLanes()
+        self.targetOpens = recordOpens(self.targetBroker)
+
+    def test_overtake(self):
+        # an urgent call overtakes a bulky one that was made first
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        # as if the transport were full, so that neither call can be sent
+        # right away
+        self.callingBroker.pauseProducing()
+        big = ["%d" % i for i in range(1000)]
+        d1 = rr.callRemote("free", big, _priority=PRIORITY_LOW)
+        d2 = rr.callRemote("add", 1, 2, _priority=PRIORITY_HIGH)
+        self.callingBroker.resumeProducing()
+        d = defer.gatherResults([d1, d2])
+        def _check(res):
+            self.failUnlessEqual(res, ["bird", 3])
+            self.failUnlessEqual(target.calls, [(1, 2), ((big,), {})])
+        d.addCallback(_check)
+        return d
+
+    def test_many(self):
+        # callRemoteMany sends one batch for each priority
+        rr, target = self.setupTarget(TargetWithoutInterfaces())
+        dl = rr.callRemoteMany([("add", (1, 2), {"_priority": PRIORITY_LOW}),
+                                ("add", (3, 4), {"_priority": PRIORITY_HIGH}),
+                                ("add", (5, 6), {"_priority": PRIORITY_LOW}),
+                                ])
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.failUnlessEqual(res, [3, 7, 11])
+            self.failUnlessEqual(target.calls, [(3, 4), (1, 2), (5, 6)])
+            self.failUnlessEqual(self.targetOpens, [("call",), ("batch",)])
+        d.addCallback(_check)
+        return d
+
+
 class TestCallOnly(TargetMixin, unittest.TestCase):
     def setUp(self):
         TargetMixin.setUp(self)
@@ -542,6 +926,21 @@ class TestCallOnly(TargetMixin, unittest.TestCase):
         return d
     testCallOnly.timeout = 2
 
+    def test_getMethod(self):
+        rr, target = self.setupTarget(Target(), True)
+        add = rr.getMethod("add")
+        self.failUnlessIdentical(add(1, 2, _callOnly=True), None)
+        self.failUnlessRaises(TypeError, add, 1, 2, _useSchema=False)
+        self.failUnlessRaises(TypeError, add, 1, 2, _resultConstraint=int)
+        def _check():
+            if target.calls:
+                self.failUnlessEqual(target.calls, [(1,2)])
+                return True
+            return False
+        d = self.poll(_check)
+        return d
+    test_getMethod.timeout = 2
+
 class ExamineFailuresMixin:
     def _examine_raise(self, r, should_be_remote):
         f = r[0]
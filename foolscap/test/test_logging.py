@@ -1,5 +1,5 @@
 
-import os, pickle, time, bz2
+import os, pickle, time, bz2, threading
 from cStringIO import StringIO
 from zope.interface import implements
 from twisted.trial import unittest
@@ -9,12 +9,13 @@ from twisted.python import log as twisted_log
 from twisted.python import failure, runtime, usage
 import foolscap
 from foolscap.logging import gatherer, log, tail, incident, cli, web, \
-     publish, dumper
+     publish, dumper, flogfile
 from foolscap.logging.interfaces import RILogObserver
 from foolscap.util import format_time
 from foolscap.eventual import fireEventually, flushEventualQueue
-from foolscap.tokens import NoLocationError
-from foolscap.test.common import PollMixin, StallMixin, GoodEnoughTub
+from foolscap.tokens import NoLocationError, Violation
+from foolscap.test.common import PollMixin, StallMixin, ShouldFailMixin, \
+     GoodEnoughTub
 from foolscap.api import RemoteException, Referenceable
 
 
@@ -93,6 +94,29 @@ class Advanced(unittest.TestCase):
         d.addCallback(_check)
         return d
 
+    def testThresholds(self):
+        l = log.FoolscapLogger()
+        out = []
+        l.addObserver(out.append)
+        l.addObserver(lambda e: 1/0) # should not stop the other observer
+        # the default threshold applies to every facility
+        l.set_generation_threshold(log.UNUSUAL)
+        l.set_generation_threshold(log.NOISY, "loud")
+        self.failUnlessEqual(l.get_generation_threshold("other"), log.UNUSUAL)
+        l.msg("ignored", level=log.OPERATIONAL)
+        l.msg("ignored", level=log.OPERATIONAL, facility="other")
+        l.msg("one", level=log.NOISY, facility="loud")
+        l.msg("two", level=log.UNUSUAL, facility="other")
+        l.msg("three", level=log.UNUSUAL)
+        d = fireEventually()
+        def _check(res):
+            self.failUnlessEqual([e["message"] for e in out],
+                                 ["one", "two", "three"])
+            self.failUnlessEqual(len(self.flushLoggedErrors(ZeroDivisionError)),
+                                 3)
+        d.addCallback(_check)
+        return d
+
     def testFileObserver(self):
         basedir = "logging/Advanced/FileObserver"
         os.makedirs(basedir)
@@ -106,14 +130,7 @@ class Advanced(unittest.TestCase):
         def _check(res):
             l.removeObserver(ob.msg)
             ob._logFile.close()
-            f = open(fn, "rb")
-            events = []
-            while True:
-                try:
-                    e = pickle.load(f)
-                    events.append(e)
-                except EOFError:
-                    break
+            events = list(flogfile.get_events(fn))
             self.failUnlessEqual(len(events), 3)
             self.failUnlessEqual(events[0]["header"]["type"],
                                  "log-file-observer")
@@ -124,6 +141,32 @@ class Advanced(unittest.TestCase):
         d.addCallback(_check)
         return d
 
+    def testFileObserverFlush(self):
+        # events reach the file at the end of the turn that logged them, not
+        # just when the observer is stopped
+        basedir = "logging/Advanced/FileObserverFlush"
+        os.makedirs(basedir)
+        l = log.FoolscapLogger()
+        fn = os.path.join(basedir, "observer-log.out")
+        ob = log.LogFileObserver(fn)
+        l.addObserver(ob.msg)
+        l.msg("one")
+        d = flushEventualQueue()
+        def _check(res):
+            events = list(flogfile.get_events(fn))
+            self.failUnlessEqual(len(events), 2)
+            l.msg("two")
+            return flushEventualQueue()
+        d.addCallback(_check)
+        def _check2(res):
+            events = list(flogfile.get_events(fn))
+            self.failUnlessEqual(len(events), 3)
+            self.failUnlessEqual(events[2]["d"]["message"], "two")
+            l.removeObserver(ob.msg)
+            ob._stop()
+        d.addCallback(_check2)
+        return d
+
     def testDisplace(self):
         l = log.FoolscapLogger()
         l.set_buffer_size(log.OPERATIONAL, 3)
@@ -188,6 +231,49 @@ class Advanced(unittest.TestCase):
         self.failUnlessEqual(items[0]['message'], "one")
         self.failUnlessEqual(items[-1]['message'], "four")
 
+    def testBudget(self):
+        l = log.FoolscapLogger()
+        l.msg("weird", level=log.WEIRD, facility="ui")
+        l.msg("noisy one", level=log.NOISY)
+        l.msg("operational", level=log.OPERATIONAL)
+        l.msg("noisy two", level=log.NOISY, facility="ui")
+        l.msg("noisy three", level=log.NOISY)
+        # the buffered events come out merged in order
+        messages = [e["message"] for e in l.get_buffered_events()]
+        self.failUnlessEqual(messages, ["weird", "noisy one", "operational",
+                                        "noisy two", "noisy three"])
+        occ = l.get_buffer_occupancy()
+        self.failUnlessEqual(occ["events"], 5)
+        self.failUnlessEqual(occ["byte-budget"], None)
+        self.failUnlessEqual(occ["buffers"][(None, log.NOISY)][0], 2)
+
+        sizes = [log.estimate_event_size(e) for e in l.get_buffered_events()]
+        l.set_buffer_budget(sum(sizes))
+        self.failUnlessEqual(l.get_buffer_occupancy()["bytes"], sum(sizes))
+        # a new event must evict the oldest NOISY event first, from any
+        # facility, before touching the higher levels
+        l.msg("noisy ONE", level=log.UNUSUAL)
+        messages = [e["message"] for e in l.get_buffered_events()]
+        self.failUnlessEqual(messages, ["weird", "operational", "noisy two",
+                                        "noisy three", "noisy ONE"])
+        occ = l.get_buffer_occupancy()
+        self.failUnless(occ["bytes"] <= sum(sizes), occ)
+
+        # an event larger than the whole budget evicts everything below its
+        # own level, and then itself
+        l.msg("y"*sum(sizes), level=log.UNUSUAL)
+        messages = [e["message"] for e in l.get_buffered_events()]
+        self.failUnlessEqual(messages, ["weird"])
+        self.failUnlessEqual(l.get_buffer_occupancy()["bytes"], sizes[0])
+
+        l.set_buffer_budget(None)
+        l.set_buffer_size(log.NOISY, 2)
+        for i in range(5):
+            l.msg("noisy %d" % i, level=log.NOISY)
+        l.set_buffer_size(log.NOISY, 1)
+        messages = [e["message"] for e in l.get_buffered_events()]
+        self.failUnlessEqual(messages, ["weird", "noisy 4"])
+
     def testHierarchy(self):
         l = log.FoolscapLogger()
 
@@ -210,19 +296,14 @@ class NoFollowUpReporter(incident.IncidentReporter):
 
 class LogfileReaderMixin:
     def _read_logfile(self, fn):
-        if fn.endswith(".bz2"):
-            f = bz2.BZ2File(fn, "r")
-        else:
-            f = open(fn, "rb")
+        reader = flogfile.FlogReader(fn)
         events = []
-        while True:
-            try:
-                events.append(pickle.load(f))
-            except EOFError:
-                break
-            except ValueError:
-                break
-        f.close()
+        try:
+            for e in reader.get_events():
+                events.append(e)
+        except ValueError:
+            pass
+        reader.close()
         return events
 
 class Incidents(unittest.TestCase, PollMixin, LogfileReaderMixin):
@@ -325,6 +406,60 @@ class Incidents(unittest.TestCase, PollMixin, LogfileReaderMixin):
         d.addCallback(_check)
         return d
 
+    def test_background(self):
+        l = log.FoolscapLogger()
+        l.setLogDir("logging/Incidents/background")
+        got_logdir = l.logdir
+        l.setIncidentReporterFactory(NoFollowUpReporter)
+        l.msg("1")
+        # WEIRD is below the reporter's SYNCHRONOUS_LEVEL, so the logfile is
+        # written by the IncidentWriter thread
+        l.msg("2-trigger", level=log.WEIRD)
+        self.failUnlessEqual(l.incidents_declared, 1)
+        l.msg("3") # too late for the snapshot
+        d = self.poll(lambda: bool(l.incidents_recorded), 0.1)
+        def _check(res):
+            files = os.listdir(got_logdir)
+            self.failUnlessEqual(len(files), 1)
+            self.failUnless(files[0].endswith(".flog.bz2"), files)
+            fn = l.recent_recorded_incidents[0]
+            self.failUnlessEqual(fn, os.path.join(got_logdir, files[0]))
+            events = self._read_logfile(fn)
+            self.failUnlessEqual(len(events), 1+2)
+            self.failUnlessEqual(events[0]["header"]["trigger"]["message"],
+                                 "2-trigger")
+            self.failUnlessEqual(events[2]["d"]["message"], "2-trigger")
+        d.addCallback(_check)
+        return d
+
+    def test_drain(self):
+        # jobs that were already submitted finish before drain() returns
+        w = incident.IncidentWriter()
+        done = []
+        def _slow(n):
+            time.sleep(0.1)
+            done.append(n)
+        w.call(_slow, 1)
+        w.call(_slow, 2)
+        w.drain()
+        self.failUnlessEqual(done, [1, 2])
+
+    def test_announce_without_reactor(self):
+        # once the reactor has stopped, nothing would deliver an
+        # eventual-send, so a finished incident is announced right away
+        from twisted.internet import reactor
+        l = log.FoolscapLogger()
+        r = incident.IncidentReporter("logging/Incidents/announce", l, "tubid")
+        r.abs_filename_bz2 = "incident.flog.bz2"
+        r.name = "incident"
+        r.trigger = {"message": "boom"}
+        self.patch(reactor, "running", False)
+        r._close_logfile = lambda: None
+        r._close_logfile_in_thread()
+        self.failUnlessEqual(l.incidents_recorded, 1)
+        self.failUnlessEqual(l.recent_recorded_incidents,
+                             ["incident.flog.bz2"])
+
     def test_overlapping(self):
         l = log.FoolscapLogger()
         l.setLogDir("logging/Incidents/overlapping")
@@ -419,6 +554,19 @@ class Observer(Referenceable):
     def remote_done_with_incident_catchup(self):
         self.done_with_incidents = True
 
+class BatchObserver(Observer):
+    def __init__(self):
+        Observer.__init__(self)
+        self.batches = []
+        self.single_messages = 0
+    def remote_msg(self, d):
+        self.single_messages += 1
+        Observer.remote_msg(self, d)
+    def remote_msgs(self, events):
+        self.batches.append(len(events))
+        for d in events:
+            Observer.remote_msg(self, d)
+
 class MyGatherer(gatherer.GathererService):
     verbose = False
 
@@ -429,7 +577,7 @@ class MyGatherer(gatherer.GathererService):
 class SampleError(Exception):
     """a sample error"""
 
-class Publish(PollMixin, unittest.TestCase):
+class Publish(PollMixin, ShouldFailMixin, unittest.TestCase):
     def setUp(self):
         self.parent = service.MultiService()
         self.parent.startService()
@@ -660,6 +808,49 @@ class Publish(PollMixin, unittest.TestCase):
         d.addCallback(_got_logport)
         return d
 
+    def test_logpublisher_batches(self):
+        t = GoodEnoughTub()
+        t.setServiceParent(self.parent)
+        l = t.listenOn("tcp:0:interface=127.0.0.1")
+        t.setLocation("127.0.0.1:%d" % l.getPortnum())
+        logport_furl = t.getLogPortFURL()
+
+        t2 = GoodEnoughTub()
+        t2.setServiceParent(self.parent)
+        ob = BatchObserver()
+
+        d = t2.getReference(logport_furl)
+        def _got_logport(logport):
+            log.msg("batched early message")
+            d = logport.callRemote("subscribe_to_all", ob, True)
+            def _emit(subscription):
+                self._subscription = subscription
+                for i in range(300):
+                    log.msg("batched message %d" % i)
+            d.addCallback(_emit)
+            def _check_f():
+                return bool(ob.messages and ob.messages[-1].get("message")
+                            == "batched message 299")
+            d.addCallback(lambda res: self.poll(_check_f, 0.1))
+            def _check_observer(res):
+                self.failUnlessEqual(ob.single_messages, 0)
+                self.failUnless(max(ob.batches) > 1, ob.batches)
+                self.failUnless(max(ob.batches)
+                                <= publish.Subscription.MAX_BATCH_EVENTS)
+                msgs = [m.get("message") for m in ob.messages]
+                self.failUnless("batched early message" in msgs)
+                first = msgs.index("batched message 0")
+                self.failUnless(msgs.index("batched early message") < first)
+                self.failUnlessEqual(msgs[first:],
+                                     ["batched message %d" % i
+                                      for i in range(300)])
+            d.addCallback(_check_observer)
+            d.addCallback(lambda res:
+                          self._subscription.callRemote("unsubscribe"))
+            return d
+        d.addCallback(_got_logport)
+        return d
+
     def test_logpublisher_catchup(self):
         basedir = "logging/Publish/logpublisher_catchup"
         os.makedirs(basedir)
@@ -735,6 +926,122 @@ class Publish(PollMixin, unittest.TestCase):
         d.addCallback(_got_logport)
         return d
 
+    def test_logpublisher_filter(self):
+        basedir = "logging/Publish/logpublisher_filter"
+        os.makedirs(basedir)
+        furlfile = os.path.join(basedir, "logport.furl")
+        t = GoodEnoughTub()
+        t.setServiceParent(self.parent)
+        l = t.listenOn("tcp:0:interface=127.0.0.1")
+        t.setLocation("127.0.0.1:%d" % l.getPortnum())
+
+        t.setOption("logport-furlfile", furlfile)
+        logport_furl = t.getLogPortFURL()
+
+        t2 = GoodEnoughTub()
+        t2.setServiceParent(self.parent)
+        ob = Observer()
+        spec = {"level": log.UNUSUAL,
+                "include-facilities": ["test.filter"],
+                "exclude-facilities": ["test.filter.hushed"]}
+
+        d = t2.getReference(logport_furl)
+        def _got_logport(logport):
+            # catch-up events are filtered too
+            log.msg("early", level=log.UNUSUAL, facility="test.filter")
+            log.msg("early but boring", facility="test.filter")
+            d = logport.callRemote("subscribe_to_all", ob, True, filter=spec)
+            def _emit(subscription):
+                self._subscription = subscription
+                log.msg("unwanted", level=log.WEIRD, facility="test.other")
+                log.msg("hushed", level=log.WEIRD,
+                        facility="test.filter.hushed")
+                log.msg("boring", facility="test.filter.sub")
+                log.msg("later", level=log.WEIRD, facility="test.filter.sub")
+            d.addCallback(_emit)
+            def _check_f():
+                for m in ob.messages:
+                    if m.get("message") == "later":
+                        return True
+                return False
+            d.addCallback(lambda res: self.poll(_check_f))
+            def _check_observer(res):
+                msgs = [m.get("message") for m in ob.messages]
+                self.failUnlessEqual(msgs, ["early", "later"])
+            d.addCallback(_check_observer)
+            def _done(res):
+                return self._subscription.callRemote("unsubscribe")
+            d.addCallback(_done)
+            # a malformed filter is rejected
+            d.addCallback(lambda res:
+                          self.shouldFail(ValueError,
+                                          "test_logpublisher_filter",
+                                          "bad subscription filter",
+                                          logport.callRemote,
+                                          "subscribe_to_all", ob,
+                                          filter={"level": "high"}))
+            return d
+        d.addCallback(_got_logport)
+        return d
+
+class SubscriptionFilter(unittest.TestCase):
+    def test_filter(self):
+        def wants(spec, events):
+            f = publish.SubscriptionFilter(spec)
+            return [e["message"] for e in events if f.wants(e)]
+        events = [{"message": "a", "level": log.NOISY, "facility": "ui"},
+                  {"message": "b", "level": log.OPERATIONAL},
+                  {"message": "c", "level": log.WEIRD, "facility": "ui.x"},
+                  {"message": "d", "facility": "upload"},
+                  ]
+        self.failUnlessEqual(wants({}, events), ["a", "b", "c", "d"])
+        self.failUnlessEqual(wants({"level": log.OPERATIONAL}, events),
+                             ["b", "c", "d"])
+        self.failUnlessEqual(wants({"include-facilities": ["ui"]}, events),
+                             ["a", "c"])
+        self.failUnlessEqual(wants({"exclude-facilities": ["ui.", "up"]},
+                                   events),
+                             ["a", "b"])
+        self.failUnlessEqual(wants({"noisy-rate": 0.0}, events),
+                             ["b", "c", "d"])
+        self.failUnlessEqual(wants({"future-key": 1}, events),
+                             ["a", "b", "c", "d"])
+
+        f = publish.SubscriptionFilter({"noisy-rate": 0.25})
+        noisy = [{"num": i, "level": log.NOISY} for i in range(8)]
+        kept = [e["num"] for e in noisy if f.wants(e)]
+        self.failUnlessEqual(kept, [3, 7])
+
+        self.failUnlessRaises(ValueError, publish.SubscriptionFilter,
+                              {"level": "high"})
+        self.failUnlessRaises(ValueError, publish.SubscriptionFilter,
+                              {"noisy-rate": 2})
+
+    def test_old_publisher(self):
+        # a publisher that predates filter= rejects it with a Violation, so
+        # the subscriber has to do the filtering itself
+        class OldPublisher:
+            def __init__(self):
+                self.calls = []
+            def callRemote(self, methname, *args, **kwargs):
+                self.calls.append((methname, args, kwargs))
+                if "filter" in kwargs:
+                    return defer.fail(Violation("unknown argument 'filter'"))
+                return defer.succeed("subscription")
+        p = OldPublisher()
+        d = publish.subscribe_to_all(p, "observer", True, {"level": log.BAD})
+        def _check(local_filter):
+            self.failUnlessEqual(len(p.calls), 2)
+            self.failUnlessEqual(p.calls[1],
+                                 ("subscribe_to_all", ("observer", True), {}))
+            self.failIf(local_filter.wants({"level": log.WEIRD}))
+            self.failUnless(local_filter.wants({"level": log.BAD}))
+        d.addCallback(_check)
+        d.addCallback(lambda res: publish.subscribe_to_all(p, "observer"))
+        d.addCallback(lambda local_filter:
+                      self.failUnlessEqual(local_filter, None))
+        return d
+
 class IncidentPublisher(PollMixin, unittest.TestCase):
     def setUp(self):
         self.parent = service.MultiService()
@@ -799,8 +1106,8 @@ class IncidentPublisher(PollMixin, unittest.TestCase):
         t.logger.msg("two")
         # and trigger an incident
         t.logger.msg("three", level=log.WEIRD)
-        # the NonTrailingIncidentReporter needs a turn before it will have
-        # finished recording the event: the getReference() call will suffice.
+        # the NonTrailingIncidentReporter records the event in its writer
+        # thread, so we must wait for it to finish before looking.
 
         # now set up a Tub to connect to the logport
         t.setServiceParent(self.parent)
@@ -815,7 +1122,8 @@ class IncidentPublisher(PollMixin, unittest.TestCase):
         t2 = GoodEnoughTub()
         t2.setServiceParent(self.parent)
 
-        d = t2.getReference(logport_furl)
+        d = self.poll(lambda: bool(t.logger.incidents_recorded))
+        d.addCallback(lambda ign: t2.getReference(logport_furl))
         def _got_logport(logport):
             d = logport.callRemote("list_incidents")
             d.addCallback(self._check_listed)
@@ -875,8 +1183,8 @@ class IncidentPublisher(PollMixin, unittest.TestCase):
         t.logger.msg("blah")
         # and trigger the first incident
         t.logger.msg("one", level=log.WEIRD)
-        # the NonTrailingIncidentReporter needs a turn before it will have
-        # finished recording the event: the getReference() call will suffice.
+        # the NonTrailingIncidentReporter records the event in its writer
+        # thread, so we must wait for it to finish before looking.
 
         # now set up a Tub to connect to the logport
         t.setServiceParent(self.parent)
@@ -888,7 +1196,8 @@ class IncidentPublisher(PollMixin, unittest.TestCase):
         t2 = GoodEnoughTub()
         t2.setServiceParent(self.parent)
 
-        d = t2.getReference(logport_furl)
+        d = self.poll(lambda: bool(t.logger.incidents_recorded))
+        d.addCallback(lambda ign: t2.getReference(logport_furl))
         def _got_logport(logport):
             self._logport = logport
             d2 = logport.callRemote("subscribe_to_incidents", ob) # no catchup
@@ -1273,6 +1582,73 @@ class Gatherer(unittest.TestCase, LogfileReaderMixin, StallMixin, PollMixin):
                                   MyGatherer, None, True, None)
         self.failUnless("running in the wrong directory" in str(e))
 
+    def test_buffering(self):
+        basedir = "logging/Gatherer/buffering"
+        os.makedirs(basedir)
+        gatherer = MyGatherer(None, False, basedir, flush_interval=0.5,
+                              flush_bytes=4000)
+        gatherer.tub_class = GoodEnoughTub
+        gatherer.setServiceParent(self.parent)
+        fn = gatherer._savefile_name
+        size0 = os.path.getsize(fn) # just the header
+        for i in range(10):
+            gatherer.msg("nodeid", {"num": i, "time": time.time(),
+                                    "level": log.OPERATIONAL,
+                                    "message": "buffered %d" % i})
+        # nothing is written until the timer fires
+        self.failUnlessEqual(os.path.getsize(fn), size0)
+        stats = gatherer.get_stats()
+        self.failUnlessEqual(stats["events"], 10)
+        self.failUnless(stats["buffered-bytes"] > 0)
+        d = self.poll(lambda: os.path.getsize(fn) > size0)
+        def _flushed(res):
+            self.failUnlessEqual(gatherer.get_stats()["buffered-bytes"], 0)
+            self.failUnlessEqual(len(self._read_logfile(fn)), 1+10)
+            size1 = os.path.getsize(fn)
+            # filling the buffer writes it out right away
+            for i in range(10, 200):
+                gatherer.msg("nodeid", {"num": i, "time": time.time(),
+                                        "level": log.OPERATIONAL,
+                                        "message": "x" * 100})
+            self.failUnless(os.path.getsize(fn) > size1)
+            self.failUnless(gatherer.get_stats()["buffered-bytes"] < 4000)
+            self.failUnlessEqual(gatherer.get_bytes_written(),
+                                 os.path.getsize(fn)
+                                 - len(flogfile.MAGIC))
+            return gatherer.do_rotate()
+        d.addCallback(_flushed)
+        def _rotated(new_name):
+            events = self._read_logfile(new_name)
+            self.failUnlessEqual(len(events), 1+200)
+            self.failUnlessEqual(events[-1]["d"]["num"], 199)
+            self.failUnlessEqual(gatherer.get_stats()["events"], 200)
+        d.addCallback(_rotated)
+        return d
+
+    def test_compress(self):
+        basedir = "logging/Gatherer/compress"
+        os.makedirs(basedir)
+        gatherer = MyGatherer(None, True, basedir, compress=True)
+        gatherer.tub_class = GoodEnoughTub
+        gatherer.setServiceParent(self.parent)
+        self.failIf(gatherer.bzip) # no need for it
+        for i in range(1000):
+            gatherer.msg("nodeid", {"num": i, "time": time.time(),
+                                    "level": log.OPERATIONAL,
+                                    "message": "compressible %d" % i})
+        d = gatherer.do_rotate()
+        def _rotated(new_name):
+            self.failUnless(new_name.endswith(".flog"), new_name)
+            events = self._read_logfile(new_name)
+            self.failUnlessEqual(len(events), 1+1000)
+            self.failUnlessEqual(events[-1]["d"]["message"],
+                                 "compressible 999")
+            raw = sum([len(pickle.dumps(e, 2)) for e in events])
+            self.failUnless(os.path.getsize(new_name) < raw / 2,
+                            (os.path.getsize(new_name), raw))
+        d.addCallback(_rotated)
+        return d
+
     def test_log_gatherer(self):
         # setLocation, then set log-gatherer-furl. Also, use bzip=True for
         # this one test.
@@ -1677,6 +2053,20 @@ class Tail(unittest.TestCase):
         self.failUnlessEqual(to["save-to"], "save.flog")
         self.failUnlessEqual(to.target_furl, "pretend this is a furl")
 
+        to = tail.TailOptions()
+        self.failUnlessEqual(to.get_filter_spec(), None)
+        to.parseOptions(["--level", "unusual", "--include-facility", "a",
+                         "--include-facility", "b.c", "--exclude-facility",
+                         "b.c.d", "--noisy-rate", "0.5", fn])
+        self.failUnlessEqual(to.get_filter_spec(),
+                             {"level": log.UNUSUAL,
+                              "include-facilities": ["a", "b.c"],
+                              "exclude-facilities": ["b.c.d"],
+                              "noisy-rate": 0.5})
+        to = tail.TailOptions()
+        self.failUnlessRaises(usage.UsageError, to.parseOptions,
+                              ["--level", "LOUD", fn])
+
         to = tail.TailOptions()
         self.failUnlessRaises(RuntimeError, to.parseOptions, ["bogus.txt"])
 
@@ -1702,9 +2092,21 @@ class CLI(unittest.TestCase):
 
         basedir = "logging/CLI/create_gatherer2"
         argv = ["flogtool", "create-gatherer", "--rotate", "3600",
+                "--flush-interval", "0.5", "--flush-bytes", "65536",
                 "--quiet", basedir]
         cli.run_flogtool(argv[1:], run_by_human=False)
         self.failUnless(os.path.exists(basedir))
+        tac = open(os.path.join(basedir, "gatherer.tac")).read()
+        self.failUnless("flush_interval = 0.5\n" in tac, tac)
+        self.failUnless("flush_bytes = 65536\n" in tac, tac)
+        self.failUnless("subscription_filter = None\n" in tac, tac)
+
+        basedir = "logging/CLI/create_gatherer4"
+        argv = ["flogtool", "create-gatherer", "--level", "WEIRD",
+                "--quiet", basedir]
+        cli.run_flogtool(argv[1:], run_by_human=False)
+        tac = open(os.path.join(basedir, "gatherer.tac")).read()
+        self.failUnless("subscription_filter = {'level': 30}\n" in tac, tac)
 
         basedir = "logging/CLI/create_gatherer3"
         argv = ["flogtool", "create-gatherer", basedir]
@@ -2035,7 +2437,262 @@ class Filter(unittest.TestCase, LogfileWriterMixin, LogfileReaderMixin):
         d.addCallback(_check)
         return d
 
+    def test_merge(self):
+        basedir = "logging/Filter/merge"
+        os.makedirs(basedir)
+        # three files whose events interleave: two indexed containers (one
+        # of them compressed) and a legacy file
+        inputs = []
+        all_events = []
+        for (i, tubid) in enumerate(["tubA", "tubB", "tubC"]):
+            header = {"header": {"type": "test", "tubid": tubid}}
+            events = []
+            for j in range(20):
+                events.append({"from": tubid, "rx_time": 2000.0,
+                               "d": {"num": j, "time": 1000.0 + 3*j + i,
+                                     "level": 20 + 10*(j%2),
+                                     "message": "%s %d" % (tubid, j)}})
+            fn = os.path.join(basedir, "%s.flog" % tubid)
+            if i == 0:
+                w = flogfile.open_writer(fn, blocksize=300)
+                for e in [header] + events:
+                    w.add(e)
+                w.close()
+            elif i == 1:
+                fn += ".bz2"
+                w = flogfile.open_writer(fn, blocksize=300)
+                for e in [header] + events:
+                    w.add(e)
+                w.close()
+            else:
+                f = open(fn, "wb")
+                for e in [header] + events:
+                    pickle.dump(e, f)
+                f.close()
+            inputs.append(fn)
+            all_events.extend(events)
+        def by_time(e):
+            return e["d"]["time"]
+        all_events.sort(key=by_time)
+        out_fn = os.path.join(basedir, "merged.flog")
+
+        for jobs in ["1", "2"]:
+            argv = ["merge", "--jobs", jobs] + inputs + [out_fn]
+            (out,err) = cli.run_flogtool(argv, run_by_human=False)
+            self.failUnless("merged 63 of 63 events from 3 files into new file"
+                            in out, out)
+            merged = list(flogfile.get_events(out_fn))
+            self.failUnlessEqual([e["header"]["tubid"] for e in merged[:3]],
+                                 ["tubA", "tubB", "tubC"])
+            self.failUnlessEqual(merged[3:], all_events)
+
+            argv = ["merge", "--jobs", jobs, "--above", "30",
+                    "--strip-facility", "nothing", "--from", "tubB"] + \
+                    inputs + [out_fn + ".bz2"]
+            (out,err) = cli.run_flogtool(argv, run_by_human=False)
+            self.failUnless("--above: removing events below level 30" in out,
+                            out)
+            self.failUnless("merged 13 of 63 events from 3 files into new file"
+                            in out, out)
+            merged = list(flogfile.get_events(out_fn + ".bz2"))
+            self.failUnlessEqual(len(merged), 3+10)
+            self.failUnlessEqual(merged[3:],
+                                 [e for e in all_events
+                                  if e["from"] == "tubB"
+                                  and e["d"]["level"] >= 30])
+
+        self.failUnlessRaises(usage.UsageError, cli.run_flogtool,
+                              ["merge", out_fn], run_by_human=False)
+        self.failUnlessRaises(usage.UsageError, cli.run_flogtool,
+                              ["merge", inputs[0], inputs[0]],
+                              run_by_human=False)
+
+
+
+class FlogFile(unittest.TestCase):
+    def make_events(self, count):
+        events = [{"header": {"type": "test"}}]
+        for i in range(count):
+            events.append({"from": "tubid", "rx_time": 2000.0+i,
+                           "d": {"num": i, "time": 1000.0+i,
+                                 "level": 20 + 10*(i%3),
+                                 "message": "event %d" % i}})
+        return events
 
+    def write(self, fn, events):
+        w = flogfile.open_writer(fn, blocksize=300)
+        for e in events:
+            w.add(e)
+        w.close()
+
+    def read(self, fn, **kwargs):
+        r = flogfile.FlogReader(fn)
+        events = list(r.get_events(**kwargs))
+        r.close()
+        return events
+
+    def check_selections(self, fn, events):
+        self.failUnlessEqual(self.read(fn), events)
+        self.failUnlessEqual(self.read(fn, after=1010, before=1020),
+                             events[:1] + events[1+11:1+20])
+        self.failUnlessEqual(self.read(fn, first_num=40),
+                             events[:1] + events[1+40:])
+        self.failUnlessEqual(self.read(fn, first_num=5, last_num=7),
+                             events[:1] + events[1+5:1+8])
+        self.failUnlessEqual(self.read(fn, above=40),
+                             events[:1] + events[1+2::3])
+        # every event can be found again by its location, in any order
+        r = flogfile.FlogReader(fn)
+        located = list(r.get_located_events())
+        self.failUnlessEqual([e for (location, e) in located], events)
+        located.reverse()
+        for (location, e) in located:
+            self.failUnlessEqual(r.get_event_at(location), e)
+        r.close()
+
+    def test_container(self):
+        basedir = "logging/FlogFile/container"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "events.flog")
+        events = self.make_events(50)
+        self.write(fn, events)
+        self.failUnless(os.path.exists(fn + ".idx"))
+        r = flogfile.FlogReader(fn)
+        self.failUnless(r.is_container)
+        blocks = r.get_blocks()
+        self.failUnless(len(blocks) > 5, len(blocks))
+        self.failUnlessEqual(r.count_events(), 51)
+        # a narrow selection only has to read the blocks that cover it
+        selector = flogfile.EventSelector(first_num=30, last_num=31)
+        wanted = [b for b in blocks if b.might_match(selector)]
+        self.failUnless(len(wanted) <= 3, len(wanted))
+        r.close()
+        self.check_selections(fn, events)
+
+        # the sidecar is only a cache
+        os.unlink(fn + ".idx")
+        self.check_selections(fn, events)
+
+    def test_truncated(self):
+        basedir = "logging/FlogFile/truncated"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "events.flog")
+        events = self.make_events(50)
+        self.write(fn, events)
+        r = flogfile.FlogReader(fn)
+        last = r.get_blocks()[-1]
+        r.close()
+        # a crash in the middle of the last block: the sidecar knows about
+        # a block that isn't all there
+        f = open(fn, "r+b")
+        f.truncate(last.offset + last.length - 5)
+        f.close()
+        complete = self.read(fn)
+        self.failUnless(len(complete) < len(events))
+        self.failUnlessEqual(complete, events[:len(complete)])
+        self.failUnlessEqual(self.read(fn, after=1000),
+                             events[:1] + events[2:len(complete)])
+        # a reader which indexed the file before it was cut short stops at
+        # the last block it can still read
+        self.write(fn, events)
+        r = flogfile.FlogReader(fn)
+        r.get_blocks()
+        f = open(fn, "r+b")
+        f.truncate(last.offset + last.length - 5)
+        f.close()
+        self.failUnlessEqual(list(r.get_events(after=1000)),
+                             events[:1] + events[2:len(complete)])
+        r.close()
+
+    def test_compressed(self):
+        basedir = "logging/FlogFile/compressed"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "events.flog")
+        events = self.make_events(50)
+        w = flogfile.BackgroundFlogWriter(open(fn, "wb"),
+                                          open(fn + ".idx", "wb"),
+                                          blocksize=300, buffersize=1000,
+                                          compress=True)
+        for e in events:
+            w.add(e)
+        w.close()
+        self.failUnlessEqual(w.error, None)
+        self.failUnless(flogfile.ZLIB_BLOCK_MARK in open(fn, "rb").read())
+        self.failIf(flogfile.BLOCK_MARK in open(fn, "rb").read())
+        self.check_selections(fn, events)
+        os.unlink(fn + ".idx")
+        self.check_selections(fn, events)
+        # every complete block can be read after a crash
+        f = open(fn, "r+b")
+        f.truncate(os.path.getsize(fn) - 5)
+        f.close()
+        complete = self.read(fn)
+        self.failUnless(1 < len(complete) < len(events))
+        self.failUnlessEqual(complete, events[:len(complete)])
+
+    def test_closed(self):
+        basedir = "logging/FlogFile/closed"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "events.flog")
+        events = self.make_events(2)
+        w = flogfile.BackgroundFlogWriter(open(fn, "wb"),
+                                          open(fn + ".idx", "wb"))
+        w.add(events[0])
+        w.close()
+        self.failUnlessRaises(ValueError, w.add, events[1])
+        self.failUnlessEqual(self.read(fn), events[:1])
+
+    def test_write_error(self):
+        # the owner hears about a failed write as soon as it happens
+        class BrokenFile:
+            def seek(self, offset, whence=0):
+                pass
+            def tell(self):
+                return 0
+            def write(self, data):
+                if data != flogfile.MAGIC:
+                    raise IOError("disk full")
+            def close(self):
+                pass
+        errors = []
+        failed = threading.Event()
+        def _on_error(e):
+            errors.append(e)
+            failed.set()
+        w = flogfile.BackgroundFlogWriter(BrokenFile(), queue_size=2,
+                                          on_error=_on_error)
+        self.failUnlessEqual(w._queue.maxsize, 2)
+        w.add(self.make_events(1)[0])
+        w.flush()
+        failed.wait(10)
+        self.failUnlessEqual(len(errors), 1)
+        self.failUnless(isinstance(errors[0], IOError))
+        self.failUnlessIdentical(w.error, errors[0])
+        w.close()
+
+    def test_bz2(self):
+        basedir = "logging/FlogFile/bz2"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "events.flog.bz2")
+        events = self.make_events(50)
+        self.write(fn, events)
+        self.failUnless(os.path.exists(os.path.join(basedir,
+                                                    "events.flog.idx")))
+        self.check_selections(fn, events)
+
+    def test_legacy(self):
+        basedir = "logging/FlogFile/legacy"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "events.flog")
+        events = self.make_events(50)
+        f = open(fn, "wb")
+        for e in events:
+            pickle.dump(e, f)
+        f.close()
+        r = flogfile.FlogReader(fn)
+        self.failIf(r.is_container)
+        r.close()
+        self.check_selections(fn, events)
 
 class Web(unittest.TestCase):
     def setUp(self):
@@ -2115,6 +2772,98 @@ class Web(unittest.TestCase):
         d.addCallback(_check_all_events)
         return d
 
+    def test_streaming(self):
+        from twisted.web import client
+        basedir = "logging/Web/streaming"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "flog.out")
+        w = flogfile.open_writer(fn, blocksize=200) # several blocks
+        tubid = "jiijpvbge2e3c3botuzzz7la3utpl67v"
+        incarnation = ("abcdefgh", None)
+        w.add({"header": {"type": "log-file-observer", "pid": 123,
+                          "versions": {"foolscap": foolscap.__version__}}})
+        def add(num, message, **kwargs):
+            d = {"num": num, "time": 1000.0+num, "message": message,
+                 "level": log.OPERATIONAL, "incarnation": incarnation}
+            d.update(kwargs)
+            w.add({"from": tubid, "rx_time": 1000.0+num, "d": d})
+        add(0, "zero")
+        add(1, "one")
+        add(2, "two", parent=1)
+        add(3, "three", parent=2, level=log.UNUSUAL)
+        add(4, "four")
+        add(5, "five", parent=1)
+        add(6, "six")
+        w.close()
+        # and the same file compressed, the way rotated gatherer files are
+        bz2_fn = fn + ".bz2"
+        f = bz2.BZ2File(bz2_fn, "w")
+        f.write(open(fn, "rb").read())
+        f.close()
+
+        def _stop(res):
+            if self.viewer:
+                return self.viewer.serv.stopService()
+        def _start(res, fn):
+            argv = ["-p", "tcp:0:interface=127.0.0.1", "--quiet",
+                    "--streaming", "--page-size", "2", fn]
+            options = web.WebViewerOptions()
+            options.parseOptions(argv)
+            self.viewer = web.WebViewer()
+            self.url = self.viewer.start(options)
+            self.baseurl = self.url[:self.url.rfind("/")] + "/"
+        def get(path):
+            return client.getPage(self.baseurl + path)
+        def _check_welcome(page):
+            self.failUnless("PID 123" in page, page)
+            self.failUnless("7 events covering 6 seconds" in page, page)
+            self.failUnless('href="summary/0-20">6 events</a> at level 20'
+                            in page, page)
+        def _check_nested(page):
+            self.failUnless("4 root events" in page, page)
+            self.failUnless("page 1 of 2" in page, page)
+            # the children of 'one' are nested under it, in order
+            self.failUnless(": one</span></li>\n<ul>\n" in page, page)
+            self.failUnless(page.index(": two") < page.index(": UNUSUAL three")
+                            < page.index(": five"), page)
+            self.failIf(": four" in page, page)
+        def _check_nested_page2(page):
+            self.failUnless("page 2 of 2" in page, page)
+            self.failUnless(": four" in page, page)
+            self.failUnless(": six" in page, page)
+            self.failIf(": one" in page, page)
+        def _check_window(page):
+            # time-windowed and paged: events 2 and 3
+            self.failUnless("page 1 of 2" in page, page)
+            self.failUnless(": two" in page, page)
+            self.failUnless(": UNUSUAL three" in page, page)
+            self.failIf(": one" in page, page)
+            self.failIf(": four" in page, page)
+        def _check_summary(page):
+            self.failUnless("Events at level 20" in page, page)
+            self.failUnless("page 3 of 3" in page, page)
+            self.failUnless(": six" in page, page)
+
+        d = defer.succeed(None)
+        for logfile in (fn, bz2_fn):
+            d.addCallback(_stop)
+            d.addCallback(_start, logfile)
+            d.addCallback(lambda res: get(""))
+            d.addCallback(_check_welcome)
+            d.addCallback(lambda res: get("all-events"))
+            d.addCallback(_check_nested)
+            d.addCallback(lambda res: get("all-events?sort=nested&page=1"))
+            d.addCallback(_check_nested_page2)
+            d.addCallback(lambda res:
+                          get("all-events?sort=time&after=1001&before=1006"))
+            d.addCallback(_check_window)
+            d.addCallback(lambda res:
+                          get("all-events?sort=number&after=1001&before=1006"))
+            d.addCallback(_check_window)
+            d.addCallback(lambda res: get("summary/0-20?page=2"))
+            d.addCallback(_check_summary)
+        return d
+
 
 class Bridge(unittest.TestCase):
     def test_foolscap_to_twisted(self):
@@ -757,18 +757,18 @@ class Existing(CrossfireMixin, unittest.TestCase):
 # this test will have to change when the regular Negotiation starts using
 # different decision blocks. The version numbers must be updated each time
 # the negotiation version is changed.
-assert negotiate.Negotiation.maxVersion == 3
+assert negotiate.Negotiation.maxVersion == 7
 MAX_HANDLED_VERSION = negotiate.Negotiation.maxVersion
-UNHANDLED_VERSION = 4
+UNHANDLED_VERSION = 8
 class NegotiationVbig(negotiate.Negotiation):
     maxVersion = UNHANDLED_VERSION
     def __init__(self, logparent):
         negotiate.Negotiation.__init__(self, logparent)
         self.negotiationOffer["extra"] = "new value"
-    def evaluateNegotiationVersion4(self, offer):
+    def evaluateNegotiationVersion8(self, offer):
         # just like v1, but different
         return self.evaluateNegotiationVersion1(offer)
-    def acceptDecisionVersion4(self, decision):
+    def acceptDecisionVersion8(self, decision):
         return self.acceptDecisionVersion1(decision)
 
 class NegotiationVbigOnly(NegotiationVbig):
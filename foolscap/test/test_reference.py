@@ -1,6 +1,7 @@
 
 from zope.interface import implements
 from twisted.trial import unittest
+from twisted.internet import defer
 from foolscap.ipb import IRemoteReference
 from foolscap.test.common import HelperTarget, Target, ShouldFailMixin
 from foolscap.eventual import flushEventualQueue
@@ -45,6 +46,31 @@ class LocalReference(unittest.TestCase, ShouldFailMixin):
         rc = rref.callRemoteOnly("set", 12)
         self.failUnlessEqual(rc, None)
 
+    def test_getMethod(self):
+        t = HelperTarget()
+        t.obj = None
+        rref = IRemoteReference(t)
+        m = rref.getMethod("set")
+        d = m(12)
+        self.failUnlessEqual(t.obj, None)
+        def _check(res):
+            self.failUnlessEqual(t.obj, 12)
+            self.failUnlessEqual(res, True)
+        d.addCallback(_check)
+        return d
+
+    def test_callRemoteMany(self):
+        t = HelperTarget()
+        t.obj = None
+        rref = IRemoteReference(t)
+        dl = rref.callRemoteMany([("set", (12,), {}),
+                                  ("get", (), {})])
+        self.failUnlessEqual(len(dl), 2)
+        self.failUnlessEqual(t.obj, None)
+        d = defer.gatherResults(dl)
+        d.addCallback(lambda res: self.failUnlessEqual(res, [True, 12]))
+        return d
+
     def test_fail(self):
         t = Target()
         rref = IRemoteReference(t)
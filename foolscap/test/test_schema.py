@@ -413,6 +413,24 @@ class Arguments(unittest.TestCase):
         self.failUnlessRaises(schema.Violation,
                               r.checkResults, 12, False)
 
+    def test_validated(self):
+        def foo(a=int, b=str, c=schema.Optional(schema.Any(), None)):
+            return schema.Any()
+        r = RemoteMethodSchema(method=foo)
+        # the inbound side skips the arguments that were already checked
+        # as they arrived, but still looks for missing ones
+        self.failUnlessRaises(schema.Violation,
+                              r.checkAllArgs, (1, 2), {}, True)
+        r.checkAllArgs((1, 2), {}, True, set([1]))
+        self.failUnlessRaises(schema.Violation,
+                              r.checkAllArgs, (1,), {"b": 2}, True)
+        r.checkAllArgs((1,), {"b": 2}, True, set(["b"]))
+        self.failUnlessRaises(schema.Violation, # missing required "b"
+                              r.checkAllArgs, (1,), {}, True, set([0]))
+        # constraints which accept everything are never called
+        self.failUnlessEqual(r._argCheckers["c"], None)
+        self.failUnlessEqual(r._resultChecker, None)
+
     def test_bad_arguments(self):
         def foo(nodefault): return str
         self.failUnlessRaises(InvalidRemoteInterface,
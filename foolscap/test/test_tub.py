@@ -417,6 +417,111 @@ class CancelPendingDeliveries(unittest.TestCase, StallMixin):
         d.addCallback(self.stall, 1.0)
         return d
 
+class AdaptiveVocab(unittest.TestCase):
+    def setUp(self):
+        self.tubA = GoodEnoughTub()
+        self.tubB = GoodEnoughTub()
+        self.tubA.startService()
+        self.tubB.startService()
+
+    def tearDown(self):
+        d = defer.DeferredList([self.tubA.stopService(),
+                                self.tubB.stopService()])
+        d.addCallback(flushEventualQueue)
+        return d
+
+    def test_bad_option(self):
+        self.failUnlessRaises(KeyError, self.tubA.setOption,
+                              "adaptive-vocab", {"treshold": 2})
+        self.failUnlessRaises(ValueError, self.tubA.setOption,
+                              "adaptive-vocab", {"tableSize": 100000})
+        self.failUnlessEqual(self.tubA._adaptive_vocab, None)
+
+    def test_option(self):
+        self.tubA.setOption("adaptive-vocab", {"threshold": 2})
+        self.tubB.listenOn("tcp:0:interface=127.0.0.1")
+        d = self.tubB.setLocationAutomatically()
+        target = HelperTarget()
+        d.addCallback(lambda res: self.tubB.registerReference(target))
+        d.addCallback(lambda furl: self.tubA.getReference(furl))
+        def _connected(rref):
+            self.rref = rref
+            broker = rref.tracker.broker
+            self.failUnless(broker.vocabLearning)
+            self.failUnlessEqual(broker.vocabPromotionThreshold, 2)
+            d1 = rref.callRemote("set", obj="a repeated string")
+            d1.addCallback(lambda res:
+                           rref.callRemote("set", obj="a repeated string"))
+            d1.addCallback(lambda res: rref.callRemote("get"))
+            return d1
+        d.addCallback(_connected)
+        def _check(res):
+            self.failUnlessEqual(res, "a repeated string")
+            broker = self.rref.tracker.broker
+            self.failUnless("a repeated string" in broker.outgoingVocabulary)
+            # the other end does not learn unless it was asked to
+            for b in self.tubB.brokers.values():
+                self.failIf(b.vocabLearning)
+        d.addCallback(_check)
+        return d
+
+
+class TLSSessions(unittest.TestCase):
+    if not crypto_available:
+        skip = "crypto not available"
+
+    def setUp(self):
+        self.tubA = Tub()
+        self.tubB = Tub()
+        self.tubA.startService()
+        self.tubB.startService()
+
+    def tearDown(self):
+        d = defer.DeferredList([self.tubA.stopService(),
+                                self.tubB.stopService()])
+        d.addCallback(flushEventualQueue)
+        return d
+
+    def test_resume(self):
+        self.tubB.listenOn("tcp:0:interface=127.0.0.1")
+        d = self.tubB.setLocationAutomatically()
+        d.addCallback(lambda res: self.tubB.registerReference(HelperTarget()))
+        def _connect(furl):
+            self.furl = furl
+            return self.tubA.getReference(furl)
+        d.addCallback(_connect)
+        def _disconnect(rref):
+            self.failUnlessEqual(self.tubA.getTLSStats(),
+                                 {"full-handshakes": 1,
+                                  "resumed-handshakes": 0})
+            d1 = defer.Deferred()
+            rref.notifyOnDisconnect(d1.callback, None)
+            rref.tracker.broker.transport.loseConnection()
+            return d1
+        d.addCallback(_disconnect)
+        d.addCallback(flushEventualQueue)
+        d.addCallback(lambda res: self.tubA.getReference(self.furl))
+        # the peer's certificate must still be available after resumption
+        d.addCallback(lambda rref: rref.callRemote("set", obj=12))
+        def _check(res):
+            for tub in (self.tubA, self.tubB):
+                self.failUnlessEqual(tub.getTLSStats(),
+                                     {"full-handshakes": 1,
+                                      "resumed-handshakes": 1})
+            self.failUnlessIdentical(self.tubA.getTLSOptions(True),
+                                     self.tubA.getTLSOptions(True))
+            # the session went to that one connection, and no further
+            self.failUnlessEqual(self.tubA.getTLSOptions(True)._nextSession,
+                                 None)
+        d.addCallback(_check)
+        return d
+
+    def test_unknown_reuse(self):
+        # anything pyOpenSSL cannot tell us about is not counted
+        from foolscap import crypto
+        self.failUnlessEqual(crypto.sessionWasReused(object()), None)
+
+
 class BadLocationFURL(unittest.TestCase):
     def setUp(self):
         self.s = service.MultiService()
@@ -20,6 +20,8 @@ ABORT    = chr(0x8A)
 ERROR    = chr(0x8D)
 PING     = chr(0x8E)
 PONG     = chr(0x8F)
+# peers which negotiate banana-decision-version 7 or later accept these
+LANE     = chr(0x90)
 
 tokenNames = {
     LIST: "LIST",
@@ -36,6 +38,7 @@ tokenNames = {
     ERROR: "ERROR",
     PING: "PING",
     PONG: "PONG",
+    LANE: "LANE",
     }
 
 SIZE_LIMIT = 1000 # default limit on the body length of long tokens (STRING,